@@ -0,0 +1,301 @@
+"""Benchmarks for Rotten Bites."""
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import unittest.mock
+
+import click
+import rotten_bites
+
+
+class Counter():
+    """Wrap a function, counting how many times it is called."""
+
+    def __init__(self, func):
+        """Wrap func."""
+        self.func = func
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        """Call the wrapped function."""
+        self.calls += 1
+        return self.func(*args, **kwargs)
+
+
+def make_tree(directory, dirs, files, depth):
+    """Create a tree of empty files, dirs wide and depth deep."""
+    def make(path, level):
+        for i in range(files):
+            open(os.path.join(path, 'file_{}'.format(i)), 'w').close()
+
+        if level == depth:
+            return
+
+        for i in range(dirs):
+            sub_path = os.path.join(path, 'dir_{}'.format(i))
+            os.mkdir(sub_path)
+            make(sub_path, level + 1)
+
+    make(directory, 0)
+
+
+def old_walk(directory):
+    """Walk a tree the way rotten bites used to, with os.walk and os.stat."""
+    for path, _, files in os.walk(directory):
+        for _ in rotten_bites.walk_files(path, sorted(files)):
+            pass
+
+
+def new_walk(directory):
+    """Walk a tree with scan_dir."""
+    for _, entries in rotten_bites.scan_dir(directory):
+        for _ in rotten_bites.stat_entries(entries):
+            pass
+
+
+def count_calls(walk, directory):
+    """
+    Walk a tree, counting the calls that end up as system calls.
+
+    DirEntry.stat can't be wrapped, so stat_entry is counted in its place.
+    """
+    counters = {name: Counter(getattr(os, name))
+                for name in ('stat', 'lstat', 'scandir')}
+    counters['stat_entry'] = Counter(rotten_bites.stat_entry)
+
+    patches = [unittest.mock.patch.object(os, name, counter)
+               for name, counter in counters.items() if name != 'stat_entry']
+    patches.append(unittest.mock.patch('rotten_bites.stat_entry',
+                                       counters['stat_entry']))
+
+    for patch in patches:
+        patch.start()
+    try:
+        walk(directory)
+    finally:
+        for patch in patches:
+            patch.stop()
+
+    return {name: counter.calls for name, counter in counters.items()}
+
+
+def time_walk(walk, directory, repeat):
+    """Return the fastest of repeat walks of a tree."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        walk(directory)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# name: (directories per directory, files per directory, depth, file size)
+# at a scale of 1
+SHAPES = {
+    'tiny': (4, 200, 2, 100),
+    'huge': (0, 4, 0, 64 * 1024 * 1024),
+    'deep': (1, 5, 40, 4096),
+    'mixed': (3, 30, 3, 256 * 1024),
+}
+
+
+def make_shape(directory, shape, scale):
+    """
+    Create a tree of a named shape, with files of random bytes.
+
+    scale multiplies the number of files per directory. Returns the number
+    of directories, files and bytes.
+    """
+    dirs, files, depth, size = SHAPES[shape]
+    files = max(1, int(files * scale))
+    totals = {'directories': 0, 'files': 0, 'bytes': 0}
+
+    def make(path, level):
+        totals['directories'] += 1
+        for i in range(files):
+            with open(os.path.join(path, 'file_{}'.format(i)), 'wb') as file:
+                file.write(os.urandom(size))
+        totals['files'] += files
+        totals['bytes'] += files * size
+
+        if level == depth:
+            return
+
+        for i in range(dirs):
+            sub_path = os.path.join(path, 'dir_{}'.format(i))
+            os.mkdir(sub_path)
+            make(sub_path, level + 1)
+
+    make(directory, 0)
+    return totals
+
+
+def time_repeat(func, repeat, setup=None):
+    """Time func repeat times, calling setup before each one untimed."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times)}
+
+
+def walk_tree(directory):
+    """Walk a tree the way run does."""
+    for _ in rotten_bites.walk_dir(directory):
+        pass
+
+
+def rehash_tree(directory, algorithm):
+    """Hash every file in a tree."""
+    for path, files in rotten_bites.walk_dir(directory):
+        for name in files:
+            if name != rotten_bites.CHECK_FILE:
+                rotten_bites.File(name, path, 0, algorithm=algorithm)
+
+
+def index_io(directory, index_format):
+    """Read every .bit_check file in a tree and save it again."""
+    for path, files in rotten_bites.walk_dir(directory):
+        if rotten_bites.CHECK_FILE in files:
+            rotten_bites.save_bitcheck(path, rotten_bites.read_bitcheck(path),
+                                       index_format)
+
+
+def bench_shape(shape, scale, repeat, options):
+    """Run every benchmark on one shape of tree."""
+    with tempfile.TemporaryDirectory() as directory:
+        tree = make_shape(directory, shape, scale)
+
+        def clean():
+            rotten_bites.delete_check_files(directory)
+
+        timings = {
+            'walk_dir': time_repeat(lambda: walk_tree(directory), repeat),
+            'rehash': time_repeat(
+                lambda: rehash_tree(directory, options['algorithm']), repeat),
+            'run_new': time_repeat(
+                lambda: rotten_bites.run(directory, **options), repeat,
+                setup=clean),
+            'run_verify': time_repeat(
+                lambda: rotten_bites.run(directory, **options), repeat),
+        }
+
+        for index_format in rotten_bites.INDEX_FORMATS:
+            timings['index_' + index_format] = time_repeat(
+                lambda: index_io(directory, index_format), repeat)
+
+    # Throughput makes different scales a little easier to compare
+    for timing in timings.values():
+        seconds = timing['min'] or float('inf')
+        timing['files_per_sec'] = tree['files'] / seconds
+        timing['bytes_per_sec'] = tree['bytes'] / seconds
+
+    return {'tree': tree, 'timings': timings}
+
+
+@click.group()
+def main():
+    """Run Rotten Bites benchmarks."""
+
+
+@main.command()
+@click.option('--dirs', default=4, help='Sub-directories per directory.')
+@click.option('--files', default=50, help='Files per directory.')
+@click.option('--depth', default=4, help='How deep the tree goes.')
+@click.option('--repeat', default=5, help='Number of times to walk.')
+def walk(dirs, files, depth, repeat):
+    """Compare os.walk + stat with scan_dir."""
+    with tempfile.TemporaryDirectory() as directory:
+        make_tree(directory, dirs, files, depth)
+
+        for name, func in (('os.walk', old_walk), ('scan_dir', new_walk)):
+            calls = count_calls(func, directory)
+            seconds = time_walk(func, directory, repeat)
+            click.echo('{:10} {:.3f}s  {}'.format(
+                name, seconds,
+                ', '.join('{} {}'.format(k, v)
+                          for k, v in sorted(calls.items()))))
+
+
+@main.command()
+@click.option('--shape', 'shapes', multiple=True,
+              type=click.Choice(sorted(SHAPES)),
+              help='Shapes of tree to benchmark (all by default).')
+@click.option('--scale', default=1.0,
+              help='Multiply the number of files in every tree by this.')
+@click.option('--repeat', default=3, help='Number of times to time each.')
+@click.option('-j', '--jobs', default=rotten_bites.DEFAULT_WORKERS,
+              help='Workers for run.')
+@click.option('--hash', 'algorithm', default=rotten_bites.DEFAULT_ALGORITHM,
+              type=click.Choice(sorted(rotten_bites.HASH_ALGORITHMS)))
+@click.option('--io-mode', default=rotten_bites.DEFAULT_IO_MODE,
+              type=click.Choice(rotten_bites.IO_MODES))
+@click.option('--small-files', default=0,
+              help='small_file_size for run (0 for none).')
+@click.option('-o', '--output', type=click.File('w'), default='-',
+              help='Where to write the JSON results.')
+def suite(shapes, scale, repeat, jobs, algorithm, io_mode, small_files,
+          output):
+    """
+    Time walking, hashing, .bit_check files and run on synthetic trees.
+
+    The JSON can be compared with the compare command.
+    """
+    options = {'workers': jobs, 'algorithm': algorithm, 'io_mode': io_mode,
+               'small_file_size': small_files}
+    results = {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'scale': scale,
+        'repeat': repeat,
+        'options': options,
+        'shapes': {},
+    }
+
+    for shape in shapes or sorted(SHAPES):
+        click.echo('Benchmarking {}...'.format(shape), err=True)
+        results['shapes'][shape] = bench_shape(shape, scale, repeat, options)
+
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+@main.command()
+@click.argument('old', type=click.File('r'))
+@click.argument('new', type=click.File('r'))
+@click.option('--threshold', default=10.0,
+              help='Percent slower that counts as a regression.')
+def compare(old, new, threshold):
+    """Compare two suite results, failing if anything got slower."""
+    old, new = json.load(old), json.load(new)
+    regressions = 0
+
+    for shape, result in sorted(new['shapes'].items()):
+        if shape not in old['shapes']:
+            continue
+
+        for name, timing in sorted(result['timings'].items()):
+            before = old['shapes'][shape]['timings'].get(name)
+            if before is None:
+                continue
+
+            change = (timing['min'] / before['min'] - 1) * 100
+            slower = change > threshold
+            regressions += slower
+            click.echo('{:6} {:12} {:9.4f}s {:9.4f}s {:+7.1f}%{}'.format(
+                shape, name, before['min'], timing['min'], change,
+                '  REGRESSION' if slower else ''))
+
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
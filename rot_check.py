@@ -42,50 +42,34 @@ def duration_human(raw_seconds):
 def main(directory, to, from_, domain, api_key):
     added_files = []
     update_files = []
-    nothing_files = []
+    nothing_files = 0
     missing_files = []
     hash_error_files = []
     file_error_files = []
 
-    def added_cb(file):
-        """Print when file is added."""
-        nonlocal added_files
-        added_files.append(file)
-
-    def updated_cb(file):
-        """Print when file is updated."""
-        nonlocal update_files
-        update_files.append(file)
-
-    def nothing_cb(file):
-        """Print when nothing happens to a file."""
-        nonlocal nothing_files
-        nothing_files.append(file)
-
-    def file_error_cb(path, file, error):
-        """Print when file has an error."""
-        file_error_files.append((path, file, error))
-
-    def hash_error_cb(old_file, new_file):
-        """Print when file has an hash error."""
-        hash_error_files.append((old_file, new_file))
-
-    def missing_cb(file):
-        """Print when file is missing."""
-        nonlocal missing_files
-        missing_files += 1
-
+    # Unchanged files are only counted, so they aren't kept around
     now = time.time()
-    rotten_bites.run(directory, added_cb=added_cb, updated_cb=updated_cb,
-                     nothing_cb=nothing_cb, file_error_cb=file_error_cb,
-                     hash_error_cb=hash_error_cb, missing_cb=missing_cb)
+    for event in rotten_bites.scan(directory):
+        if event.kind == 'added':
+            added_files.append(event.file)
+        elif event.kind == 'updated':
+            update_files.append(event.file)
+        elif event.kind == 'nothing':
+            nothing_files += 1
+        elif event.kind == 'missing':
+            missing_files.append(event.file)
+        elif event.kind == 'error':
+            hash_error_files.append(event.old_file)
+        elif event.kind == 'file_error':
+            file_error_files.append(event)
+
     run_time = time.time() - now
 
     # Send email
     text = io.StringIO()
     text.write('Ran for {}.\n'.format(duration_human(run_time)))
     text.write('{} files scanned, {} new, {} updated, {} missing, {} errors.\n'.format(
-               len(added_files) + len(update_files) + len(nothing_files) + len(hash_error_files),
+               len(added_files) + len(update_files) + nothing_files + len(hash_error_files),
                len(added_files), len(update_files), len(missing_files), len(hash_error_files)))
     text.write('\n\n')
 
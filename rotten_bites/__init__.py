@@ -1,20 +1,92 @@
 """Utility for detecting if bit rot in files."""
+import array
+import asyncio
+import bisect
+import ctypes
+import ctypes.util
 import errno
 import hashlib
+import heapq
+import itertools
+import json
+import mmap
 import os
 import os.path
+import queue
+import select
+import shutil
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter, deque, namedtuple
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from json import JSONDecodeError
 
 try:
-    import json
-    from json.decoder import JSONDecodeError  # 3.5
+    from asyncio import get_running_loop
 except ImportError:  # pragma: no cover
-    JSONDecodeError = ValueError  # 3.4
+    from asyncio import get_event_loop as get_running_loop  # 3.5 and 3.6
 
 import pathspec
 
+try:
+    import xxhash
+except ImportError:  # pragma: no cover
+    xxhash = None
+
+try:
+    import crc32c
+except ImportError:  # pragma: no cover
+    crc32c = None
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
 DEFAULT_CHUNK_SIZE = 16384
+DEFAULT_IO_MODE = 'buffered'
+IO_MODES = ('buffered', 'readinto', 'mmap')
+DEFAULT_ALGORITHM = 'sha1'
+DEFAULT_WORKERS = 1
+DEFAULT_SCRUB_PERIOD = 30 * 24 * 60 * 60
+MAX_BACKOFF = 16
 CHECK_FILE = ".bit_check"
+BLOCKS_FILE = ".blocks.bit_check"
+DEFAULT_BLOCK_SIZE = 64 * 1024 * 1024
+PREAD_SIZE = 1024 * 1024
+TREE_PREFIX = 'tree-'
+INFO_FIELDS = ('size', 'inode', 'verified')
+INDEX_FORMATS = ('json', 'binary')
+DEFAULT_INDEX_FORMAT = 'json'
+DEFAULT_WRITE_BATCH = 64
+EVENT_KINDS = ('added', 'updated', 'nothing', 'error', 'missing',
+               'file_error', 'moved')
+DEFAULT_EVENT_BUFFER = 1024
+CHECKPOINT_FILE = '.resume.bit_check'
+DEFAULT_CHECKPOINT_INTERVAL = 60
+JOURNAL_FILE = '.journal.bit_check'
+WATCHER_FILE = '.watcher.bit_check'
+ROLLING_FILE = '.rolling.bit_check'
+DEFAULT_WATCH_INTERVAL = 1
+METRICS_FORMATS = ('json', 'prometheus')
+DEFAULT_METRICS_FORMAT = 'json'
+DEFAULT_PROGRESS_INTERVAL = 0.5
+SMALL_FILE_BATCH = 64
+DEFAULT_SORT_RUN = 1000000
+BINARY_MAGIC = b'RBIX'
+BINARY_VERSION = 1
+BINARY_NONE = 2 ** 64 - 1
+
+# magic, version, digest width, records, algorithms length, names length
+BINARY_HEADER = struct.Struct('<4sHHIII')
 
 
 class Result(Enum):
@@ -26,220 +98,3541 @@ class Result(Enum):
     error = 3
 
 
+class Duplicate(namedtuple('Duplicate', ('size', 'algorithm', 'hash',
+                                         'paths', 'reclaimable'))):
+    """
+    A set of files with the same contents, found by find_duplicates.
+
+    reclaimable is how many bytes would be freed by keeping just one copy.
+    Files that are hard links to each other only count once.
+    """
+
+    __slots__ = ()
+
+
+class Event(namedtuple('Event', ('kind', 'path', 'name', 'file', 'old_file',
+                                 'error'))):
+    """
+    Something that happened to a file during scan.
+
+    kind is one of EVENT_KINDS. file is the File that was added, updated,
+    checked or went missing, or the newly hashed File for an error, with the
+    stored one in old_file. For a move, file is where it is now and old_file
+    is where it was. For a file_error there's no File, just the exception in
+    error.
+    """
+
+    __slots__ = ()
+
+
+class CRC32C():
+    """Give the crc32c module the same interface as hashlib."""
+
+    def __init__(self):
+        """Start a new checksum."""
+        self.value = 0
+
+    def update(self, data):
+        """Add data to the checksum."""
+        self.value = crc32c.crc32c(data, self.value)
+
+    def digest(self):
+        """Return the checksum as bytes."""
+        return struct.pack('>I', self.value)
+
+    def hexdigest(self):
+        """Return the checksum as a hex string."""
+        return '{:08x}'.format(self.value)
+
+
+def create_hash_algorithms():
+    """
+    Find all of the hash algorithms that can be used.
+
+    sha1 is always available because that is what older .bit_check files use.
+    The fast non-cryptographic hashes are only available when their modules
+    are installed.
+    """
+    algorithms = {
+        'sha1': hashlib.sha1,
+        'sha256': hashlib.sha256,
+    }
+
+    if hasattr(hashlib, 'blake2b'):
+        algorithms['blake2b'] = hashlib.blake2b
+
+    if xxhash is not None:
+        algorithms['xxh64'] = xxhash.xxh64
+
+    if crc32c is not None:
+        algorithms['crc32c'] = CRC32C
+
+    return algorithms
+
+
+HASH_ALGORITHMS = create_hash_algorithms()
+
+
+def tree_algorithm(algorithm, block_size):
+    """Name the tree hash of algorithm with blocks of block_size bytes."""
+    return '{}{}-{}'.format(TREE_PREFIX, block_size, algorithm)
+
+
+def parse_tree_algorithm(algorithm):
+    """
+    Split the name of a tree hash into its algorithm and block size.
+
+    Returns None for algorithms that aren't tree hashes.
+    """
+    if not algorithm.startswith(TREE_PREFIX):
+        return None
+
+    try:
+        block_size, base = algorithm[len(TREE_PREFIX):].split('-', 1)
+        block_size = int(block_size)
+    except ValueError:
+        raise ValueError("Unknown hash algorithm: {}".format(algorithm))
+    if block_size < 1 or base not in HASH_ALGORITHMS:
+        raise ValueError("Unknown hash algorithm: {}".format(algorithm))
+    return base, block_size
+
+
+class TreeHash():
+    """
+    Give tree hashes the same interface as hashlib.
+
+    A tree hash is the root of a Merkle tree of the digests of each block of
+    the file (see Blocks). Unlike a normal hash, the blocks can be hashed at
+    the same time (see hash_blocks). A file of at most one block has the same
+    hash as it would with just the algorithm.
+    """
+
+    def __init__(self, algorithm, block_size):
+        """Start a new tree hash."""
+        self.blocks = Blocks(algorithm, block_size)
+
+    def update(self, data):
+        """Add data to the hash."""
+        self.blocks.update(data)
+
+    def digest(self):
+        """Finish the hash, returning it as bytes."""
+        return bytes.fromhex(self.hexdigest())
+
+    def hexdigest(self):
+        """Finish the hash, returning it as a hex string."""
+        return self.blocks.finish().root
+
+
+def get_hash(algorithm=DEFAULT_ALGORITHM):
+    """
+    Create a new hash object for the given algorithm.
+
+    Tree hashes (see tree_algorithm) are also understood.
+    """
+    tree = parse_tree_algorithm(algorithm)
+    if tree is not None:
+        return TreeHash(*tree)
+
+    try:
+        return HASH_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError("Unknown hash algorithm: {}".format(algorithm))
+
+
+def advise(file, advice):
+    """
+    Tell the kernel how a file is going to be read, if it will listen.
+
+    file is a file object or a file descriptor. This is only a hint, so any
+    failure is ignored.
+    """
+    if not hasattr(os, 'posix_fadvise'):  # pragma: no cover
+        return
+
+    try:
+        os.posix_fadvise(file if isinstance(file, int) else file.fileno(),
+                         0, 0, advice)
+    except (OSError, ValueError):  # pragma: no cover
+        pass
+
+
+def read_buffered(file, chunk_size):
+    """Read a file in chunks, creating a new bytes object for each one."""
+    data = file.read(chunk_size)
+    while data:
+        yield data
+        data = file.read(chunk_size)
+
+
+def read_into(file, chunk_size):
+    """
+    Read a file in chunks, reusing the same buffer for every chunk.
+
+    Each chunk is only valid until the next one is read.
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+
+    size = file.readinto(buffer)
+    while size:
+        yield view[:size]
+        size = file.readinto(buffer)
+
+
+def read_mmap(file, chunk_size):
+    """
+    Read a file in chunks straight out of a memory map.
+
+    Empty files can't be mapped, so they are read normally.
+    """
+    try:
+        memory = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        yield from read_into(file, chunk_size)
+        return
+
+    with memory:
+        if hasattr(memory, 'madvise'):  # 3.8
+            memory.madvise(mmap.MADV_SEQUENTIAL)
+
+        # Every view into the map has to be released before it can be closed
+        with memoryview(memory) as view:
+            for start in range(0, len(memory), chunk_size):
+                with view[start:start + chunk_size] as chunk:
+                    yield chunk
+
+
+def read_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE, io_mode=DEFAULT_IO_MODE):
+    """
+    Read a file in chunks using one of the I/O modes.
+
+    buffered reads through a normal file object, the way rotten bites always
+    has. readinto and mmap avoid allocating a new object for every chunk and
+    tell the kernel to drop the file from the page cache once it is read, so
+    a scan doesn't push out everything else that is cached.
+    """
+    if io_mode == 'buffered':
+        with open(path, 'rb') as file:
+            yield from read_buffered(file, chunk_size)
+        return
+
+    if io_mode not in IO_MODES:
+        raise ValueError("Unknown I/O mode: {}".format(io_mode))
+
+    reader = read_mmap if io_mode == 'mmap' else read_into
+
+    with open(path, 'rb', buffering=0) as file:
+        if hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+            advise(file, os.POSIX_FADV_SEQUENTIAL)
+
+        yield from reader(file, chunk_size)
+
+        if hasattr(os, 'POSIX_FADV_DONTNEED'):
+            advise(file, os.POSIX_FADV_DONTNEED)
+
+
+class Throttle():
+    """
+    Slow down reading so a scan doesn't starve everything else on the disk.
+
+    One Throttle is shared by every worker. Reads are limited to
+    max_bytes_per_sec and max_iops (reads per second). If max_latency is set
+    and reads start taking longer than that on average, which usually means
+    the disk is busy with other work, each read also waits a multiple of the
+    read time. The multiple doubles while reads are slow and halves once they
+    are fast again.
+    """
+
+    def __init__(self, max_bytes_per_sec=None, max_iops=None,
+                 max_latency=None):
+        """Set the limits."""
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.max_iops = max_iops
+        self.max_latency = max_latency
+        self.latency = 0
+        self.backoff = 0
+        self.next_read = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self, size, latency):
+        """Wait after a read of size bytes that took latency seconds."""
+        delay = 0
+        if self.max_bytes_per_sec:
+            delay = size / self.max_bytes_per_sec
+        if self.max_iops:
+            delay = max(delay, 1 / self.max_iops)
+
+        with self.lock:
+            if self.max_latency is not None:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+                if self.latency > self.max_latency:
+                    self.backoff = min(max(self.backoff * 2, 1), MAX_BACKOFF)
+                else:
+                    self.backoff //= 2
+                delay += self.backoff * latency
+
+            now = time.monotonic()
+            self.next_read = max(self.next_read, now) + delay
+            sleep = self.next_read - now - delay
+
+        # Each reader waits for the ones that reserved time before it
+        if sleep > 0:
+            time.sleep(sleep)
+
+    def wrap(self, chunks):
+        """Throttle reading from a chunk generator."""
+        chunks = iter(chunks)
+        while True:
+            start = time.monotonic()
+            try:
+                data = next(chunks)
+            except StopIteration:
+                return
+
+            self.wait(len(data), time.monotonic() - start)
+            yield data
+
+
+def lower_priority():
+    """
+    Run this process at the lowest CPU and I/O priority.
+
+    The I/O priority uses the ionice command, which is only on Linux. Threads
+    take on the priority of the thread that starts them, so this should be
+    called before any are started.
+    """
+    if hasattr(os, 'nice'):
+        os.nice(19)
+
+    ionice = shutil.which('ionice')
+    if ionice is not None:
+        subprocess.call([ionice, '-c', '3', '-p', str(os.getpid())],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def to_digest(value):
+    """
+    Convert a hex hash to raw bytes, which take less than half the space.
+
+    Anything that doesn't convert back to exactly the same string is left
+    alone.
+    """
+    if isinstance(value, str):
+        try:
+            digest = bytes.fromhex(value)
+        except ValueError:
+            return value
+        if digest.hex() == value:
+            return digest
+    return value
+
+
 class File():
     """
     Represents everything that I care about in a file.
 
     The only things I care about are the name, path, when the file was modified
-    and the hash value of the file.
+    and the hash value of the file (along with which algorithm made it). The
+    size and inode are also kept when they are known, so that unchanged files
+    can be spotted without hashing them, as well as when the hash was last
+    verified.
+
+    There can be millions of these, so they use __slots__, share the path
+    string of their directory and keep the hash as raw bytes. hash still
+    reads and writes hex strings.
     """
 
-    def __init__(self, name, path, mtime, hash_value=None):
+    __slots__ = ('name', 'path', 'mtime', 'algorithm', 'size', 'inode',
+                 'verified', 'value')
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, path, mtime, hash_value=None,
+                 algorithm=DEFAULT_ALGORITHM, size=None, inode=None,
+                 verified=None, **options):
         """
         Create a file object.
 
-        If a hash value is not provided, it calculates the hash itself.
+        If a hash value is not provided, it calculates the hash itself. Any
+        other options are passed on to rehash.
         """
         self.name = name
-        self.path = path
+        self.path = sys.intern(path) if isinstance(path, str) else path
         self.mtime = mtime
-        self.hash = hash_value or self.rehash()
+        self.algorithm = algorithm
+        self.size = size
+        self.inode = inode
+        self.verified = verified
+        self.hash = hash_value or self.rehash(**options)
+
+    @property
+    def hash(self):
+        """The hash of the file as a hex string."""
+        value = self.value
+        return value.hex() if isinstance(value, bytes) else value
+
+    @hash.setter
+    def hash(self, value):
+        """Set the hash, from either a hex string or raw bytes."""
+        self.value = to_digest(value)
+
+    @property
+    def digest(self):
+        """The hash of the file as raw bytes, or None if it isn't hex."""
+        value = self.value
+        return value if isinstance(value, bytes) else None
 
     @staticmethod
     def from_json(path, obj):
-        """Convert json object to File objects."""
-        return {k: File(k, path, v[0], v[1]) for k, v in obj.items()}
+        """
+        Convert json object to File objects.
 
-    def rehash(self, chunk_size=DEFAULT_CHUNK_SIZE):
-        """Calculate the hash of this file."""
-        path = os.path.join(self.path, self.name)
-        digest = hashlib.sha1()
+        Entries without an algorithm were written before there was a choice,
+        so they are sha1.
+        """
+        def create(name, value):
+            """Create a File from a single entry."""
+            algorithm = value[2] if len(value) > 2 else DEFAULT_ALGORITHM
+            info = value[3] if len(value) > 3 else {}
+            return File(name, path, value[0], value[1], algorithm,
+                        *(info.get(field) for field in INFO_FIELDS))
 
-        with open(path, 'rb') as file:
-            data = file.read(chunk_size)
-            while data:
-                digest.update(data)
-                data = file.read(chunk_size)
+        return {k: create(k, v) for k, v in obj.items()}
+
+    def same_stat(self, stat):
+        """Check if a stat result matches what is known about this file."""
+        return (self.size is not None and self.inode is not None and
+                self.mtime == stat.st_mtime and self.size == stat.st_size and
+                self.inode == stat.st_ino)
+
+    def read(self, chunk_size=DEFAULT_CHUNK_SIZE, io_mode=DEFAULT_IO_MODE,
+             throttle=None):
+        """Read the file a chunk at a time (see read_chunks)."""
+        chunks = read_chunks(os.path.join(self.path, self.name), chunk_size,
+                             io_mode)
+        if throttle is not None:
+            chunks = throttle.wrap(chunks)
+        return chunks
+
+    def rehash(self, chunk_size=DEFAULT_CHUNK_SIZE, io_mode=DEFAULT_IO_MODE,
+               throttle=None, workers=1, executor=None):
+        """
+        Calculate the hash of this file.
+
+        Tree hashes are read workers blocks at a time, or on executor (see
+        hash_blocks).
+        """
+        tree = parse_tree_algorithm(self.algorithm)
+        if tree is not None and (workers > 1 or executor is not None):
+            return hash_blocks(os.path.join(self.path, self.name), *tree,
+                               workers=workers, throttle=throttle,
+                               executor=executor).root
+
+        digest = get_hash(self.algorithm)
+        for data in self.read(chunk_size, io_mode, throttle):
+            digest.update(data)
         return digest.hexdigest()
 
     def to_json(self):
-        """Convert File object to json."""
+        """
+        Convert File object to json.
+
+        The algorithm is left off for sha1 and the rest of the information is
+        left off when it isn't known, so that the files can still be read by
+        older versions.
+        """
+        info = {field: getattr(self, field) for field in INFO_FIELDS
+                if getattr(self, field) is not None}
+
+        if info:
+            return [self.mtime, self.hash, self.algorithm, info]
+        if self.algorithm != DEFAULT_ALGORITHM:
+            return [self.mtime, self.hash, self.algorithm]
         return [self.mtime, self.hash]
 
     def __repr__(self):  # pragma: no cover
         """String representation of File."""
-        return "<File name:{}, path:{}, mtime:{}, hash:{}".format(
-            self.name, self.path, self.mtime, self.hash)
+        return "<File name:{}, path:{}, mtime:{}, hash:{}:{}".format(
+            self.name, self.path, self.mtime, self.algorithm, self.hash)
 
 
-def walk_dir(directory, ignore=None, follow_links=False):
+class Blocks():
     """
-    My version of os.walk.
+    The digests of each block of a file, in a Merkle tree.
 
-    It takes care of ignoring files that should be ignored and produces a
-    generator.
+    A file's hash only says that something in it changed. Comparing the
+    digests of its blocks says where. The root of the tree (each pair of
+    digests hashed together, until there is only one) covers the whole file.
     """
-    for path, _, files in os.walk(directory, followlinks=follow_links):
 
-        if ignore is not None:
-            files = ignore.match_files(
-                (os.path.join(path, f) for f in files))
-            files = (os.path.basename(f) for f in files)
-            files = sorted(files)
+    def __init__(self, algorithm, block_size, digests=None):
+        """Start hashing blocks, or keep digests that were already made."""
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.digests = digests if digests is not None else []
+        self.current = None
+        self.filled = 0
 
-        yield path, files
+    def update(self, data):
+        """Hash more of the file."""
+        view = memoryview(data)
+        while view:
+            if self.current is None:
+                self.current = get_hash(self.algorithm)
+                self.filled = 0
 
+            take = min(len(view), self.block_size - self.filled)
+            self.current.update(view[:take])
+            self.filled += take
+            view = view[take:]
 
-def get_stat(follow_links=False):
-    """Return appropriate stat function."""
-    func = os.lstat if follow_links else os.stat
-    return func
+            if self.filled == self.block_size:
+                self.digests.append(self.current.digest())
+                self.current = None
 
+    def finish(self):
+        """Finish the last block, which is usually short."""
+        if self.current is not None:
+            self.digests.append(self.current.digest())
+            self.current = None
+        return self
 
-def walk_files(directory, files, follow_links=False):
-    """Walk through each file, stat-ing them."""
-    stat = get_stat(follow_links)
+    @property
+    def root(self):
+        """The root of the Merkle tree, as a hex string."""
+        level = self.digests or [get_hash(self.algorithm).digest()]
+        while len(level) > 1:
+            pairs = []
+            for i in range(0, len(level) - 1, 2):
+                digest = get_hash(self.algorithm)
+                digest.update(b'\x01' + level[i] + level[i + 1])
+                pairs.append(digest.digest())
+            if len(level) % 2:
+                pairs.append(level[-1])
+            level = pairs
+        return level[0].hex()
 
-    for file in files:
-        try:
-            stat_data = stat(os.path.join(directory, file))
-        except OSError as exception:
-            # For some reason we couldn't stat the file. I will look at why
-            # later.
-            yield file, None, exception
-            continue
+    def damaged(self, other, size=None):
+        """
+        Find the byte ranges where other is different.
 
-        yield file, stat_data, None
+        Returns a list of (start, end) ranges, with neighbouring blocks
+        joined together. size is the size of the file, to trim the last one.
+        """
+        if (self.algorithm, self.block_size) != \
+                (other.algorithm, other.block_size):
+            raise ValueError("Blocks of different sizes can't be compared")
+
+        ranges = []
+        count = max(len(self.digests), len(other.digests))
+        for i in range(count):
+            if i < len(self.digests) and i < len(other.digests) and \
+                    self.digests[i] == other.digests[i]:
+                continue
+
+            start = i * self.block_size
+            end = start + self.block_size
+            if size is not None:
+                end = min(end, size)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def verify(self, path, workers=DEFAULT_WORKERS):
+        """
+        Check a file against these blocks, workers blocks at a time.
+
+        Returns the damaged byte ranges (see damaged).
+        """
+        blocks = hash_blocks(path, self.algorithm, self.block_size, workers)
+        return blocks.damaged(self, os.path.getsize(path))
+
+    def to_json(self):
+        """Convert to json."""
+        return [self.algorithm, self.block_size,
+                [digest.hex() for digest in self.digests]]
+
+    @staticmethod
+    def from_json(obj):
+        """Convert json to Blocks."""
+        algorithm, block_size, digests = obj
+        return Blocks(algorithm, block_size,
+                      [bytes.fromhex(digest) for digest in digests])
+
+
+# pylint: disable=too-many-arguments
+def hash_block(descriptor, algorithm, start, size, chunk_size=PREAD_SIZE,
+               throttle=None):
+    """Hash size bytes of an open file from start, with os.pread."""
+    digest = get_hash(algorithm)
+    end = start + size
+    while start < end:
+        begin = time.monotonic()
+        data = os.pread(descriptor, min(chunk_size, end - start), start)
+        if throttle is not None:
+            throttle.wait(len(data), time.monotonic() - begin)
+        if not data:
+            break
+        digest.update(data)
+        start += len(data)
+    return digest.digest()
+
+
+def hash_blocks(path, algorithm, block_size, workers=DEFAULT_WORKERS,
+                throttle=None, executor=None):
+    """
+    Hash every block of a file, workers blocks at a time.
+
+    Each block is read with os.pread from its own offset, so any number of
+    them can be read at once, and a single huge file can keep every core and
+    the whole disk queue busy. throttle (a Throttle) is shared by all of
+    them. With executor, the blocks are hashed on it instead of on workers
+    threads of their own, so files hashed at the same time share them.
+    Returns Blocks.
+    """
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(descriptor).st_size
+        starts = range(0, size, block_size)
+
+        def block(start):
+            return hash_block(descriptor, algorithm, start, block_size,
+                              throttle=throttle)
+
+        if executor is not None:
+            digests = list(executor.map(block, starts))
+        elif workers <= 1:
+            digests = [block(start) for start in starts]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                digests = list(executor.map(block, starts))
+    finally:
+        os.close(descriptor)
+
+    return Blocks(algorithm, block_size, digests)
 
 
-def read_bitcheck(path):
-    """Read file that contains file hash information."""
+def read_blocks(path):
+    """Read the Blocks of the files in a directory, by name."""
     try:
-        with open(os.path.join(path, CHECK_FILE)) as file:
-            return json.load(
-                file, object_hook=lambda obj: File.from_json(path, obj))
-    except (FileNotFoundError, JSONDecodeError):
+        with open(os.path.join(path, BLOCKS_FILE)) as file:
+            data = json.load(file)
+    except FileNotFoundError:
         return {}
+    return {name: Blocks.from_json(value) for name, value in data.items()}
 
 
-def save_bitcheck(path, data):
-    """Save file that contains file hash information."""
-    with open(os.path.join(path, CHECK_FILE), 'w') as file:
-        json.dump(data, file, sort_keys=True, default=lambda x: x.to_json())
+def save_blocks(path, blocks):
+    """Save the Blocks of the files in a directory, atomically."""
+    file_path = os.path.join(path, BLOCKS_FILE)
+    if not blocks:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        return
 
+    temp = os.path.join(path, '.{}{}'.format(os.getpid(), BLOCKS_FILE))
+    with open(temp, 'w') as file:
+        json.dump({name: value.to_json() for name, value in blocks.items()},
+                  file)
+    os.replace(temp, file_path)
 
-def compare_files(old_file, new_file):
+
+class BlockFile(File):
     """
-    Determine how a two files have changed.
+    A File that also keeps Blocks, for files bigger than a block.
 
-    If there is no old version of a file, then the file was added.
-    If the hash of the old and new files match, then nothing has happened.
-    If the hash of the old and new files does not match, but the modified time
-    has changed, then the file has been updated.
-    If the hash of the old and new files does not match and the modified time
-    has not changed, then there is an error.
+    The blocks are hashed along with the whole file, in the same read. If the
+    hash doesn't match, damaged is set to the byte ranges that changed (when
+    the old Blocks are known).
     """
-    if old_file is None:
-        # Don't have a hash for this file, so it is new
-        return Result.added
 
-    if old_file.hash != new_file.hash:
-        if old_file.mtime == new_file.mtime:
-            return Result.error
-        else:
-            return Result.updated
+    __slots__ = ('blocks', 'damaged')
 
-    return Result.nothing
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, path, mtime, hash_value=None,
+                 algorithm=DEFAULT_ALGORITHM, size=None, inode=None,
+                 verified=None, block_size=DEFAULT_BLOCK_SIZE, **options):
+        """Create a file object, hashing each block_size bytes too."""
+        self.blocks = Blocks(algorithm, block_size)
+        self.damaged = None
+        super().__init__(name, path, mtime, hash_value, algorithm, size,
+                         inode, verified, **options)
 
+    def rehash(self, chunk_size=DEFAULT_CHUNK_SIZE, io_mode=DEFAULT_IO_MODE,
+               throttle=None, workers=1, executor=None):
+        """
+        Calculate the hash of this file and of each of its blocks.
+
+        Everything comes from one read, so workers and executor aren't used.
+        """
+        digest = get_hash(self.algorithm)
+        self.blocks = Blocks(self.algorithm, self.blocks.block_size)
+        for data in self.read(chunk_size, io_mode, throttle):
+            digest.update(data)
+            self.blocks.update(data)
+        self.blocks.finish()
+        return digest.hexdigest()
 
-def convert_ignore_list(lst):
-    """Convert an ignore list to an accept list."""
-    def create_ignore_list():
-        """Generator for creating ignore list."""
-        yield '*'  # Accept everything
-        yield '!*{}'.format(CHECK_FILE)  # Ignore my files
-
-        for line in lst:
-            if line[0] == '!':
-                yield line[1:]
-            else:
-                yield '!{}'.format(line)
 
-    return pathspec.PathSpec.from_lines('gitignore', create_ignore_list())
+def shard_of(relative, count):
+    """
+    Pick which of count shards a directory belongs to.
+
+    relative is the directory's path relative to the top of the tree, like
+    'a/b/' (see scan_dir), so every machine puts it in the same shard.
+    """
+    return zlib.crc32(relative.encode('utf-8', 'surrogateescape')) % count
 
 
 # pylint: disable=too-many-arguments
-def handle_error(error, path, file, old_file, file_error_cb, missing_cb):
-    """Deal with file error."""
-    # Check what kind of error it is
-    if error.errno == errno.EACCES:
-        # We don't have access to the file
-        file_error_cb(path, file, error)
-    elif error.errno == errno.ENOENT:
-        # The file was deleted
-        if old_file is not None:
-            missing_cb(old_file)
-    else:
-        # Don't know what else to do with it
-        raise error
+def scan_dir(directory, ignore=None, follow_links=False, after=None,
+             shard=None, only=None, skip=None, top=''):
+    """
+    Walk a directory tree with os.scandir.
 
+    Yields the path of each directory along with the os.DirEntry of every
+    file in it. Directories are visited top down in sorted order and files
+    are sorted by name, so a walk of the same tree is always the same.
 
-# pylint: disable=too-many-arguments,too-many-locals
-def run(directory, added_cb=lambda x: x, updated_cb=lambda x: x,
-        nothing_cb=lambda x: x, file_error_cb=lambda p, f, e: p,
-        hash_error_cb=lambda old, new: old, missing_cb=lambda x: x,
-        ignore=None, just_verify=False, dry_run=False):
-    """Run rotten bits, checking for bit errors."""
-    ignore = convert_ignore_list(ignore or [])
+    Like os.walk, symbolic links to directories are only followed when
+    follow_links is set and directories that can't be listed are skipped.
+    Unlike os.walk, the entries are handed back so that stat-ing them later
+    doesn't have to look up the path again.
 
-    for path, files in walk_dir(directory, ignore):
-        data = read_bitcheck(path)
+    ignore can be a PathSpec, which is matched against each file's path, or
+    an IgnoreMatcher, which also skips directories that are ignored.
 
-        for file, stat, error in walk_files(path, files):
-            old_file = data.get(file)
+    after is the path of a directory relative to directory, like 'a/b/' (or
+    '' for directory itself). Everything up to and including it in walk
+    order is skipped, without listing directories that can't lead past it.
 
-            # Check if any errors occurred while walking the file
-            if error:
-                handle_error(error, path, file, old_file, file_error_cb,
-                             missing_cb)
-                continue
+    shard is (index, count). Only directories in that shard are yielded (see
+    shard_of), although every directory still has to be listed.
+
+    only is a set of relative paths of directories, like after. Only those
+    are yielded, and only the directories on the way to them are listed.
+    The directories in skip (also relative paths) aren't yielded, although
+    the directories in them still are.
+
+    top is a relative path too. Only the directories under it are walked,
+    but ignore is still matched against paths relative to directory.
+    """
+    after = None if after is None else after.split('/')[:-1]
+    if only is not None:
+        on_the_way = set()
+        for relative in only:
+            parts = relative.split('/')[:-1]
+            on_the_way.update(''.join(part + '/' for part in parts[:i])
+                              for i in range(len(parts) + 1))
+    matcher = ignore if isinstance(ignore, IgnoreMatcher) else None
+    state = matcher.match_dir('', '') if matcher else None
+    parts = top.split('/')[:-1]
+    for i, name in enumerate(parts):
+        if state is None:
+            break
+        state = matcher.match_dir(name, '/'.join(parts[:i + 1]), state)
+    start = os.path.join(directory, *parts) if parts else directory
+    directories = [] if matcher and state is None else [(start, top, state)]
+
+    while directories:
+        path, relative, state = directories.pop()
 
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            # The directory was deleted or can't be read
+            continue
+
+        subdirectories = []
+        files = []
+
+        for entry in entries:
             try:
-                new_file = File(file, path, stat.st_mtime)
-            except FileNotFoundError:
-                # The file was deleted between when the file list was created
-                # and now
-                if old_file is not None:
-                    # We only care about this if the old file existed
-                    missing_cb(old_file)
-                continue
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
 
-            result = compare_files(old_file, new_file)
+            if not is_dir:
+                files.append(entry)
+            elif follow_links or not entry.is_symlink():
+                subdirectories.append(entry.name)
 
-            if result == Result.updated and not just_verify:
-                old_file.mtime = new_file.mtime
-                old_file.hash = new_file.hash
-                updated_cb(old_file)
+        if matcher is not None:
+            files = [entry for entry in files if matcher.match_file(
+                entry.name, relative + entry.name, state)]
+        elif ignore is not None:
+            keep = set(ignore.match_files(entry.path for entry in files))
+            files = [entry for entry in files if entry.path in keep]
 
-            elif result == Result.added and not just_verify:
-                data[file] = new_file
-                added_cb(new_file)
+        files.sort(key=lambda entry: entry.name)
+        if (after is None or relative.split('/')[:-1] > after) and \
+                (shard is None or shard_of(relative, shard[1]) == shard[0]) \
+                and (only is None or relative in only) and \
+                (skip is None or relative not in skip):
+            yield path, files
 
-            elif result == Result.nothing:
-                nothing_cb(old_file)
+        for name in sorted(subdirectories, reverse=True):
+            if only is not None and relative + name + '/' not in on_the_way:
+                continue
 
-            elif result == Result.error:
-                hash_error_cb(old_file, new_file)
+            if after is not None:
+                parts = (relative + name).split('/')
+                if parts < after and parts != after[:len(parts)]:
+                    # Nothing below this was left
+                    continue
 
-        for missing in set(data.keys()) - set(files):
-            missing_cb(data.pop(missing))
+            sub_state = None
+            if matcher is not None:
+                sub_state = matcher.match_dir(name, relative + name, state)
+                if sub_state is None:
+                    continue
 
-        if not dry_run:
-            save_bitcheck(path, data)
+            directories.append((os.path.join(path, name),
+                                relative + name + '/', sub_state))
 
 
-def delete_check_files(directory):
-    """Delete all metafiles for Rotten Bites."""
-    for path, files in walk_dir(directory):
-        if CHECK_FILE in files:
-            os.remove(os.path.join(path, CHECK_FILE))
+def walk_dir(directory, ignore=None, follow_links=False):
+    """
+    My version of os.walk.
+
+    It takes care of ignoring files that should be ignored and produces a
+    generator.
+    """
+    for path, entries in scan_dir(directory, ignore, follow_links):
+        yield path, [entry.name for entry in entries]
+
+
+def get_stat(follow_links=False):
+    """Return appropriate stat function."""
+    func = os.lstat if follow_links else os.stat
+    return func
+
+
+def walk_files(directory, files, follow_links=False):
+    """Walk through each file, stat-ing them."""
+    stat = get_stat(follow_links)
+
+    for file in files:
+        try:
+            stat_data = stat(os.path.join(directory, file))
+        except OSError as exception:
+            # For some reason we couldn't stat the file. I will look at why
+            # later.
+            yield file, None, exception
+            continue
+
+        yield file, stat_data, None
+
+
+def stat_entry(entry, follow_links=False):
+    """Stat a directory entry the same way get_stat would stat its path."""
+    return entry.stat(follow_symlinks=not follow_links)
+
+
+def stat_entries(entries, follow_links=False):
+    """
+    Walk through each directory entry, stat-ing them.
+
+    The same as walk_files, but os.scandir has already found the paths and
+    may have already cached the stat results.
+    """
+    for entry in entries:
+        try:
+            stat_data = stat_entry(entry, follow_links)
+        except OSError as exception:
+            yield entry.name, None, exception
+            continue
+
+        yield entry.name, stat_data, None
+
+
+def binary_record(width):
+    """
+    Create the struct for a record with digests of up to width bytes.
+
+    name offset, name length, mtime, size, inode, verified, algorithm,
+    digest length, digest. Unknown sizes, inodes and verified times are
+    BINARY_NONE.
+    """
+    return struct.Struct('<QIdQQQBB{}s'.format(width))
+
+
+class LazyIndex(MutableMapping):
+    """
+    The files of a directory, only turned into File objects when needed.
+
+    Looking up a file creates a new File every time, and it is thrown away
+    once it is no longer used, so a directory with millions of files never
+    has them all in memory at once. That also means changes made to a File
+    only stick once it is put back with index[name] = file. Those changes,
+    and removed files, are kept on top of the stored files.
+
+    Subclasses store the files, and provide find, create and stored_names.
+    """
+
+    def __init__(self, path):
+        """Start without any changes."""
+        self.path = path
+        self.changed = {}
+        self.removed = set()
+
+    def find(self, name):
+        """Find a stored file, returning how it is stored or None."""
+        raise NotImplementedError
+
+    def create(self, name, record):
+        """Turn what find returned into a File."""
+        raise NotImplementedError
+
+    def stored_names(self):
+        """All of the names of the stored files, in order."""
+        raise NotImplementedError
+
+    def __getitem__(self, name):
+        """Find a file."""
+        if name in self.changed:
+            return self.changed[name]
+
+        record = None if name in self.removed else self.find(name)
+        if record is None:
+            raise KeyError(name)
+        return self.create(name, record)
+
+    def __setitem__(self, name, file):
+        """Add, replace or update a file."""
+        self.removed.discard(name)
+        self.changed[name] = file
+
+    def __delitem__(self, name):
+        """Remove a file."""
+        self[name]  # pylint: disable=pointless-statement
+        self.changed.pop(name, None)
+        self.removed.add(name)
+
+    def __iter__(self):
+        """Iterate over the names of all of the files."""
+        for name in self.stored_names():
+            if name not in self.removed:
+                yield name
+
+        for name in self.changed:
+            if self.find(name) is None:
+                yield name
+
+    def __len__(self):
+        """Count the files."""
+        return sum(1 for _ in self)
+
+
+class BinaryIndex(LazyIndex):
+    """
+    The files of a directory, read lazily from the binary index format.
+
+    The binary format is:
+
+        header      magic, version, digest width, number of records and the
+                    lengths of the next sections (see BINARY_HEADER)
+
+        algorithms  names of the hash algorithms used, separated by newlines
+
+        records     one fixed width record per file, sorted by name (see
+                    binary_record)
+
+        names       all of the file names, as UTF-8, one after the other
+
+    Nothing is parsed up front. Looking up a file is a binary search over the
+    records.
+    """
+
+    def __init__(self, path, buffer):
+        """Check the header of a binary index."""
+        super().__init__(path)
+        (magic, version, width, self.count, algorithms_length,
+         names_length) = BINARY_HEADER.unpack_from(buffer)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError("Not a binary index")
+
+        self.buffer = buffer
+        self.record = binary_record(width)
+
+        start = BINARY_HEADER.size + algorithms_length
+        self.algorithms = buffer[BINARY_HEADER.size:start].decode().split()
+        self.records = start
+        self.names = start + self.record.size * self.count
+        if self.names + names_length != len(buffer):
+            raise ValueError("Truncated binary index")
+
+    def unpack(self, index):
+        """Unpack a record and its name."""
+        record = self.record.unpack_from(
+            self.buffer, self.records + index * self.record.size)
+        start = self.names + record[0]
+        return self.buffer[start:start + record[1]], record
+
+    def find(self, name):
+        """Binary search for a name, returning its record or None."""
+        key = os.fsencode(name)
+        low, high = 0, self.count
+
+        while low < high:
+            middle = (low + high) // 2
+            found, record = self.unpack(middle)
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return record
+        return None
+
+    def create(self, name, record):
+        """Turn a record into a File."""
+        (_, _, mtime, size, inode, verified, algorithm, length,
+         digest) = record
+        return File(name, self.path, mtime, digest[:length],
+                    self.algorithms[algorithm],
+                    *(None if value == BINARY_NONE else value
+                      for value in (size, inode, verified)))
+
+    def stored_names(self):
+        """All of the names in the index itself, in order."""
+        for index in range(self.count):
+            yield os.fsdecode(self.unpack(index)[0])
+
+
+class ColumnarIndex(LazyIndex):
+    """
+    The files of a directory, stored a column per attribute.
+
+    Names are kept in a sorted list, and everything else in arrays of plain
+    numbers, with all of the digests in one bytes object. A file takes a few
+    dozen bytes instead of a few hundred as a File. This only works if every
+    hash is hex, which is always the case for hashes rotten bites made.
+    """
+
+    def __init__(self, path, files):
+        """Store the columns for some Files."""
+        super().__init__(path)
+        files = sorted(files, key=lambda file: file.name)
+        digests = [file.digest for file in files]
+        if None in digests:
+            raise ValueError("Only hex digests can be stored in columns")
+
+        self.algorithms = sorted(set(file.algorithm for file in files))
+        algorithm_ids = {name: i for i, name in enumerate(self.algorithms)}
+        self.width = max((len(digest) for digest in digests), default=0)
+
+        self.names = [file.name for file in files]
+        self.mtimes = array.array('d', (file.mtime for file in files))
+        self.info = [array.array('Q', (BINARY_NONE if value is None
+                                       else value for value in
+                                       (getattr(file, field)
+                                        for file in files)))
+                     for field in INFO_FIELDS]
+        self.algorithm_ids = bytes(algorithm_ids[file.algorithm]
+                                   for file in files)
+        self.lengths = bytes(len(digest) for digest in digests)
+        self.digests = b''.join(digest.ljust(self.width, b'\0')
+                                for digest in digests)
+
+    def find(self, name):
+        """Binary search for a name, returning its position or None."""
+        index = bisect.bisect_left(self.names, name)
+        if index < len(self.names) and self.names[index] == name:
+            return index
+        return None
+
+    def create(self, name, record):
+        """Turn a position into a File."""
+        start = record * self.width
+        return File(name, self.path, self.mtimes[record],
+                    self.digests[start:start + self.lengths[record]],
+                    self.algorithms[self.algorithm_ids[record]],
+                    *(None if column[record] == BINARY_NONE
+                      else column[record] for column in self.info))
+
+    def stored_names(self):
+        """All of the names in order."""
+        return iter(self.names)
+
+
+def dump_binary(data):
+    """Convert a directory's files to the binary index format."""
+    files = sorted((os.fsencode(name), file) for name, file in data.items())
+    algorithms = sorted(set(file.algorithm for _, file in files))
+    algorithm_ids = {name: i for i, name in enumerate(algorithms)}
+
+    digests = [file.digest for _, file in files]
+    if None in digests:
+        raise ValueError("Only hex digests can be stored in a binary index")
+
+    width = max((len(digest) for digest in digests), default=0)
+    record = binary_record(width)
+    algorithms = '\n'.join(algorithms).encode()
+
+    records = []
+    offset = 0
+    for (name, file), digest in zip(files, digests):
+        records.append(record.pack(
+            offset, len(name), file.mtime,
+            *[BINARY_NONE if value is None else value
+              for value in (file.size, file.inode, file.verified)],
+            algorithm_ids[file.algorithm], len(digest), digest))
+        offset += len(name)
+
+    return b''.join([BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, width,
+                                        len(files), len(algorithms), offset),
+                     algorithms] + records + [name for name, _ in files])
+
+
+def read_bitcheck(path, columnar=False):
+    """
+    Read file that contains file hash information.
+
+    Both the JSON and binary formats can be read. Which one a file is in is
+    worked out from its first few bytes. JSON files become a dict, unless
+    columnar is set, in which case they become a ColumnarIndex to save
+    memory. Binary files are always read lazily (see BinaryIndex).
+    """
+    try:
+        with open(os.path.join(path, CHECK_FILE), 'rb') as file:
+            contents = file.read()
+    except FileNotFoundError:
+        return {}
+
+    try:
+        if contents.startswith(BINARY_MAGIC):
+            return BinaryIndex(path, contents)
+        data = File.from_json(path, json.loads(contents.decode()))
+    except (JSONDecodeError, UnicodeDecodeError, ValueError, struct.error):
+        return {}
+
+    if columnar:
+        try:
+            return ColumnarIndex(path, data.values())
+        except ValueError:
+            pass
+    return data
+
+
+def dump_bitcheck(data, index_format=DEFAULT_INDEX_FORMAT):
+    """Convert a directory's files to the contents of a .bit_check file."""
+    if index_format == 'binary':
+        return dump_binary(data)
+
+    return json.dumps(dict(data), sort_keys=True,
+                      default=lambda x: x.to_json()).encode()
+
+
+def sync_directory(path):
+    """Make sure a rename in a directory has made it to disk."""
+    try:
+        descriptor = os.open(path, os.O_RDONLY)
+    except OSError:  # pragma: no cover
+        # Not every platform can open a directory
+        return
+
+    try:
+        os.fsync(descriptor)
+    except OSError:  # pragma: no cover
+        pass
+    finally:
+        os.close(descriptor)
+
+
+class CheckFileWriter():
+    """
+    Read and write .bit_check files, writing them safely a batch at a time.
+
+    This is the default store for run. A store is anything with:
+
+        read(path, columnar)    return the files of a directory, as a dict or
+                                a LazyIndex
+
+        save(path, data)        store the files of a directory (this can be
+                                delayed until flush)
+
+        needs_rewrite(data)     check if what read returned should be saved
+                                even if nothing in it changed
+
+        flush()                 finish saving everything
+
+    SQLiteStore is the other one.
+
+    Each file is written next to the old one under a temporary name and
+    renamed over it, so a crash never leaves a half written .bit_check file.
+    The temporary name ends in .bit_check, so it is never hashed.
+
+    With fsync, the renames for a batch only happen once every file in it is
+    on disk, and the directories are synced afterwards. Syncing a batch at
+    once gives the file system a chance to combine the work.
+    """
+
+    def __init__(self, index_format=None, fsync=False,
+                 batch_size=DEFAULT_WRITE_BATCH):
+        """
+        Set up the writer.
+
+        Without index_format, each file is written in the format it was read
+        in, and new ones in DEFAULT_INDEX_FORMAT.
+        """
+        self.index_format = index_format
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.pending = []
+        self.saved = 0
+
+    @staticmethod
+    def read(path, columnar=False):
+        """Read a .bit_check file."""
+        return read_bitcheck(path, columnar)
+
+    def needs_rewrite(self, data):
+        """Rewrite files that aren't in the index_format asked for."""
+        return self.index_format is not None and bool(data) and (
+            isinstance(data, BinaryIndex) != (self.index_format == 'binary'))
+
+    def save(self, path, data):
+        """Queue a .bit_check file to be written."""
+        index_format = self.index_format
+        if index_format is None:
+            index_format = 'binary' if isinstance(data, BinaryIndex) else \
+                DEFAULT_INDEX_FORMAT
+        self.pending.append((path, dump_bitcheck(data, index_format)))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write every queued .bit_check file."""
+        pending, self.pending = self.pending, []
+        renames = []
+
+        for path, contents in pending:
+            temp = os.path.join(path, '.{}{}'.format(os.getpid(), CHECK_FILE))
+            with open(temp, 'wb') as file:
+                file.write(contents)
+                if self.fsync:
+                    file.flush()
+                    os.fsync(file.fileno())
+            renames.append((path, temp))
+
+        for path, temp in renames:
+            os.replace(temp, os.path.join(path, CHECK_FILE))
+            self.saved += 1
+
+        if self.fsync:
+            for path, _ in renames:
+                sync_directory(path)
+
+
+def save_bitcheck(path, data, index_format=DEFAULT_INDEX_FORMAT,
+                  fsync=False):
+    """
+    Save file that contains file hash information.
+
+    index_format is json (the default, readable by every version) or binary
+    (smaller and much faster to read for large directories, see
+    BinaryIndex). The file is replaced atomically (see CheckFileWriter).
+    """
+    writer = CheckFileWriter(index_format, fsync)
+    writer.save(path, data)
+    writer.flush()
+
+
+class SQLiteStore():
+    """
+    Keep every directory's files in one SQLite database.
+
+    This is an alternative to .bit_check files (see CheckFileWriter for what
+    a store does). It trades the ability to move directories around for a
+    single file that can be queried, with indexes on directory, hash and
+    last verified time.
+
+    Directories are stored by absolute path. The database is in WAL mode and
+    saves are done in batches, batch_size directories to a transaction.
+    """
+
+    def __init__(self, database, batch_size=DEFAULT_WRITE_BATCH):
+        """Open (or create) a database."""
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SQLITE_SCHEMA)
+        self.batch_size = batch_size
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def read(self, path, columnar=False):
+        """Read the files of a directory."""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT name, mtime, hash, algorithm, size, inode, verified '
+                'FROM files WHERE directory = ?',
+                (os.path.abspath(path),)).fetchall()
+
+        data = {row[0]: File(row[0], path, *row[1:]) for row in rows}
+        if columnar:
+            try:
+                return ColumnarIndex(path, data.values())
+            except ValueError:
+                pass
+        return data
+
+    @staticmethod
+    def needs_rewrite(data):
+        """Nothing needs to be rewritten just because it was read."""
+        return False
+
+    def save(self, path, data):
+        """Replace the files of a directory."""
+        directory = os.path.abspath(path)
+
+        with self.lock:
+            self.connection.execute('DELETE FROM files WHERE directory = ?',
+                                    (directory,))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                ((directory, name, file.mtime, file.hash, file.algorithm,
+                  file.size, file.inode, file.verified)
+                 for name, file in data.items()))
+
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.connection.commit()
+                self.pending = 0
+
+    def flush(self):
+        """Commit everything that was saved."""
+        with self.lock:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        """Commit and close the database."""
+        self.flush()
+        self.connection.close()
+
+    def directories(self):
+        """All of the directories in the database."""
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                'SELECT DISTINCT directory FROM files ORDER BY directory')]
+
+    def find_hash(self, hash_value):
+        """Find the paths of every file with a hash."""
+        with self.lock:
+            return [os.path.join(*row) for row in self.connection.execute(
+                'SELECT directory, name FROM files WHERE hash = ? '
+                'ORDER BY directory, name', (hash_value,))]
+
+    def stalest(self, count):
+        """Find the paths of the files verified the longest time ago."""
+        with self.lock:
+            return [os.path.join(*row) for row in self.connection.execute(
+                'SELECT directory, name FROM files '
+                'ORDER BY verified IS NOT NULL, verified LIMIT ?', (count,))]
+
+    def stats(self):
+        """Count the directories, files and bytes, and the verified times."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT COUNT(DISTINCT directory), COUNT(*), '
+                'COALESCE(SUM(size), 0), MIN(verified), MAX(verified) '
+                'FROM files').fetchone()
+        return dict(zip(('directories', 'files', 'bytes', 'oldest_verified',
+                         'newest_verified'), row))
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    hash TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    size INTEGER,
+    inode INTEGER,
+    verified INTEGER,
+    PRIMARY KEY (directory, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+CREATE INDEX IF NOT EXISTS files_verified ON files (verified);
+"""
+
+
+def stored_files(directory, ignore=None, store=None):
+    """
+    Yield every stored file in a tree, without reading any of them.
+
+    Each is (size, algorithm, hash, path, inode). Sizes that weren't stored
+    are filled in with stat.
+    """
+    if not isinstance(ignore, IgnoreMatcher):
+        ignore = IgnoreMatcher(ignore or [])
+    store = store or CheckFileWriter
+
+    for path, entries in scan_dir(directory, ignore):
+        data = store.read(path)
+        for entry in entries:
+            file = data.get(entry.name)
+            if file is None:
+                continue
+
+            size, inode = file.size, file.inode
+            if size is None:
+                try:
+                    stat = stat_entry(entry)
+                except OSError:
+                    continue
+                size, inode = stat.st_size, stat.st_ino
+
+            yield (size, file.algorithm, file.hash,
+                   os.path.join(path, entry.name), inode)
+
+
+def sorted_externally(records, run_size=DEFAULT_SORT_RUN):
+    """
+    Sort records that may not fit in memory.
+
+    Records are sorted run_size at a time, and every run but the last is
+    written to a temporary file, one JSON list per line. The runs are then
+    merged. Records have to survive being turned into JSON and back.
+    """
+    runs = []
+    try:
+        while True:
+            chunk = sorted(itertools.islice(records, run_size))
+            if len(chunk) < run_size:
+                break
+
+            spill = tempfile.TemporaryFile('w+')
+            runs.append(spill)
+            spill.writelines(json.dumps(record) + '\n' for record in chunk)
+            spill.seek(0)
+
+        if not runs:
+            yield from chunk
+            return
+
+        def read(spill):
+            for line in spill:
+                yield tuple(json.loads(line))
+
+        yield from heapq.merge(*[read(spill) for spill in runs], chunk)
+    finally:
+        for spill in runs:
+            spill.close()
+
+
+def find_duplicates(directory, ignore=None, store=None, min_size=1,
+                    run_size=DEFAULT_SORT_RUN):
+    """
+    Find files with the same contents, using the stored hashes.
+
+    No file is read. Stored files are sorted by size, then hash (see
+    sorted_externally, so a huge tree never has to fit in memory), which
+    puts duplicates next to each other. Files are only compared with files
+    hashed with the same algorithm. Files smaller than min_size are left
+    out. Yields a Duplicate for each set, smallest files first.
+    """
+    records = (record for record in stored_files(directory, ignore, store)
+               if record[0] >= min_size)
+
+    for (size, algorithm, hash_value), group in itertools.groupby(
+            sorted_externally(records, run_size),
+            key=lambda record: record[:3]):
+        group = list(group)
+        if len(group) < 2:
+            continue
+
+        inodes = [record[4] for record in group]
+        copies = len(set(inodes) - {None}) + inodes.count(None)
+        yield Duplicate(size, algorithm, hash_value,
+                        [record[3] for record in group], size * (copies - 1))
+
+
+def import_check_files(directory, store):
+    """Copy every .bit_check file in a tree into a store."""
+    for path, files in walk_dir(directory):
+        if CHECK_FILE in files:
+            store.save(path, read_bitcheck(path))
+    store.flush()
+
+
+def export_check_files(store, index_format=DEFAULT_INDEX_FORMAT):
+    """Write a .bit_check file for every directory in a store."""
+    for path in store.directories():
+        if os.path.isdir(path):
+            save_bitcheck(path, store.read(path), index_format)
+
+
+def compare_files(old_file, new_file):
+    """
+    Determine how a two files have changed.
+
+    If there is no old version of a file, then the file was added.
+    If the hash of the old and new files match, then nothing has happened.
+    If the hash of the old and new files does not match, but the modified time
+    has changed, then the file has been updated.
+    If the hash of the old and new files does not match and the modified time
+    has not changed, then there is an error.
+    """
+    if old_file is None:
+        # Don't have a hash for this file, so it is new
+        return Result.added
+
+    if old_file.hash != new_file.hash:
+        if old_file.mtime == new_file.mtime:
+            return Result.error
+        else:
+            return Result.updated
+
+    return Result.nothing
+
+
+def create_accept_list(lst):
+    """Generator for turning an ignore list into gitignore style lines."""
+    yield '*'  # Accept everything
+    yield '!*{}'.format(CHECK_FILE)  # Ignore my files
+
+    for line in lst:
+        if line[0] == '!':
+            yield line[1:]
+        else:
+            yield '!{}'.format(line)
+
+
+def convert_ignore_list(lst):
+    """Convert an ignore list to an accept list."""
+    return pathspec.PathSpec.from_lines('gitignore', create_accept_list(lst))
+
+
+GLOB_CHARACTERS = frozenset('*?[\\')
+MATCH_CACHE_SIZE = 65536
+
+
+class IgnoreMatcher():
+    """
+    A compiled version of the accept list from convert_ignore_list.
+
+    It accepts the same files, but works a directory at a time so whole
+    directories can be skipped without listing them. Paths are relative to
+    the directory being scanned.
+
+    Every rule is sorted into the fastest way to check it:
+
+        literal     a plain name, like node_modules (a set lookup)
+
+        extension   *.ext (a dictionary lookup per dot in the name)
+
+        glob        anything else (falls back to the pathspec regex)
+
+    Like gitignore, the last rule that matches a path decides whether it is
+    accepted. Literal and extension rules match any part of the path, so the
+    last rule that matches a directory is worked out once and passed down to
+    everything under it. If that rule ignores the directory and no later rule
+    accepts anything, nothing under it can be accepted and it is pruned.
+    """
+
+    def __init__(self, lst):
+        """Compile an ignore list."""
+        self.include = []
+        self.every = -1
+        self.names = {}
+        self.dir_names = {}
+        self.extensions = {}
+        self.dir_extensions = {}
+        self.globs = []
+
+        for line in create_accept_list(lst):
+            pattern = pathspec.PathSpec.from_lines('gitignore', [line])
+            pattern = pattern.patterns[0]
+            if pattern.include is None:
+                # Blank line or comment
+                continue
+
+            index = len(self.include)
+            self.include.append(pattern.include)
+            self.add_rule(index, line.lstrip('!'), pattern)
+
+        accepted = [i for i, include in enumerate(self.include) if include]
+        self.last_accept = max(accepted, default=-1)
+        self.globs.reverse()
+        self.cache = {} if not self.globs else None
+
+    def add_rule(self, index, line, pattern):
+        """Sort a rule by how it can be matched."""
+        dir_only = line.endswith('/')
+        name = line.rstrip('/')
+        names, extensions = ((self.dir_names, self.dir_extensions) if dir_only
+                             else (self.names, self.extensions))
+
+        if line == '*':
+            self.every = index
+        elif line != line.strip() or not name or '/' in name:
+            self.globs.append((index, pattern.regex))
+        elif not GLOB_CHARACTERS.intersection(name):
+            names[name] = index
+        elif (name[0] == '*' and name[1:2] == '.' and
+              not GLOB_CHARACTERS.intersection(name[1:])):
+            extensions[name[1:]] = index
+        else:
+            self.globs.append((index, pattern.regex))
+
+    @staticmethod
+    def match_name(name, names, extensions):
+        """Find the last literal or extension rule that matches a name."""
+        index = names.get(name, -1)
+
+        if extensions:
+            dot = name.find('.')
+            while dot != -1:
+                index = max(index, extensions.get(name[dot:], -1))
+                dot = name.find('.', dot + 1)
+
+        return index
+
+    def match_dir(self, name, path, parent=None):
+        """
+        Find the last rule that matches a directory.
+
+        parent is what this returned for the directory this one is in (None
+        for the directory being scanned). Returns None if nothing in this
+        directory can be accepted.
+        """
+        if parent is None:
+            index = self.every
+        else:
+            index = max(parent,
+                        self.match_name(name, self.names, self.extensions),
+                        self.match_name(name, self.dir_names,
+                                        self.dir_extensions))
+            for glob_index, regex in self.globs:
+                if glob_index <= index:
+                    break
+                if regex.match(path + '/'):
+                    index = glob_index
+                    break
+
+        if index >= 0 and not self.include[index] and \
+                index > self.last_accept:
+            return None
+        return index
+
+    def match_file(self, name, path, parent):
+        """Check if a file is accepted, given what its directory matched."""
+        if self.cache is not None:
+            key = (parent, name)
+            if key not in self.cache:
+                if len(self.cache) >= MATCH_CACHE_SIZE:
+                    self.cache.clear()
+                index = max(parent, self.match_name(name, self.names,
+                                                    self.extensions))
+                self.cache[key] = index >= 0 and self.include[index]
+            return self.cache[key]
+
+        index = max(parent, self.match_name(name, self.names, self.extensions))
+        for glob_index, regex in self.globs:
+            if glob_index <= index:
+                break
+            if regex.match(path):
+                index = glob_index
+                break
+
+        return index >= 0 and self.include[index]
+
+
+# pylint: disable=too-many-arguments
+def handle_error(error, path, file, old_file, file_error_cb, missing_cb):
+    """Deal with file error."""
+    # Check what kind of error it is
+    if not isinstance(error, OSError) or error.errno == errno.EACCES:
+        # We don't have access to the file, or can't hash it here
+        file_error_cb(path, file, error)
+    elif error.errno == errno.ENOENT:
+        # The file was deleted
+        if old_file is not None:
+            missing_cb(old_file)
+    else:
+        # Don't know what else to do with it
+        raise error
+
+
+class Deferred():
+    """
+    Stand-in for a future when hashing on the calling thread.
+
+    The work is only done once the result is asked for, so a single worker
+    behaves exactly like a plain loop.
+    """
+
+    def __init__(self, func, *args):
+        """Store the work to be done."""
+        self.func = func
+        self.args = args
+        self.done = False
+        self.value = None
+
+    def result(self):
+        """Do the work, the first time."""
+        if not self.done:
+            self.value = self.func(*self.args)
+            self.done = True
+            self.func = self.args = None
+        return self.value
+
+
+def hash_file(name, path, stat, algorithm, options, block_size=None):
+    """
+    Create a File object for a file that has already been stat-ed.
+
+    With block_size, files bigger than one block are BlockFiles.
+    """
+    if block_size and stat.st_size > block_size:
+        return BlockFile(name, path, stat.st_mtime, algorithm=algorithm,
+                         size=stat.st_size, inode=stat.st_ino,
+                         block_size=block_size, **options)
+    return File(name, path, stat.st_mtime, algorithm=algorithm,
+                size=stat.st_size, inode=stat.st_ino, **options)
+
+
+def read_into_buffer(descriptor, buffer):
+    """Read from a file descriptor into buffer, returning the bytes read."""
+    if hasattr(os, 'readv'):
+        return os.readv(descriptor, [buffer])
+
+    data = os.read(descriptor, len(buffer))  # pragma: no cover
+    buffer[:len(data)] = data  # pragma: no cover
+    return len(data)  # pragma: no cover
+
+
+def hash_small_files(path, batch, options):
+    """
+    Hash a batch of small files in a directory.
+
+    batch is a list of (name, stat, algorithm), for files that were at most
+    options['small_file_size'] bytes when they were stat-ed. Each file is
+    read with one os.readv (os.read where there isn't one) into a buffer
+    that's shared by the whole batch, skipping file objects and read_chunks.
+    Network file systems can return less than was asked for, so reading
+    carries on until the file's size has been read or there's nothing left.
+    Like read_chunks, files are dropped from the page cache unless
+    options['io_mode'] is buffered.
+
+    Returns a File for each file, or the OSError reading it raised.
+    """
+    buffer = bytearray(options['small_file_size'] + 1)
+    view = memoryview(buffer)
+    throttle = options.get('throttle')
+    drop = options.get('io_mode', DEFAULT_IO_MODE) != 'buffered' and \
+        hasattr(os, 'POSIX_FADV_DONTNEED')
+    results = []
+
+    for name, stat, algorithm in batch:
+        digest = get_hash(algorithm)
+        try:
+            descriptor = os.open(os.path.join(path, name), os.O_RDONLY)
+            try:
+                remaining = stat.st_size
+                while True:
+                    start = time.monotonic()
+                    count = read_into_buffer(descriptor, buffer)
+                    if throttle is not None:
+                        throttle.wait(count, time.monotonic() - start)
+
+                    digest.update(view[:count])
+                    remaining -= count
+                    if count == 0 or remaining <= 0:
+                        break
+                if drop:
+                    advise(descriptor, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(descriptor)
+        except OSError as exception:
+            results.append(exception)
+            continue
+
+        results.append(File(name, path, stat.st_mtime, digest.hexdigest(),
+                            algorithm, stat.st_size, stat.st_ino))
+
+    return results
+
+
+class BatchItem():
+    """Stand-in for a future for one file of a batch of small files."""
+
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index):
+        """Point at a file in a batch (a future of hash_small_files)."""
+        self.batch = batch
+        self.index = index
+
+    def result(self):
+        """Return the file's File, raising its error if reading it failed."""
+        result = self.batch.result()[self.index]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class Move():
+    """Stand-in for a future for a file that MoveTracker found was moved."""
+
+    __slots__ = ('source', 'file')
+
+    def __init__(self, source, file):
+        """Remember where the file was moved from."""
+        self.source = source
+        self.file = file
+
+    def result(self):
+        """Return the File, with its hash carried over."""
+        return self.file
+
+
+class Trusted():
+    """
+    Stand-in for a future for a file that was trusted instead of read.
+
+    Lazy indexes hand out a new File every time, so check_directory can't
+    tell a trusted file from a hashed one by comparing them.
+    """
+
+    __slots__ = ('file',)
+
+    def __init__(self, file):
+        """Keep the stored File."""
+        self.file = file
+
+    def result(self):
+        """Return the stored File."""
+        return self.file
+
+
+class MoveTracker():
+    """
+    Notice files that were moved from one directory to another.
+
+    Otherwise, a moved file is missing from one directory and added to
+    another, and is read again.
+
+    Before run, plan finds the stored files that are gone and the files that
+    are new, without reading any of them. A new file with the same device,
+    inode, size and modified time as one that's gone was moved (or renamed),
+    so its stored hash and verified time are carried over and it isn't read.
+
+    Files that are gone and didn't match are held until the end of the run,
+    in case a new file turns out to have the same hash (it was copied, then
+    deleted). Whatever is left is missing.
+    """
+
+    def __init__(self):
+        """Start with nothing planned."""
+        self.moves = {}
+        self.moved_away = set()
+        self.held = {}
+        self.by_hash = {}
+
+    def plan(self, directory, ignore=None, store=None, shard=None,
+             only=None):
+        """
+        Match up files that are gone with new files, by inode.
+
+        With shard or only, just those directories are looked at (see
+        scan_dir).
+        """
+        if not isinstance(ignore, IgnoreMatcher):
+            ignore = IgnoreMatcher(ignore or [])
+        store = store or CheckFileWriter
+        gone = {}
+        new = []
+
+        for path, entries in scan_dir(directory, ignore, shard=shard,
+                                      only=only):
+            data = store.read(path)
+            names = set(entry.name for entry in entries)
+            device = None
+
+            for name, file in data.items():
+                if name in names:
+                    continue
+
+                self.held[path, name] = file
+                self.by_hash.setdefault(
+                    (file.size, file.algorithm, file.hash), []).append(
+                        (path, name))
+
+                if file.inode is not None:
+                    if device is None:
+                        device = os.stat(path).st_dev
+                    gone[device, file.inode, file.size, file.mtime] = file
+
+            for entry in entries:
+                if entry.name in data:
+                    continue
+                try:
+                    stat = stat_entry(entry)
+                except OSError:
+                    continue
+                new.append(((stat.st_dev, stat.st_ino, stat.st_size,
+                             stat.st_mtime), path, entry.name))
+
+        for key, path, name in new:
+            source = gone.pop(key, None)
+            if source is not None:
+                self.moves[path, name] = source
+                self.moved_away.add((source.path, source.name))
+                del self.held[source.path, source.name]
+
+    def moved_here(self, path, name, stat):
+        """Return where a new file was moved from, if it was."""
+        source = self.moves.pop((path, name), None)
+        if source is not None and (source.inode, source.size, source.mtime) \
+                == (stat.st_ino, stat.st_size, stat.st_mtime):
+            return source
+        return None
+
+    def match_hash(self, file):
+        """Return a file that's gone with the same contents as file."""
+        for key in self.by_hash.get((file.size, file.algorithm, file.hash),
+                                    ()):
+            source = self.held.pop(key, None)
+            if source is not None:
+                return source
+        return None
+
+    def gone(self, path, name):
+        """Check if a missing file is taken care of here."""
+        return (path, name) in self.moved_away or (path, name) in self.held
+
+    def leftover(self):
+        """Return the files that are gone and weren't moved."""
+        leftover = list(self.held.values())
+        self.held.clear()
+        return leftover
+
+
+class Metrics():
+    """
+    Keep track of where run spends its time.
+
+    The phases are:
+
+        list            listing directories
+        stat            stat-ing files
+        index_read      reading .bit_check files (or another store)
+        hash            reading and hashing files
+        callbacks       running run's callbacks
+        index_write     writing .bit_check files (or another store)
+
+    Hashing is added up across workers, so with more than one worker it can
+    be longer than the run. The number of calls of each phase is counted
+    too, which for list, stat, index_read and hash is the number of
+    directories listed, stat calls, stores read and files opened. Each file's
+    hash time goes in a histogram.
+
+    Nothing is measured unless a Metrics is passed to run.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+    PHASES = ('list', 'stat', 'index_read', 'hash', 'callbacks',
+              'index_write')
+
+    def __init__(self):
+        """Start with nothing measured."""
+        self.lock = threading.Lock()
+        self.seconds = Counter()
+        self.calls = Counter()
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+        self.bytes_hashed = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    def add(self, phase, seconds, calls=1):
+        """Add time spent in a phase."""
+        with self.lock:
+            self.seconds[phase] += seconds
+            self.calls[phase] += calls
+
+    def timed(self, phase, func):
+        """Wrap a function, adding the time spent in it to phase."""
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start)
+        return wrapper
+
+    def timed_iter(self, phase, iterable):
+        """Wrap an iterable, adding the time to get each item to phase."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(phase, time.perf_counter() - start)
+            yield item
+
+    def hash_file(self, *args):
+        """Call hash_file, measuring how long it took."""
+        start = time.perf_counter()
+        file = hash_file(*args)
+        seconds = time.perf_counter() - start
+
+        with self.lock:
+            self.seconds['hash'] += seconds
+            self.calls['hash'] += 1
+            self.bytes_hashed += file.size or 0
+            self.histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        return file
+
+    def hash_small_files(self, *args):
+        """Call hash_small_files, measuring how long it took."""
+        start = time.perf_counter()
+        results = hash_small_files(*args)
+        seconds = time.perf_counter() - start
+
+        # Each file gets an equal share of the time in the histogram
+        bucket = bisect.bisect_left(self.BUCKETS,
+                                    seconds / max(len(results), 1))
+        with self.lock:
+            self.seconds['hash'] += seconds
+            self.calls['hash'] += len(results)
+            self.bytes_hashed += sum(result.size or 0 for result in results
+                                     if isinstance(result, File))
+            self.histogram[bucket] += len(results)
+        return results
+
+    def submit(self, submit):
+        """Wrap a submit function for queue_directory so hashing is timed."""
+        wrapped = {hash_file: self.hash_file,
+                   hash_small_files: self.hash_small_files}
+
+        def wrapper(func, *args):
+            return submit(wrapped.get(func, func), *args)
+        return wrapper
+
+    def stop(self):
+        """Note that the run is over."""
+        self.finished = time.monotonic()
+
+    def summary(self):
+        """Everything measured, as a dict."""
+        elapsed = (self.finished or time.monotonic()) - self.started
+        files = self.calls['hash']
+        return {
+            'seconds': elapsed,
+            'phases': {phase: {'seconds': self.seconds[phase],
+                               'calls': self.calls[phase]}
+                       for phase in self.PHASES},
+            'files_hashed': files,
+            'bytes_hashed': self.bytes_hashed,
+            'files_per_sec': files / elapsed if elapsed else 0,
+            'bytes_per_sec': self.bytes_hashed / elapsed if elapsed else 0,
+            'hash_seconds': {
+                'buckets': list(self.BUCKETS),
+                'counts': list(self.histogram),
+            },
+        }
+
+    def to_prometheus(self, prefix='rotten_bites'):
+        """Everything measured, in Prometheus' text format."""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, description))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            for labels, value in samples:
+                lines.append('{}_{}{} {}'.format(prefix, name, labels,
+                                                 repr(float(value))))
+
+        metric('run_seconds', 'gauge', 'How long the run took.',
+               [('', summary['seconds'])])
+        metric('phase_seconds', 'gauge', 'Time spent in each phase.',
+               [('{{phase="{}"}}'.format(phase), values['seconds'])
+                for phase, values in sorted(summary['phases'].items())])
+        metric('phase_calls', 'gauge', 'Calls made in each phase.',
+               [('{{phase="{}"}}'.format(phase), values['calls'])
+                for phase, values in sorted(summary['phases'].items())])
+        metric('bytes_hashed', 'gauge', 'Bytes read and hashed.',
+               [('', summary['bytes_hashed'])])
+        metric('files_per_second', 'gauge', 'Files hashed per second.',
+               [('', summary['files_per_sec'])])
+
+        total = 0
+        samples = []
+        # The histogram's samples are suffixes on its name
+        for bucket, count in zip(self.BUCKETS + ('+Inf',), self.histogram):
+            total += count
+            samples.append(('_bucket{{le="{}"}}'.format(bucket), total))
+        metric('hash_seconds', 'histogram', 'Time to hash each file.',
+               samples + [('_sum', self.seconds['hash']), ('_count', total)])
+
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path, metrics_format=DEFAULT_METRICS_FORMAT):
+        """
+        Write the metrics to a file, in one of METRICS_FORMATS.
+
+        The file is replaced atomically, as Prometheus' textfile collector
+        wants.
+        """
+        if metrics_format == 'json':
+            text = json.dumps(self.summary(), indent=2, sort_keys=True)
+        else:
+            text = self.to_prometheus()
+
+        temp = path + '.{}'.format(os.getpid())
+        with open(temp, 'w') as file:
+            file.write(text)
+        os.replace(temp, path)
+
+
+def count_tree(directory, ignore=None, store=None, shard=None):
+    """
+    Quickly count the files and bytes that run will check, for Progress.
+
+    Sizes are taken from the stored files when they're known, so mostly only
+    new files are stat-ed. ignore is the same as run's. Returns the number of
+    files and bytes.
+    """
+    if not isinstance(ignore, IgnoreMatcher):
+        ignore = IgnoreMatcher(ignore or [])
+    store = store or CheckFileWriter
+    files = 0
+    size = 0
+
+    for path, entries in scan_dir(directory, ignore, shard=shard):
+        data = store.read(path)
+        files += len(entries)
+
+        for entry in entries:
+            old_file = data.get(entry.name)
+            if old_file is not None and old_file.size is not None:
+                size += old_file.size
+                continue
+
+            try:
+                size += stat_entry(entry).st_size
+            except OSError:
+                pass
+
+    return files, size
+
+
+class Progress():
+    """
+    Keep track of how far through a run is.
+
+    update is called for each file that's done, and is cheap. At most every
+    interval seconds it calls render with the Progress, so showing progress
+    never slows down a run of lots of tiny files.
+    """
+
+    def __init__(self, total_files, total_bytes, render,
+                 interval=DEFAULT_PROGRESS_INTERVAL):
+        """Start tracking, expecting so many files and bytes in total."""
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.render = render
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.next_render = self.started + interval
+
+    def update(self, size):
+        """Note that a file of size bytes is done."""
+        self.files += 1
+        self.bytes += size or 0
+
+        now = time.monotonic()
+        if now >= self.next_render:
+            self.next_render = now + self.interval
+            self.render(self)
+
+    def finish(self):
+        """Render one last time."""
+        self.render(self)
+
+    @property
+    def elapsed(self):
+        """Seconds since the start."""
+        return time.monotonic() - self.started
+
+    @property
+    def files_per_sec(self):
+        """Files done per second so far."""
+        elapsed = self.elapsed
+        return self.files / elapsed if elapsed else 0
+
+    @property
+    def bytes_per_sec(self):
+        """Bytes done per second so far."""
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed else 0
+
+    @property
+    def fraction(self):
+        """How much is done, from 0 to 1, going by bytes if there are any."""
+        if self.total_bytes:
+            return min(1, self.bytes / self.total_bytes)
+        if self.total_files:
+            return min(1, self.files / self.total_files)
+        return 1
+
+    @property
+    def eta(self):
+        """Seconds left, or None if it can't be guessed yet."""
+        fraction = self.fraction
+        if not fraction:
+            return None
+        return self.elapsed * (1 - fraction) / fraction
+
+
+class MeteredStore():
+    """Time everything a store does for Metrics."""
+
+    def __init__(self, store, metrics):
+        """Wrap store."""
+        self.store = store
+        self.read = metrics.timed('index_read', store.read)
+        self.save = metrics.timed('index_write', store.save)
+        self.flush = metrics.timed('index_write', store.flush)
+        self.needs_rewrite = store.needs_rewrite
+
+
+def relative_dir(directory, path):
+    """Return a directory's path relative to directory, like 'a/b/' (or '')."""
+    relative = os.path.relpath(path, directory)
+    return '' if relative == os.curdir else relative.replace(os.sep, '/') + '/'
+
+
+def checkpoint_name(shard=None, name=CHECKPOINT_FILE):
+    """Add a shard to the name of a checkpoint file, like .resume.0-4.x."""
+    if shard is None:
+        return name
+    base, extension = os.path.splitext(name)
+    return '{}.{}-{}{}'.format(base, shard[0], shard[1], extension)
+
+
+class Checkpoint():
+    """
+    Remember how far run got, so an interrupted run can pick up from there.
+
+    Directories are walked in the same order every time (see scan_dir), so
+    the last directory that was saved is all that needs to be remembered.
+    Every interval seconds, the store is flushed and then that directory is
+    written to a small JSON file. The file is removed when a run finishes.
+
+    The default file is .resume.bit_check in the top directory, which is
+    never scanned since it ends in .bit_check. With shard, the shard is part
+    of the name (see checkpoint_name), so shards sharing a tree each keep
+    their own.
+    """
+
+    def __init__(self, directory, path=None,
+                 interval=DEFAULT_CHECKPOINT_INTERVAL, shard=None):
+        """Keep checkpoints for directory."""
+        self.directory = directory
+        self.path = path or os.path.join(directory, checkpoint_name(shard))
+        self.interval = interval
+        self.last = None
+        self.saved_at = time.monotonic()
+
+    def load(self):
+        """
+        Read where the last run stopped.
+
+        Returns a path relative to directory for scan_dir's after, or None
+        if there's nothing to resume.
+        """
+        try:
+            with open(self.path) as file:
+                return json.load(file)['after']
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError):
+            # Not worth giving up over, it just means starting over
+            return None
+
+    def done(self, path, store):
+        """Note that a directory was checked, saving a checkpoint if due."""
+        self.last = relative_dir(self.directory, path)
+
+        if time.monotonic() - self.saved_at >= self.interval:
+            self.save(store)
+
+    def save(self, store):
+        """Save a checkpoint, after making sure the store is saved."""
+        store.flush()
+        self.saved_at = time.monotonic()
+        if self.last is None:
+            return
+
+        temp = self.path + '.{}'.format(os.getpid())
+        with open(temp, 'w') as file:
+            json.dump({'after': self.last, 'time': int(time.time())}, file)
+        os.replace(temp, self.path)
+
+    def clear(self):
+        """Forget the checkpoint once a run is done."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+# pylint: disable=too-many-arguments
+def queue_directory(path, entries, submit, algorithm, options, trust=None,
+                    columnar=False, store=None, metrics=None, moves=None):
+    """
+    Read the stored hashes of a directory and queue its files to hash.
+
+    Files that are already stored are hashed with the algorithm they were
+    stored with, so they can be compared. New files use the given algorithm.
+
+    Stored files whose algorithm isn't available are passed on as errors
+    (the ValueError from get_hash), for check_directory's file_error_cb.
+
+    trust is called with the path and name of each stored file. If it returns
+    True and the file's modified time, size and inode haven't changed, the
+    file isn't hashed at all.
+
+    The stored files are read from store (.bit_check files by default), and
+    columnar is passed on to its read.
+
+    metrics is a Metrics, which times the stat calls. New files that moves
+    (a MoveTracker) knows were moved aren't hashed.
+
+    With options['small_file_size'], files up to that size are hashed
+    SMALL_FILE_BATCH at a time by hash_small_files, so each batch is one job.
+    With options['block_size'], files bigger than that are hashed a block at
+    a time too (see BlockFile). With options['tree_size'], new files bigger
+    than that get a tree hash of algorithm (see tree_algorithm).
+    """
+    data = (store or CheckFileWriter).read(path, columnar)
+    files = [entry.name for entry in entries]
+    jobs = []
+
+    small_file_size = options.get('small_file_size')
+    block_size = options.get('block_size')
+    tree_size = options.get('tree_size')
+    if small_file_size or block_size or tree_size:
+        options = dict(options)
+        for option in ('small_file_size', 'block_size', 'tree_size'):
+            options.pop(option, None)
+    batch_options = dict(options, small_file_size=small_file_size)
+    batch = []
+    batch_jobs = []
+
+    def submit_batch():
+        future = submit(hash_small_files, path, list(batch), batch_options)
+        for i, job in enumerate(batch_jobs):
+            job.batch = future
+            job.index = i
+        batch.clear()
+        batch_jobs.clear()
+
+    stats = stat_entries(entries)
+    if metrics is not None:
+        stats = metrics.timed_iter('stat', stats)
+
+    # Stored files may use an algorithm that isn't installed here
+    unknown = {}
+
+    def check_algorithm(name):
+        if name not in unknown:
+            try:
+                get_hash(name)
+                unknown[name] = None
+            except ValueError as exception:
+                unknown[name] = exception
+        return unknown[name]
+
+    for file, stat, error in stats:
+        old_file = data.get(file)
+        file_algorithm = algorithm if old_file is None else old_file.algorithm
+        if old_file is None and tree_size and not error and \
+                stat.st_size > tree_size:
+            file_algorithm = tree_algorithm(algorithm, tree_size)
+
+        if not error and old_file is not None:
+            error = check_algorithm(file_algorithm)
+
+        source = None
+        if not error and old_file is None and moves is not None:
+            source = moves.moved_here(path, file, stat)
+
+        if error:
+            job = None
+        elif source is not None:
+            job = Move(source, File(file, path, stat.st_mtime, source.hash,
+                                    source.algorithm, stat.st_size,
+                                    stat.st_ino, source.verified))
+        elif (trust is not None and old_file is not None and
+              old_file.same_stat(stat) and trust(path, file)):
+            job = Trusted(old_file)
+        elif small_file_size and stat.st_size <= small_file_size and \
+                not (block_size and stat.st_size > block_size):
+            job = BatchItem(None, None)
+            batch.append((file, stat, file_algorithm))
+            batch_jobs.append(job)
+            if len(batch) >= SMALL_FILE_BATCH:
+                submit_batch()
+        else:
+            job = submit(hash_file, file, path, stat, file_algorithm, options,
+                         block_size)
+
+        jobs.append((file, error, job))
+
+    if batch:
+        submit_batch()
+
+    return path, files, data, jobs
+
+
+# pylint: disable=too-many-arguments,too-many-locals,too-many-branches
+def check_directory(queued, added_cb, updated_cb, nothing_cb, file_error_cb,
+                    hash_error_cb, missing_cb, just_verify, dry_run, store,
+                    moves=None, moved_cb=None, keep_verified=True):
+    """
+    Compare the hashed files of a directory against the stored hashes.
+
+    The directory is only saved to the store if something in it changed.
+    New verified times are only kept with keep_verified, otherwise files that
+    only have a new verified time are left as they were stored.
+
+    With moves (a MoveTracker), new files that were moved from somewhere
+    else are passed to moved_cb instead of added_cb.
+
+    The Blocks of BlockFiles are kept next to the directory's other files, in
+    BLOCKS_FILE. When a BlockFile's hash doesn't match, its damaged byte
+    ranges are worked out from them before hash_error_cb is called.
+    """
+    path, files, data, jobs = queued
+    now = int(time.time())
+    changed = store.needs_rewrite(data)
+    blocks = None  # Only read when there are BlockFiles
+    blocks_changed = False
+
+    for file, error, job in jobs:
+        old_file = data.get(file)
+
+        # Check if any errors occurred while walking the file
+        if error:
+            handle_error(error, path, file, old_file, file_error_cb,
+                         missing_cb)
+            continue
+
+        try:
+            new_file = job.result()
+        except FileNotFoundError:
+            # The file was deleted between when the file list was created
+            # and now
+            if old_file is not None:
+                # We only care about this if the old file existed
+                missing_cb(old_file)
+            continue
+
+        if old_file is None and moves is not None:
+            if isinstance(job, Move):
+                source = job.source
+            else:
+                new_file.verified = now
+                source = moves.match_hash(new_file)
+
+            if source is not None:
+                if not just_verify:
+                    data[file] = new_file
+                    changed = True
+                moved_cb(source, new_file)
+                continue
+
+        if not isinstance(job, Trusted):
+            # The file was actually read
+            new_file.verified = now
+
+        result = compare_files(old_file, new_file)
+
+        if isinstance(new_file, BlockFile):
+            if blocks is None:
+                blocks = read_blocks(path)
+            old_blocks = blocks.get(file)
+            new_blocks = new_file.blocks
+
+            if result == Result.error:
+                if old_blocks is not None and \
+                        old_blocks.block_size == new_blocks.block_size:
+                    new_file.damaged = new_blocks.damaged(old_blocks,
+                                                          new_file.size)
+            elif not just_verify and (
+                    old_blocks is None or
+                    old_blocks.to_json() != new_blocks.to_json()):
+                blocks[file] = new_blocks
+                blocks_changed = True
+
+        if result == Result.updated and not just_verify:
+            old_file.mtime = new_file.mtime
+            old_file.hash = new_file.hash
+            old_file.size = new_file.size
+            old_file.inode = new_file.inode
+            old_file.verified = new_file.verified
+            data[file] = old_file
+            changed = True
+            updated_cb(old_file)
+
+        elif result == Result.added and not just_verify:
+            data[file] = new_file
+            changed = True
+            added_cb(new_file)
+
+        elif result == Result.nothing:
+            # Fill in the stat information for files stored before it was,
+            # and note when it was verified. A new verified time alone is
+            # only worth rewriting the directory for when scrubbing.
+            info = (new_file.size, new_file.inode)
+            if info != (old_file.size, old_file.inode) or (
+                    keep_verified and new_file.verified != old_file.verified):
+                old_file.size, old_file.inode = info
+                old_file.verified = new_file.verified
+                data[file] = old_file
+                changed = True
+            nothing_cb(old_file)
+
+        elif result == Result.error:
+            hash_error_cb(old_file, new_file)
+
+    for missing in set(data.keys()) - set(files):
+        old_file = data.pop(missing)
+        changed = True
+        if moves is None or not moves.gone(path, missing):
+            missing_cb(old_file)
+
+        if blocks is None:
+            blocks = read_blocks(path)
+        if blocks.pop(missing, None) is not None:
+            blocks_changed = True
+
+    if changed and not dry_run:
+        store.save(path, data)
+    if blocks_changed and not dry_run:
+        save_blocks(path, blocks)
+
+
+def trust_everything(path, name):
+    """Trust every file that doesn't look like it has changed."""
+    return True
+
+
+class Scrub():
+    """
+    Spread verifying a tree over many runs.
+
+    Before a run, plan reads every .bit_check file and picks the files that
+    were verified the longest time ago. Only those files are hashed. Every
+    other file is trusted as long as its modified time, size and inode
+    haven't changed, the same as a quick run.
+
+    How much is verified each run is limited by max_bytes and max_fraction
+    (of the number of stored files). Files that haven't been verified within
+    period seconds are always picked, even past those limits, so every file
+    is verified at least once per period. max_seconds stops verifying
+    entirely once the run has taken that long, no matter what was picked.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, period=DEFAULT_SCRUB_PERIOD, max_bytes=None,
+                 max_fraction=None, max_seconds=None):
+        """Set the limits for each run."""
+        self.period = period
+        self.max_bytes = max_bytes
+        self.max_fraction = max_fraction
+        self.max_seconds = max_seconds
+        self.selected = set()
+        self.start = None
+
+    def plan(self, directory, ignore=None, store=None, shard=None,
+             only=None):
+        """
+        Pick the files to verify in this run.
+
+        The stored files are read from store (.bit_check files by default).
+        With shard or only, only those directories' files are considered (see
+        scan_dir).
+
+        Files that have never had a verified time recorded are the stalest,
+        but are not overdue, so turning on scrubbing doesn't turn the next
+        run into a full scan.
+        """
+        now = time.time()
+        stored = []
+
+        for path, entries in scan_dir(directory, ignore, shard=shard,
+                                      only=only):
+            names = set(entry.name for entry in entries)
+            stored.extend((file.verified or 0, path, name, file.size or 0)
+                          for name, file in
+                          (store or CheckFileWriter).read(path).items()
+                          if name in names)
+
+        stored.sort()
+
+        max_files = len(stored)
+        if self.max_fraction is not None:
+            max_files = int(len(stored) * self.max_fraction + 0.5)
+
+        total = 0
+        self.selected = set()
+        for verified, path, name, size in stored:
+            overdue = verified and now - verified >= self.period
+            if len(self.selected) >= max_files and not overdue:
+                if verified:
+                    break  # Everything after this is newer, so not overdue
+                continue
+
+            # The stalest file is always taken, even if it's bigger than
+            # max_bytes, so scrubbing can't get stuck on it. Others that
+            # don't fit are skipped for smaller ones.
+            within_budget = not self.selected or self.max_bytes is None or \
+                total + size <= self.max_bytes
+            if not (within_budget or overdue):
+                continue
+
+            total += size
+            self.selected.add((path, name))
+
+        self.start = now
+        return self.selected
+
+    def trusted(self, path, name):
+        """Check if a file can be trusted without verifying it."""
+        if self.max_seconds is not None and \
+                time.time() - self.start >= self.max_seconds:
+            return True
+
+        return (path, name) not in self.selected
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def run(directory, added_cb=lambda x: x, updated_cb=lambda x: x,
+        nothing_cb=lambda x: x, file_error_cb=lambda p, f, e: p,
+        hash_error_cb=lambda old, new: old, missing_cb=lambda x: x,
+        ignore=None, just_verify=False, dry_run=False,
+        workers=DEFAULT_WORKERS, algorithm=DEFAULT_ALGORITHM,
+        chunk_size=DEFAULT_CHUNK_SIZE, io_mode=DEFAULT_IO_MODE, quick=False,
+        scrub=None, max_bytes_per_sec=None, max_iops=None, max_latency=None,
+        index_format=None, fsync=False, columnar=False,
+        store=None, cancel=None, checkpoint=None, resume=False, shard=None,
+        metrics=None, small_file_size=None, detect_moves=False,
+        moved_cb=lambda old, new: new, block_size=None, tree_size=None,
+        only=None, skip=None):
+    """
+    Run rotten bits, checking for bit errors.
+
+    With more than one worker, files are hashed in a thread pool while
+    directories are still being walked. Results are always handled on the
+    calling thread in walk order, so callbacks fire and .bit_check files are
+    written exactly as they would be with a single worker.
+
+    New files are hashed with algorithm. Files that are already stored keep
+    the algorithm they were stored with.
+
+    chunk_size and io_mode control how files are read (see read_chunks).
+    With small_file_size, files up to that many bytes are instead read in
+    batches, straight into one buffer (see hash_small_files), which is much
+    faster for lots of tiny files. With block_size, files bigger than that
+    many bytes also have a digest for each block, so a hash error says which
+    parts of the file are damaged (see BlockFile). With tree_size, new files
+    bigger than that many bytes get a tree hash instead, with blocks of that
+    size. Their blocks are read by a pool of workers threads that all of
+    them share (see hash_blocks), so there are never more than that many
+    block reads at once, however many of those files are being hashed.
+
+    With quick, files that have the same modified time, size and inode as
+    when they were stored are assumed to be unchanged and aren't read. This
+    finds new and changed files quickly, but it can't find bit rot.
+
+    scrub is a Scrub, which verifies only part of the tree each run. Files
+    that aren't verified are handled the same as with quick. Without one,
+    a directory isn't rewritten just to update when its files were verified.
+
+    max_bytes_per_sec, max_iops and max_latency slow the scan down so it can
+    share the disk (see Throttle).
+
+    .bit_check files are written in index_format, whatever format they were
+    read in (see save_bitcheck). Without it, they keep the format they are
+    in. They are only written when something in them changed, and with
+    fsync they are synced to disk (see CheckFileWriter). With columnar,
+    they are kept in memory as a ColumnarIndex, which uses far less memory
+    for huge directories.
+
+    store replaces .bit_check files with somewhere else to keep the hashes,
+    such as a SQLiteStore (see CheckFileWriter). index_format and fsync are
+    only for .bit_check files.
+
+    cancel is a threading.Event. Once it's set, run stops before the next
+    directory. Everything checked so far is still saved.
+
+    checkpoint is a Checkpoint, which is saved every so often and whenever
+    run stops early. With resume, run starts after the last checkpoint.
+
+    only is a set of directories relative to directory, like 'a/b/'. Only
+    those are checked (see scan_dir), and checkpoint isn't used. The
+    directories in skip aren't checked.
+    """
+    get_hash(algorithm)  # Fail early on unknown algorithms
+    if shard is not None and not 0 <= shard[0] < shard[1]:
+        raise ValueError("Shard {} of {} doesn't exist".format(*shard))
+    ignore = IgnoreMatcher(ignore or [])
+    options = {'chunk_size': chunk_size, 'io_mode': io_mode}
+    if small_file_size:
+        options['small_file_size'] = small_file_size
+    if block_size:
+        options['block_size'] = block_size
+    if tree_size:
+        options['tree_size'] = tree_size
+
+    if (max_bytes_per_sec, max_iops, max_latency) != (None, None, None):
+        options['throttle'] = Throttle(max_bytes_per_sec, max_iops,
+                                       max_latency)
+
+    store = store or CheckFileWriter(index_format, fsync)
+    if metrics is not None:
+        store = MeteredStore(store, metrics)
+        added_cb, updated_cb, nothing_cb, file_error_cb, hash_error_cb, \
+            missing_cb, moved_cb = (
+                metrics.timed('callbacks', callback) for callback in
+                (added_cb, updated_cb, nothing_cb, file_error_cb,
+                 hash_error_cb, missing_cb, moved_cb))
+
+    trust = None
+    if quick:
+        trust = trust_everything
+    elif scrub is not None:
+        scrub.plan(directory, ignore, store, shard, only)
+        trust = scrub.trusted
+
+    moves = None
+    if detect_moves:
+        moves = MoveTracker()
+        moves.plan(directory, ignore, store, shard, only)
+
+    callbacks = (added_cb, updated_cb, nothing_cb, file_error_cb,
+                 hash_error_cb, missing_cb, just_verify, dry_run, store,
+                 moves, moved_cb, scrub is not None)
+
+    if dry_run or only is not None:
+        checkpoint = None
+    after = checkpoint.load() if checkpoint and resume else None
+
+    # One pool for the blocks of every tree hashed file, rather than one each
+    if tree_size and workers > 1:
+        options['executor'] = ThreadPoolExecutor(max_workers=workers)
+
+    finished = False
+    try:
+        check_tree(directory, (ignore, after, shard, only, skip), workers,
+                   (algorithm, options, trust, columnar, store, metrics,
+                    moves),
+                   callbacks, cancel, checkpoint, metrics)
+        if moves is not None:
+            for old_file in moves.leftover():
+                missing_cb(old_file)
+        finished = cancel is None or not cancel.is_set()
+    finally:
+        if 'executor' in options:
+            options['executor'].shutdown()
+        store.flush()
+        if checkpoint is not None:
+            if finished:
+                checkpoint.clear()
+            else:
+                checkpoint.save(store)
+        if metrics is not None:
+            metrics.stop()
+
+
+class Window():
+    """
+    Start jobs in a thread pool in order, at most limit ahead of run.
+
+    submit hands back a WindowJob straight away, but it's only started once
+    fewer than limit jobs have been started and not waited for. Waiting for
+    one makes room for the next. A directory with hundreds of thousands of
+    files doesn't become hundreds of thousands of futures, and stopping only
+    has to wait for the few jobs that were running. Only the calling thread
+    uses it.
+    """
+
+    def __init__(self, executor, limit):
+        """Use executor, starting up to limit jobs ahead."""
+        self.executor = executor
+        self.limit = limit
+        self.waiting = deque()
+        self.running = set()
+
+    def submit(self, func, *args):
+        """Queue func(*args) to run once there's room."""
+        job = WindowJob(self, func, args)
+        self.waiting.append(job)
+        self.fill()
+        return job
+
+    def full(self):
+        """Check if there are jobs waiting for room."""
+        return bool(self.waiting)
+
+    def start(self, job):
+        """Start a job in the pool."""
+        job.future = self.executor.submit(job.func, *job.args)
+        job.func = job.args = None
+        self.running.add(job)
+
+    def fill(self):
+        """Start jobs until there are limit of them."""
+        while self.waiting and len(self.running) < self.limit:
+            self.start(self.waiting.popleft())
+
+    def done(self, job):
+        """Note that a job was waited for, making room for another."""
+        self.running.discard(job)
+        self.fill()
+
+    def cancel(self):
+        """Throw away every job that hasn't started running yet."""
+        self.waiting.clear()
+        for job in self.running:
+            job.future.cancel()
+        self.running.clear()
+
+
+class WindowJob():
+    """Stand-in for a future for a job submitted to a Window."""
+
+    __slots__ = ('window', 'func', 'args', 'future')
+
+    def __init__(self, window, func, args):
+        """Remember the work, to be started by window."""
+        self.window = window
+        self.func = func
+        self.args = args
+        self.future = None
+
+    def result(self):
+        """Wait for the job, starting it first if it hasn't been."""
+        if self.future is None:
+            self.window.waiting.remove(self)
+            self.window.start(self)
+        self.window.done(self)
+        return self.future.result()
+
+
+# pylint: disable=too-many-arguments
+def check_tree(directory, walk_options, workers, queue_options, callbacks,
+               cancel=None, checkpoint=None, metrics=None):
+    """
+    Walk, hash and check every directory for run.
+
+    walk_options are the ignore, after, shard, only and skip arguments to
+    scan_dir, and queue_options are the rest of the arguments to
+    queue_directory.
+    """
+    ignore, after, shard, only, skip = walk_options
+    store = callbacks[8]  # check_directory's store
+
+    walk = scan_dir(directory, ignore, after=after, shard=shard, only=only,
+                    skip=skip)
+    submit = Deferred
+    if metrics is not None:
+        walk = metrics.timed_iter('list', walk)
+        submit = metrics.submit(submit)
+
+    def check(queued):
+        check_directory(queued, *callbacks)
+        if checkpoint is not None:
+            checkpoint.done(queued[0], store)
+
+    if workers <= 1:
+        for path, entries in walk:
+            if cancel is not None and cancel.is_set():
+                return
+            check(queue_directory(path, entries, submit, *queue_options))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Keep a few files per worker in flight so that small directories
+        # don't leave the pool idle.
+        window = Window(executor, workers * 4)
+        submit = window.submit
+        if metrics is not None:
+            submit = metrics.submit(submit)
+
+        pending = deque()
+        try:
+            for path, entries in walk:
+                if cancel is not None and cancel.is_set():
+                    # Hashing that was already started is thrown away
+                    pending.clear()
+                    break
+
+                pending.append(queue_directory(path, entries, submit,
+                                               *queue_options))
+
+                while pending and window.full():
+                    check(pending.popleft())
+
+            while pending:
+                check(pending.popleft())
+        finally:
+            window.cancel()
+
+
+class Journal():
+    """
+    The directories that changed since the last run, as seen by a Watcher.
+
+    Each line is the JSON of a directory's path relative to directory (see
+    relative_dir), or null when changes may have been missed, like when the
+    Watcher starts or inotify's queue overflows. Lines are only appended, with
+    the file locked, so a run can take them all while the Watcher carries on.
+
+    The Watcher also locks WATCHER_FILE for as long as it's running. Without
+    one running nothing is being noted, so take asks for a full walk.
+    """
+
+    def __init__(self, directory, path=None):
+        """Keep a journal for directory."""
+        self.directory = directory
+        self.path = path or os.path.join(directory, JOURNAL_FILE)
+        self.lock_path = os.path.join(os.path.dirname(self.path),
+                                      WATCHER_FILE)
+
+    def write(self, text):
+        """Append to the journal."""
+        with open(self.path, 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            file.write(text)
+
+    def add(self, relatives):
+        """Note that directories changed."""
+        self.write(''.join(json.dumps(relative) + '\n'
+                           for relative in relatives))
+
+    def overflow(self):
+        """Note that changes were missed, so the next run walks everything."""
+        self.write('null\n')
+
+    def put_back(self, relatives):
+        """Give back what take returned, for a run that didn't finish."""
+        if relatives is None:
+            self.overflow()
+        else:
+            self.add(relatives)
+
+    def hold(self):
+        """
+        Lock WATCHER_FILE, until the file that's returned is closed.
+
+        Raises RuntimeError if another Watcher already has it.
+        """
+        file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            raise RuntimeError("{} is already being watched".format(
+                self.directory))
+        return file
+
+    def watched(self):
+        """Check if a Watcher is running."""
+        if fcntl is None:
+            return False  # pragma: no cover
+
+        try:
+            with open(self.lock_path, 'a') as file:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        return False
+
+    def take(self):
+        """
+        Take every directory noted so far, leaving the journal empty.
+
+        Returns a set of relative paths, or None if everything has to be
+        walked.
+        """
+        if not self.watched():
+            return None
+
+        try:
+            with open(self.path, 'r+') as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                lines = file.read().splitlines()
+                file.seek(0)
+                file.truncate()
+        except FileNotFoundError:
+            return None
+
+        relatives = set()
+        for line in lines:
+            try:
+                relative = json.loads(line)
+            except ValueError:
+                return None
+            if relative is None:
+                return None
+            relatives.add(relative)
+        return relatives
+
+
+def load_inotify():
+    """Find inotify in the C library, or None where there isn't one."""
+    if not sys.platform.startswith('linux'):
+        return None  # pragma: no cover
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None  # pragma: no cover
+
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    return libc
+
+
+# From sys/inotify.h
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR |
+              IN_DONT_FOLLOW)
+# watch descriptor, mask, cookie, length of name
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class Watcher():
+    """
+    Watch a tree with inotify, noting in a Journal which directories change.
+
+    Every directory is watched, including ones made later. Changes to
+    .bit_check files (mine) don't count. If inotify's queue overflows, the
+    Journal is told and the next run walks everything. Running out of
+    watches (fs.inotify.max_user_watches) raises OSError, since some
+    directories wouldn't be watched at all.
+
+    Only works on Linux.
+    """
+
+    def __init__(self, directory, journal=None, ignore=None,
+                 interval=DEFAULT_WATCH_INTERVAL):
+        """Get ready to watch directory. stop is checked every interval."""
+        self.libc = load_inotify()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, "inotify isn't available")
+
+        self.directory = directory
+        self.journal = journal or Journal(directory)
+        self.ignore = IgnoreMatcher(ignore or [])
+        self.interval = interval
+        self.descriptor = None
+        self.watches = {}
+        self.overflowed = False
+
+    def watch(self, path):
+        """Watch a directory and everything in it, returning their paths."""
+        added = []
+        top = relative_dir(self.directory, path)
+        for sub_path, _ in scan_dir(self.directory, self.ignore, top=top):
+            watch = self.libc.inotify_add_watch(
+                self.descriptor, os.fsencode(sub_path), WATCH_MASK)
+            if watch < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, 'Out of inotify watches (see '
+                                  'fs.inotify.max_user_watches)')
+                continue  # It was deleted already
+
+            relative = relative_dir(self.directory, sub_path)
+            self.watches[watch] = relative
+            added.append(relative)
+        return added
+
+    def read_events(self):
+        """Read whatever inotify events are waiting."""
+        data = os.read(self.descriptor, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            watch, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield watch, mask, name
+
+    def handle(self, watch, mask, name, dirty):
+        """Add the directories an event changed to dirty."""
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(watch, None)
+            return
+
+        relative = self.watches.get(watch)
+        if relative is None or name.endswith(CHECK_FILE):
+            return
+
+        dirty.add(relative)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            dirty.update(self.watch(os.path.join(self.directory, relative,
+                                                 name)))
+
+    def flush(self, dirty):
+        """Write what changed to the journal."""
+        if self.overflowed:
+            self.journal.overflow()
+            self.overflowed = False
+        if dirty:
+            self.journal.add(sorted(dirty))
+            dirty.clear()
+
+    def run(self, stop=None):
+        """Watch until stop (a threading.Event) is set, or forever."""
+        self.descriptor = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        lock = self.journal.hold()
+        try:
+            self.watch(self.directory)
+            # Anything that changed before now was missed
+            self.journal.overflow()
+
+            dirty = set()
+            while stop is None or not stop.is_set():
+                ready, _, _ = select.select([self.descriptor], [], [],
+                                            self.interval)
+                if ready:
+                    for event in self.read_events():
+                        self.handle(*event, dirty)
+                self.flush(dirty)
+        finally:
+            os.close(self.descriptor)
+            self.watches = {}
+            lock.close()
+
+
+def run_watched(directory, journal=None, scrub_seconds=None, **options):
+    """
+    Check only the directories a Watcher saw change, then scrub the rest.
+
+    The directories in journal are checked like a quick run. Then, for up to
+    scrub_seconds, the rest of the tree is verified, carrying on from where
+    the last run stopped (ROLLING_FILE remembers where), so every file is
+    still verified every so often. If the journal overflowed or there's no
+    Watcher running, everything is checked instead, the same as run.
+
+    options are passed on to run, although the rolling pass is never quick.
+    Returns True if the journal was used.
+    """
+    journal = journal or Journal(directory)
+    only = journal.take()
+    try:
+        if only is None:
+            run(directory, **options)
+        else:
+            run(directory, **dict(options, quick=True, only=only))
+
+        if only is not None and scrub_seconds:
+            cancel = threading.Event()
+            timer = threading.Timer(scrub_seconds, cancel.set)
+            timer.start()
+            try:
+                # The journal's directories were just checked
+                run(directory, **dict(
+                    options, quick=False, skip=only, cancel=cancel,
+                    resume=True, checkpoint=Checkpoint(
+                        directory, os.path.join(directory, ROLLING_FILE))))
+            finally:
+                timer.cancel()
+    except BaseException:
+        journal.put_back(only)
+        raise
+
+    if options.get('dry_run'):
+        journal.put_back(only)
+    return only is not None
+
+
+class StopScan(Exception):
+    """Raised inside run when whoever is reading scan stops."""
+
+
+class ScanThread(threading.Thread):
+    """
+    Run run on a background thread, turning callbacks into Events.
+
+    At most buffer_size events wait in events at a time, after which run
+    waits for them to be taken. Once everything is done, FINISHED is put in
+    events and an exception from run is kept in failure. A cancel in options
+    is used to stop the scan, so setting it stops the scan too.
+    """
+
+    FINISHED = None
+
+    def __init__(self, directory, kinds, buffer_size, options):
+        """Get ready to run, only making events in kinds."""
+        super().__init__(name='rotten_bites.scan', daemon=True)
+
+        unknown = set(kinds) - set(EVENT_KINDS)
+        if unknown:
+            raise ValueError("Unknown event kinds: {}".format(
+                ', '.join(sorted(unknown))))
+
+        self.directory = directory
+        self.events = queue.Queue(buffer_size)
+        self.options = dict(options)
+        self.cancel = self.options.pop('cancel', None) or threading.Event()
+        self.failure = None
+
+        put = self.put
+        makers = {
+            'added': ('added_cb', lambda file: put(
+                Event('added', file.path, file.name, file, None, None))),
+            'updated': ('updated_cb', lambda file: put(
+                Event('updated', file.path, file.name, file, None, None))),
+            'nothing': ('nothing_cb', lambda file: put(
+                Event('nothing', file.path, file.name, file, None, None))),
+            'error': ('hash_error_cb', lambda old, new: put(
+                Event('error', old.path, old.name, new, old, None))),
+            'missing': ('missing_cb', lambda file: put(
+                Event('missing', file.path, file.name, file, None, None))),
+            'file_error': ('file_error_cb', lambda path, name, error: put(
+                Event('file_error', path, name, None, None, error))),
+            'moved': ('moved_cb', lambda old, new: put(
+                Event('moved', new.path, new.name, new, old, None))),
+        }
+        self.options.update(makers[kind] for kind in kinds)
+
+    def offer(self, item):
+        """Wait to put item in events, giving up if the scan is stopped."""
+        while not self.cancel.is_set():
+            try:
+                self.events.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def put(self, event):
+        """Put an event in events, unwinding run if the scan is stopped."""
+        if not self.offer(event):
+            raise StopScan()
+
+    def run(self):
+        """Run rotten bites."""
+        try:
+            run(self.directory, cancel=self.cancel, **self.options)
+        except StopScan:
+            pass
+        except BaseException as e:  # pylint: disable=broad-except
+            self.failure = e
+        finally:
+            # Nobody can be waiting for events when they are full
+            try:
+                self.events.put_nowait(self.FINISHED)
+            except queue.Full:
+                self.offer(self.FINISHED)
+
+    def take(self):
+        """Wait for at least one event, returning all that are ready."""
+        items = [self.events.get()]
+        while items[-1] is not self.FINISHED:
+            try:
+                items.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def stop(self):
+        """Stop run before the next directory or event."""
+        self.cancel.set()
+
+
+def scan(directory, kinds=EVENT_KINDS, buffer_size=DEFAULT_EVENT_BUFFER,
+         **options):
+    """
+    Run rotten bites, yielding an Event for everything that happens.
+
+    This is a generator in place of run's callbacks. run happens on a
+    background thread, and at most buffer_size events are waiting at a time,
+    so run waits when the caller falls behind. Only events in kinds are
+    made, so leaving out 'nothing' means unchanged files cost nothing.
+
+    Closing the generator early stops run before the next directory (or
+    event), saving what was checked so far. Errors in run are raised here.
+    Any other options are passed on to run.
+    """
+    thread = ScanThread(directory, kinds, buffer_size, options)
+    thread.start()
+
+    try:
+        while True:
+            event = thread.events.get()
+            if event is thread.FINISHED:
+                break
+            yield event
+    finally:
+        thread.stop()
+        thread.join()
+
+    if thread.failure is not None:
+        raise thread.failure
+
+
+class AsyncScan():
+    """
+    scan for asyncio.
+
+    Use it with async for. The event loop is never blocked: run is on its
+    own thread, hashing uses run's workers, and events are passed over in
+    batches by the loop's default executor.
+
+    If the task reading it is cancelled, or it is closed early with aclose
+    (or async with), run is stopped before the next directory and what was
+    checked so far is saved.
+    """
+
+    def __init__(self, directory, kinds=EVENT_KINDS,
+                 buffer_size=DEFAULT_EVENT_BUFFER, **options):
+        """Get ready to scan. Arguments are the same as scan."""
+        self.thread = ScanThread(directory, kinds, buffer_size, options)
+        self.ready = deque()
+        self.done = False
+
+    def __aiter__(self):
+        """Start scanning."""
+        if self.thread.ident is None:
+            self.thread.start()
+        return self
+
+    async def __anext__(self):
+        """Return the next event."""
+        while not self.ready and not self.done:
+            loop = get_running_loop()
+            try:
+                self.ready.extend(
+                    await loop.run_in_executor(None, self.thread.take))
+            except asyncio.CancelledError:
+                await self.aclose()
+                raise
+
+            if self.ready[-1] is ScanThread.FINISHED:
+                self.ready.pop()
+                self.done = True
+
+        if self.ready:
+            return self.ready.popleft()
+
+        if self.thread.failure is not None:
+            failure, self.thread.failure = self.thread.failure, None
+            raise failure
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        """Stop scanning, waiting for run to save what it checked."""
+        self.done = True
+        self.ready.clear()
+        self.thread.stop()
+        if self.thread.is_alive():
+            await get_running_loop().run_in_executor(
+                None, self.thread.join)
+
+    async def __aenter__(self):
+        """Start scanning."""
+        return self.__aiter__()
+
+    async def __aexit__(self, *exc):
+        """Stop scanning."""
+        await self.aclose()
+
+
+async def async_run(directory, progress_cb=None, **options):
+    """
+    Run rotten bites without blocking the event loop.
+
+    progress_cb is called with a Counter of the kinds of events so far after
+    each batch of events. The final Counter is returned. Any other options
+    are passed on to AsyncScan (and then run).
+    """
+    counts = Counter()
+
+    async with AsyncScan(directory, **options) as events:
+        async for event in events:
+            counts[event.kind] += 1
+            if progress_cb is not None and not events.ready:
+                progress_cb(counts)
+
+    return counts
+
+
+class Report():
+    """
+    Write what a run found to a file, so reports from shards can be merged.
+
+    Reports are JSON lines: a header, one line for every file that wasn't
+    unchanged, and a summary of the counts (including unchanged files) once
+    the run is done. Paths are relative to directory, so they match across
+    machines that mount the tree in different places.
+
+    A run that resumes after the directory resumed (see Checkpoint) adds to
+    the report of the run it's picking up from, with a header of its own.
+    merge_reports uses resumed to leave out what the earlier run listed
+    after it, since those directories were checked again.
+    """
+
+    def __init__(self, path, directory, shard=None, resumed=None):
+        """Start a report for a run of directory."""
+        self.directory = directory
+        self.counts = Counter()
+        self.file = open(path, 'w' if resumed is None else 'a')
+        self.write(type='header', version=1, shard=shard, resumed=resumed,
+                   started=int(time.time()))
+
+    def write(self, **line):
+        """Write a line of the report."""
+        self.file.write(json.dumps(line, sort_keys=True) + '\n')
+
+    def add(self, kind, path, name):
+        """Add a file, with its kind from EVENT_KINDS."""
+        self.counts[kind] += 1
+        if kind != 'nothing':
+            relative = os.path.relpath(os.path.join(path, name),
+                                       self.directory)
+            self.write(type='file', kind=kind,
+                       path=relative.replace(os.sep, '/'))
+
+    def close(self, finished=True):
+        """Finish the report, noting whether the run got to the end."""
+        self.write(type='summary', counts=self.counts,
+                   finished=int(time.time()) if finished else None)
+        self.file.close()
+
+
+def merge_reports(paths):
+    """
+    Combine Reports from different shards into one.
+
+    Returns a dict with the summed counts, every file by kind (sorted), the
+    shards that were found, and any shards that are missing or that didn't
+    finish. Reports of runs without shards are fine too.
+
+    A report can hold several runs, when they were resumed. A shard is
+    finished once the last of them is. Runs that died without a summary
+    only count the files they listed. The directories after the checkpoint
+    a run resumed from were checked again, so what the run before listed in
+    them is dropped.
+    """
+    counts = Counter()
+    files = {kind: [] for kind in EVENT_KINDS if kind != 'nothing'}
+    shards = set()
+    unfinished = []
+    total = None
+
+    def drop_after(run, resumed):
+        """Drop a run's files in directories after resumed in walk order."""
+        after = resumed.split('/')[:-1]
+        summary, listed = run
+        kept = [(kind, relative) for kind, relative in listed
+                if relative.split('/')[:-1] <= after]
+        if summary is not None:
+            summary.subtract(Counter(kind for kind, _ in listed))
+            summary.update(Counter(kind for kind, _ in kept))
+        run[1] = kept
+
+    for path in paths:
+        finished = False
+        shard = None
+        runs = []  # [summary counts or None, listed (kind, path)]
+
+        with open(path) as file:
+            for line in file:
+                line = json.loads(line)
+                if line['type'] == 'header':
+                    if runs and line.get('resumed') is not None:
+                        drop_after(runs[-1], line['resumed'])
+                    runs.append([None, []])
+                    shard = line['shard']
+                    finished = False
+                elif line['type'] == 'file':
+                    runs[-1][1].append((line['kind'], line['path']))
+                elif line['type'] == 'summary':
+                    runs[-1][0] = Counter(line['counts'])
+                    finished = bool(line['finished'])
+
+        for summary, listed in runs:
+            for kind, relative in listed:
+                files[kind].append(relative)
+            if summary is None:
+                summary = Counter(kind for kind, _ in listed)
+            counts.update(+summary)
+
+        if shard is not None:
+            shards.add(tuple(shard))
+            total = shard[1]
+        if not finished:
+            unfinished.append(path)
+
+    missing = []
+    if total is not None:
+        found = set(index for index, count in shards if count == total)
+        missing = [index for index in range(total) if index not in found]
+
+    return {'counts': dict(counts),
+            'files': {kind: sorted(paths) for kind, paths in files.items()},
+            'shards': sorted(shards),
+            'missing_shards': missing,
+            'unfinished': unfinished}
+
+
+def convert_check_files(directory, index_format):
+    """Rewrite all metafiles for Rotten Bites in a different format."""
+    for path, files in walk_dir(directory):
+        if CHECK_FILE in files:
+            save_bitcheck(path, read_bitcheck(path), index_format)
+
+
+def delete_check_files(directory):
+    """
+    Delete all metafiles for Rotten Bites.
+
+    They all end in .bit_check (hashes, blocks, checkpoints of every shard,
+    the journal and the watcher's lock), the same files that are never
+    hashed (see create_accept_list).
+    """
+    for path, files in walk_dir(directory):
+        for name in files:
+            if name.endswith(CHECK_FILE):
+                os.remove(os.path.join(path, name))
@@ -1,6 +1,7 @@
 """CLI portion of Rotten Bites."""
 # pylint: disable=no-value-for-parameter
 from enum import IntEnum
+import json
 import os
 
 import click
@@ -31,10 +32,56 @@ def read_ignore_list(file):
         yield line
 
 
+def parse_shard(ctx, param, value):
+    """Convert i/N to (i, N)."""
+    if value is None:
+        return None
+
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise click.BadParameter('should look like i/N, such as 0/4')
+
+    if not 0 <= index < count:
+        raise click.BadParameter('i should be from 0 to N - 1')
+    return index, count
+
+
+def human_bytes(size):
+    """Format a number of bytes to be read by people."""
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            break
+        size /= 1024
+    return '{:.1f} {}'.format(size, unit)
+
+
+def human_seconds(seconds):
+    """Format seconds as h:mm:ss."""
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+
+
+def render_progress(progress):
+    """Show progress on one line of stderr."""
+    click.echo('\r\x1b[K{:5.1f}%  {}/{} files  {}/s  {:.0f} files/s  '
+               'ETA {}'.format(progress.fraction * 100, progress.files,
+                               progress.total_files,
+                               human_bytes(progress.bytes_per_sec),
+                               progress.files_per_sec,
+                               human_seconds(progress.eta)),
+               nl=False, err=True)
+
+
 @click.command()
 @click.argument('directory')
 @click.option('--delete', is_flag=True,
               help='Delete all .bit_check files.')
+@click.option('--convert', type=click.Choice(rotten_bites.INDEX_FORMATS),
+              help='Convert all .bit_check files to another format.')
 @click.option('-n', '--dry-run', is_flag=True,
               help='Run without making any changes. No .bit_check files are '
                    'created or updated')
@@ -46,29 +93,130 @@ def read_ignore_list(file):
 @click.option('-v', '--verbose', 'logging', flag_value=Logging.verbose,
               help='Display all files that are scanned, even if they haven\'t'
                    ' changed')
+@click.option('--progress', 'show_progress', is_flag=True,
+              help='Count everything first, then show progress and how '
+                   'long is left.')
 @click.option('--verify', default=False, is_flag=True,
               help='Verify hashes without updating.')
+@click.option('--quick', default=False, is_flag=True,
+              help='Only hash files that are new or whose modified time, size '
+                   'or inode changed. Much faster, but can\'t detect bit rot.')
+@click.option('--detect-moves', is_flag=True,
+              help='Notice files that were moved between directories, '
+                   'instead of reading them again.')
+@click.option('--resume', is_flag=True,
+              help='Pick up where the last run left off if it was '
+                   'interrupted.')
+@click.option('--journal', is_flag=True,
+              help='Only check directories rotten_bites_watch saw change '
+                   '(everything if it wasn\'t running), then verify the rest '
+                   'for up to --scrub-minutes.')
+@click.option('--shard', callback=parse_shard, metavar='i/N',
+              help='Only check shard i (counting from 0) of N, split by '
+                   'directory, so N machines can share a tree.')
+@click.option('--report', type=click.Path(dir_okay=False),
+              help='Write what was found to this file, to be combined with '
+                   'rotten_bites_merge.')
+@click.option('--scrub-bytes', type=click.IntRange(0, None),
+              help='Scrub: only verify the files verified longest ago, up to '
+                   'this many bytes. Other files are checked like --quick.')
+@click.option('--scrub-percent', type=float,
+              help='Scrub: only verify this percent of files, the ones '
+                   'verified longest ago.')
+@click.option('--scrub-minutes', type=float,
+              help='Scrub: stop verifying files after this many minutes.')
+@click.option('--scrub-days', default=30, type=float,
+              help='Scrub: always verify files that haven\'t been verified '
+                   'in this many days, even past the other limits.')
+@click.option('--max-rate', type=click.IntRange(1, None),
+              help='Read at most this many bytes per second.')
+@click.option('--max-iops', type=click.IntRange(1, None),
+              help='Read at most this many times per second.')
+@click.option('--max-latency', type=float,
+              help='Back off while reads take longer than this many '
+                   'milliseconds on average.')
+@click.option('--nice', is_flag=True,
+              help='Run at the lowest CPU and I/O priority.')
+@click.option('--index-format', type=click.Choice(rotten_bites.INDEX_FORMATS),
+              help='Format to write .bit_check files in. By default they '
+                   'keep their format, and new ones are json.')
+@click.option('--fsync', is_flag=True,
+              help='Make sure .bit_check files are on disk before moving on.')
+@click.option('--database', type=click.Path(dir_okay=False),
+              help='Keep hashes in this SQLite database instead of '
+                   '.bit_check files.')
+@click.option('--import', 'import_', is_flag=True,
+              help='Copy all .bit_check files into --database.')
+@click.option('--export', is_flag=True,
+              help='Write .bit_check files from --database, in '
+                   '--index-format.')
+@click.option('--stats', is_flag=True,
+              help='Show what is in --database.')
+@click.option('--metrics', type=click.Path(dir_okay=False),
+              help='Write how long each part of the run took to this file.')
+@click.option('--metrics-format', default=rotten_bites.DEFAULT_METRICS_FORMAT,
+              type=click.Choice(rotten_bites.METRICS_FORMATS),
+              help='Format of --metrics. prometheus is for node_exporter\'s '
+                   'textfile collector.')
+@click.option('--low-memory', is_flag=True,
+              help='Use much less memory for directories with huge numbers '
+                   'of files, at the cost of some speed.')
+@click.option('-j', '--jobs', default=rotten_bites.DEFAULT_WORKERS,
+              type=click.IntRange(1, None),
+              help='Number of files to hash at the same time.')
+@click.option('--hash', 'algorithm', default=rotten_bites.DEFAULT_ALGORITHM,
+              type=click.Choice(sorted(rotten_bites.HASH_ALGORITHMS)),
+              help='Hash algorithm used for new files. Files that are already '
+                   'stored keep their algorithm. xxh64 and crc32c need the '
+                   'fast extra.')
+@click.option('--io-mode', default=rotten_bites.DEFAULT_IO_MODE,
+              type=click.Choice(rotten_bites.IO_MODES),
+              help='How files are read. readinto and mmap avoid extra copies '
+                   'and keep the scan out of the page cache.')
+@click.option('--chunk-size', default=rotten_bites.DEFAULT_CHUNK_SIZE,
+              type=click.IntRange(1, None),
+              help='Number of bytes read from a file at a time.')
+@click.option('--small-files', type=click.IntRange(1, None),
+              help='Read files up to this many bytes in batches, straight '
+                   'into one buffer. Try 65536 for lots of tiny files.')
+@click.option('--block-size', type=click.IntRange(1, None),
+              help='Also hash each block of this many bytes of bigger '
+                   'files, to find which parts of them are damaged.')
+@click.option('--tree-size', type=click.IntRange(1, None),
+              help='Give new files bigger than this many bytes a tree hash '
+                   'with blocks this size, so --jobs blocks of them are read '
+                   'at the same time.')
 # pylint: disable=too-many-arguments,too-many-locals
-def main(directory, delete, dry_run, ignore_list, verify, logging):
+def main(directory, delete, convert, dry_run, ignore_list, show_progress,
+         verify, quick, detect_moves, resume, journal, shard, report,
+         scrub_bytes,
+         scrub_percent, scrub_minutes, scrub_days, max_rate, max_iops,
+         max_latency, nice, index_format, fsync, database, import_, export,
+         stats, metrics, metrics_format, low_memory, logging, jobs,
+         algorithm, io_mode, chunk_size, small_files, block_size,
+         tree_size):
     """
     Run CLI.
 
-    Given a directory, rotten bites calculates the sha1 hash of every file
-    and stores it in .bit_check files. Once stored, subsequent checks will see
-    if the hash has changed, detecting bit rot.
+    Given a directory, rotten bites calculates the hash (sha1 by default) of
+    every file and stores it in .bit_check files (or a SQLite database with
+    --database). Once stored, subsequent checks will see if the hash has
+    changed, detecting bit rot.
 
     Status codes:
 
-        'E'     error, sha1 mismatch
+        'E'     error, hash mismatch
 
         'a'     add to index
 
-        'u'     update sha1
+        'u'     update hash
 
         ' '     not modified (shown only with verbose)
 
         '?'     could not read file (permission denied or file no longer
                 exists)
+
+        'm'     moved from another directory (with --detect-moves)
     """
     ignore_list = read_ignore_list(ignore_list)
     logging = logging or Logging.normal
@@ -77,10 +225,15 @@ def main(directory, delete, dry_run, ignore_list, verify, logging):
     nothing_files = 0
     hash_error_files = 0
     missing_files = 0
+    moved_files = 0
+    progress = None
 
     def vprint(msg, log_level):
         """Print depending on the log level."""
         if logging >= log_level:
+            if progress is not None:
+                # Clear the progress line, which is shown again later
+                click.echo('\r\x1b[K', nl=False, err=True)
             click.echo(msg)
 
     def added_cb(file):
@@ -88,6 +241,10 @@ def main(directory, delete, dry_run, ignore_list, verify, logging):
         nonlocal added_files
 
         added_files += 1
+        if progress is not None:
+            progress.update(file.size)
+        if report:
+            report.add('added', file.path, file.name)
         vprint("a  {}".format(os.path.join(file.path, file.name)),
                Logging.normal)
 
@@ -96,6 +253,10 @@ def main(directory, delete, dry_run, ignore_list, verify, logging):
         nonlocal update_files
 
         update_files += 1
+        if progress is not None:
+            progress.update(file.size)
+        if report:
+            report.add('updated', file.path, file.name)
         vprint("u  {}".format(os.path.join(file.path, file.name)),
                Logging.normal)
 
@@ -104,11 +265,19 @@ def main(directory, delete, dry_run, ignore_list, verify, logging):
         nonlocal nothing_files
 
         nothing_files += 1
+        if progress is not None:
+            progress.update(file.size)
+        if report:
+            report.add('nothing', file.path, file.name)
         vprint("   {}".format(os.path.join(file.path, file.name)),
                Logging.verbose)
 
     def file_error_cb(path, file, error):
         """Print when file has an error."""
+        if progress is not None:
+            progress.update(0)
+        if report:
+            report.add('file_error', path, file)
         vprint("?  {}".format(os.path.join(path, file)), Logging.normal)
 
     def hash_error_cb(old_file, new_file):
@@ -116,14 +285,41 @@ def main(directory, delete, dry_run, ignore_list, verify, logging):
         nonlocal hash_error_files
 
         hash_error_files += 1
-        vprint("E  {}".format(os.path.join(old_file.path, old_file.name)),
-               Logging.quiet)
+        if progress is not None:
+            progress.update(new_file.size)
+        if report:
+            report.add('error', old_file.path, old_file.name)
+        damaged = getattr(new_file, 'damaged', None)
+        if damaged:
+            vprint("E  {} (bytes {})".format(
+                os.path.join(old_file.path, old_file.name),
+                ', '.join('{}-{}'.format(start, end - 1)
+                          for start, end in damaged)), Logging.quiet)
+        else:
+            vprint("E  {}".format(os.path.join(old_file.path,
+                                               old_file.name)),
+                   Logging.quiet)
+
+    def moved_cb(old_file, new_file):
+        """Print when file was moved."""
+        nonlocal moved_files
+
+        moved_files += 1
+        if report:
+            report.add('moved', new_file.path, new_file.name)
+        if progress is not None:
+            progress.update(new_file.size)
+        vprint("m  {} (from {})".format(
+            os.path.join(new_file.path, new_file.name),
+            os.path.join(old_file.path, old_file.name)), Logging.normal)
 
     def missing_cb(file):
         """Print when file is missing."""
         nonlocal missing_files
 
         missing_files += 1
+        if report:
+            report.add('missing', file.path, file.name)
         vprint("d  {}".format(os.path.join(file.path, file.name)),
                Logging.normal)
 
@@ -131,19 +327,224 @@ def main(directory, delete, dry_run, ignore_list, verify, logging):
         rotten_bites.delete_check_files(directory)
         return
 
-    rotten_bites.run(directory, added_cb=added_cb, updated_cb=updated_cb,
-                     nothing_cb=nothing_cb, file_error_cb=file_error_cb,
-                     hash_error_cb=hash_error_cb, missing_cb=missing_cb,
-                     just_verify=verify, ignore=ignore_list, dry_run=dry_run)
+    if convert:
+        rotten_bites.convert_check_files(directory, convert)
+        return
+
+    store = None
+    if database:
+        store = rotten_bites.SQLiteStore(database)
+    elif import_ or export or stats:
+        raise click.UsageError('--import, --export and --stats need '
+                               '--database')
+
+    if import_:
+        rotten_bites.import_check_files(directory, store)
+        return
+
+    if export:
+        rotten_bites.export_check_files(store, index_format)
+        return
+
+    if stats:
+        for key, value in sorted(store.stats().items()):
+            click.echo('{}: {}'.format(key, value))
+        return
+
+    if nice:
+        rotten_bites.lower_priority()
+
+    # Always keep checkpoints, in case the next run wants to resume. Shards
+    # sharing a tree each keep their own.
+    checkpoint = rotten_bites.Checkpoint(
+        directory, shard=shard, path=None if not database else
+        database + rotten_bites.checkpoint_name(shard, '.resume'))
+
+    if report:
+        report = rotten_bites.Report(
+            report, directory, shard,
+            resumed=checkpoint.load() if resume and not journal else None)
+
+    if show_progress and journal:
+        raise click.UsageError("--progress can't be used with --journal")
+    if show_progress:
+        click.echo('Counting files...', err=True)
+        ignore_list = list(ignore_list)
+        progress = rotten_bites.Progress(
+            *rotten_bites.count_tree(directory, ignore_list, store, shard),
+            render=render_progress)
+
+    metrics_path, metrics = metrics, None
+    if metrics_path:
+        metrics = rotten_bites.Metrics()
+
+    # With --journal, --scrub-minutes is how long to verify the rest for
+    scrub = None
+    if not journal and \
+            (scrub_bytes, scrub_percent, scrub_minutes) != (None, None, None):
+        scrub = rotten_bites.Scrub(
+            period=scrub_days * 24 * 60 * 60, max_bytes=scrub_bytes,
+            max_fraction=None if scrub_percent is None
+            else scrub_percent / 100,
+            max_seconds=None if scrub_minutes is None else scrub_minutes * 60)
+
+    options = dict(
+        added_cb=added_cb, updated_cb=updated_cb, nothing_cb=nothing_cb,
+        file_error_cb=file_error_cb, hash_error_cb=hash_error_cb,
+        missing_cb=missing_cb, just_verify=verify, ignore=list(ignore_list),
+        dry_run=dry_run, workers=jobs, algorithm=algorithm, io_mode=io_mode,
+        chunk_size=chunk_size, max_bytes_per_sec=max_rate,
+        max_iops=max_iops, max_latency=None if max_latency is None
+        else max_latency / 1000, index_format=index_format, fsync=fsync,
+        columnar=low_memory, store=store, shard=shard, metrics=metrics,
+        small_file_size=small_files, detect_moves=detect_moves,
+        moved_cb=moved_cb, block_size=block_size, tree_size=tree_size)
+
+    finished = False
+    try:
+        if journal:
+            if not rotten_bites.run_watched(
+                    directory, scrub_seconds=None if scrub_minutes is None
+                    else scrub_minutes * 60, **options):
+                vprint('The journal is incomplete, so everything was '
+                       'checked.', Logging.normal)
+        else:
+            rotten_bites.run(directory, quick=quick, scrub=scrub,
+                             checkpoint=checkpoint, resume=resume, **options)
+        finished = True
+    finally:
+        if report:
+            report.close(finished)
+
+    if progress is not None:
+        progress.finish()
+        click.echo(err=True)
+        progress = None
+    if metrics:
+        metrics.save(metrics_path, metrics_format)
 
     vprint("", Logging.normal)
     if dry_run:
         click.echo('** DRY-RUN **')
     vprint(
         '{} files scanned, {} new, {} updated, {} missing, {} errors.'.format(
-            added_files + update_files + nothing_files + hash_error_files,
-            added_files, update_files, missing_files, hash_error_files),
+            added_files + update_files + nothing_files + hash_error_files +
+            moved_files, added_files, update_files, missing_files,
+            hash_error_files),
         Logging.normal)
+    if detect_moves:
+        vprint('{} moved.'.format(moved_files), Logging.normal)
+
+
+@click.command()
+@click.argument('reports', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--json', 'as_json', is_flag=True,
+              help='Print the combined report as JSON.')
+@click.option('-v', '--verbose', is_flag=True,
+              help='Also list files that were added or updated.')
+def merge(reports, as_json, verbose):
+    """
+    Combine reports from rotten_bites --report.
+
+    Given the reports from every shard of a tree, print one summary, along
+    with the files that need attention.
+    """
+    merged = rotten_bites.merge_reports(reports)
+
+    if as_json:
+        click.echo(json.dumps(merged, indent=2, sort_keys=True))
+        return
+
+    codes = [('error', 'E'), ('file_error', '?'), ('missing', 'd')]
+    if verbose:
+        codes += [('added', 'a'), ('updated', 'u'), ('moved', 'm')]
+
+    for kind, code in codes:
+        for path in merged['files'][kind]:
+            click.echo("{}  {}".format(code, path))
+
+    counts = merged['counts']
+    click.echo("")
+    click.echo(
+        '{} files scanned, {} new, {} updated, {} missing, {} errors.'.format(
+            sum(counts.get(kind, 0) for kind in
+                ('added', 'updated', 'nothing', 'error')),
+            counts.get('added', 0), counts.get('updated', 0),
+            counts.get('missing', 0), counts.get('error', 0)))
+
+    if merged['missing_shards']:
+        click.echo('Missing shards: {}'.format(
+            ', '.join(str(index) for index in merged['missing_shards'])))
+    for path in merged['unfinished']:
+        click.echo('Did not finish: {}'.format(path))
+
+    if merged['missing_shards'] or merged['unfinished']:
+        raise SystemExit(1)
+
+
+@click.command()
+@click.argument('directory')
+@click.option('--database', type=click.Path(dir_okay=False, exists=True),
+              help='Read hashes from this SQLite database instead of '
+                   '.bit_check files.')
+@click.option('--ignore-list', type=click.File('r'),
+              help='List of files and folders to ignore.')
+@click.option('--min-size', default=1, type=click.IntRange(0, None),
+              help='Leave out files smaller than this many bytes.')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Print one JSON object per set of duplicates.')
+def dupes(directory, database, ignore_list, min_size, as_json):
+    """
+    Find duplicate files.
+
+    Uses the hashes rotten_bites already stored, so no file is read. Run
+    rotten_bites first to make sure they're up to date.
+    """
+    store = rotten_bites.SQLiteStore(database) if database else None
+    sets = 0
+    reclaimable = 0
+
+    for duplicate in rotten_bites.find_duplicates(
+            directory, list(read_ignore_list(ignore_list)), store, min_size):
+        sets += 1
+        reclaimable += duplicate.reclaimable
+
+        if as_json:
+            click.echo(json.dumps(duplicate._asdict(), sort_keys=True))
+            continue
+
+        click.echo('{} x {} bytes ({}:{})'.format(
+            len(duplicate.paths), duplicate.size, duplicate.algorithm,
+            duplicate.hash))
+        for path in duplicate.paths:
+            click.echo('    {}'.format(path))
+
+    if not as_json:
+        click.echo('')
+        click.echo('{} sets of duplicates, {} bytes could be freed.'.format(
+            sets, reclaimable))
+
+
+@click.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--ignore-list', type=click.File('r'),
+              help='List of files and folders to ignore.')
+def watch(directory, ignore_list):
+    """
+    Watch DIRECTORY for changes, for rotten_bites --journal.
+
+    Runs until it's stopped, noting which directories change in
+    .journal.bit_check. Only works on Linux.
+    """
+    watcher = rotten_bites.Watcher(directory,
+                                   ignore=list(read_ignore_list(ignore_list)))
+    click.echo('Watching {}...'.format(directory), err=True)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
 
 if __name__ == '__main__':
     main()
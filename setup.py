@@ -24,6 +24,10 @@ setup(
     author_email='philipbl@cs.utah.edu',
     download_url=DOWNLOAD_URL,
     install_requires=REQUIRES,
+    python_requires='>=3.5',
+    extras_require={
+        'fast': ['xxhash', 'crc32c'],
+    },
     packages=PACKAGES,
     include_package_data=True,
     test_suite='tests',
@@ -33,7 +37,10 @@ setup(
     long_description=read_md('README.md'),
     entry_points={
         'console_scripts': [
-            'rotten_bites = rotten_bites.__main__:main'
+            'rotten_bites = rotten_bites.__main__:main',
+            'rotten_bites_merge = rotten_bites.__main__:merge',
+            'rotten_bites_dupes = rotten_bites.__main__:dupes',
+            'rotten_bites_watch = rotten_bites.__main__:watch'
         ]
     },
     classifiers=[
@@ -41,6 +48,6 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.5',
     ],
 )
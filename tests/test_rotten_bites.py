@@ -1,6 +1,11 @@
+import asyncio
 import errno
+import hashlib
 import os
 import shutil
+import tempfile
+import threading
+import time
 import unittest
 import unittest.mock
 
@@ -152,6 +157,41 @@ class TestRottenBites(fake_filesystem_unittest.TestCase):
         self.assertEqual(path, 'a')
         self.assertEqual(files, ['file_2.txt', 'file_3.txt', 'file_5.txt'])
 
+    def test_scan_dir(self):
+        self.fs.CreateFile('d/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('d/b/file_3.txt', contents="file_3\n")
+        self.fs.CreateFile('d/a/file_2.txt', contents="file_2\n")
+        self.fs.CreateLink('d/link', os.path.abspath('d/a'))
+
+        result = [(path, [(entry.name, entry.stat().st_size)
+                          for entry in entries])
+                  for path, entries in rotten_bites.scan_dir('d')]
+
+        self.assertEqual(result, [
+            ('d', [('file_1.txt', 7)]),
+            ('d/a', [('file_2.txt', 7)]),
+            ('d/b', [('file_3.txt', 7)]),
+        ])
+
+        result = [path for path, _ in
+                  rotten_bites.scan_dir('d', follow_links=True)]
+        self.assertEqual(result, ['d', 'd/a', 'd/b', 'd/link'])
+
+    def test_stat_entries(self):
+        self.fs.CreateFile('d/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('d/file_2.txt', contents="file_2\n")
+
+        _, entries = next(rotten_bites.scan_dir('d'))
+        os.remove('d/file_2.txt')
+
+        result = list(rotten_bites.stat_entries(entries))
+        self.assertEqual(result[0][0], 'file_1.txt')
+        self.assertEqual(result[0][1].st_size, 7)
+        self.assertEqual(result[0][2], None)
+        self.assertEqual(result[1][0], 'file_2.txt')
+        self.assertEqual(result[1][1], None)
+        self.assertEqual(result[1][2].errno, errno.ENOENT)
+
     def test_walk_files(self):
         self.fs.CreateFile('file_1.txt', contents="file_1\n")
         self.fs.CreateFile('file_2.txt', contents="file_2\n")
@@ -227,6 +267,152 @@ class TestRottenBites(fake_filesystem_unittest.TestCase):
         rotten_bites.save_bitcheck('.', {"file_1.txt": file_1})
         self.assertTrue(os.path.exists('.bit_check'))
 
+    def test_binary_bitcheck(self):
+        data = {
+            "file_1.txt": rotten_bites.File("file_1.txt", ".", 1234.5,
+                                            hash_value=self.file_1_hash,
+                                            size=7, inode=42, verified=99),
+            "b.txt": rotten_bites.File("b.txt", ".", 1, hash_value="ab" * 32,
+                                       algorithm='sha256'),
+            "ü.txt": rotten_bites.File("ü.txt", ".", 2, hash_value="cd"),
+        }
+        rotten_bites.save_bitcheck('.', data, 'binary')
+
+        with open('.bit_check', 'rb') as file:
+            self.assertTrue(file.read().startswith(rotten_bites.BINARY_MAGIC))
+
+        result = rotten_bites.read_bitcheck('.')
+        self.assertIsInstance(result, rotten_bites.BinaryIndex)
+        self.assertEqual(result.changed, {})
+
+        self.assertEqual(sorted(result), sorted(data))
+        self.assertEqual(len(result), 3)
+        self.assertFalse("missing" in result)
+
+        file = result["file_1.txt"]
+        self.assertEqual(file.to_json(), data["file_1.txt"].to_json())
+        self.assertEqual(file.path, '.')
+        self.assertEqual(result["b.txt"].to_json(), data["b.txt"].to_json())
+        self.assertEqual(result["ü.txt"].to_json(), data["ü.txt"].to_json())
+
+        # Changes only stick once they are put back
+        file.mtime = 5
+        self.assertEqual(result["file_1.txt"].mtime, 1234.5)
+        result["file_1.txt"] = file
+        result["new.txt"] = rotten_bites.File("new.txt", ".", 3, "ef")
+        result.pop("b.txt")
+        self.assertEqual(result["file_1.txt"].mtime, 5)
+        self.assertEqual(sorted(result), ["file_1.txt", "new.txt", "ü.txt"])
+
+        rotten_bites.save_bitcheck('.', result)
+        result = rotten_bites.read_bitcheck('.')
+        self.assertIsInstance(result, dict)
+        self.assertEqual(sorted(result), ["file_1.txt", "new.txt", "ü.txt"])
+        self.assertEqual(result["file_1.txt"].mtime, 5)
+
+        with self.assertRaises(ValueError):
+            rotten_bites.save_bitcheck('.', {"a": rotten_bites.File(
+                "a", ".", 1, hash_value="not hex")}, 'binary')
+
+    def test_File_compact(self):
+        file = rotten_bites.File("file_1.txt", "a" + "/b", 1234,
+                                 hash_value=self.file_1_hash)
+
+        self.assertFalse(hasattr(file, '__dict__'))
+        self.assertIs(file.path, rotten_bites.File("x", "a/b", 1, "ab").path)
+        self.assertEqual(file.digest, bytes.fromhex(self.file_1_hash))
+        self.assertEqual(file.hash, self.file_1_hash)
+
+        file.hash = "Not hex"
+        self.assertEqual(file.hash, "Not hex")
+        self.assertEqual(file.digest, None)
+
+    def test_columnar_index(self):
+        self.fs.CreateFile('.bit_check', contents=(
+            '{"b.txt": [1, "ab", "sha1", {"size": 7}], '
+            '"a.txt": [2.5, "abcd", "sha256", {"inode": 3, "verified": 4}]}'))
+
+        result = rotten_bites.read_bitcheck('.', columnar=True)
+        self.assertIsInstance(result, rotten_bites.ColumnarIndex)
+        self.assertEqual(list(result), ["a.txt", "b.txt"])
+        self.assertEqual(result["a.txt"].to_json(),
+                         [2.5, "abcd", "sha256", {"inode": 3, "verified": 4}])
+        self.assertEqual(result["b.txt"].to_json(),
+                         [1, "ab", "sha1", {"size": 7}])
+        self.assertEqual(result["b.txt"].path, ".")
+
+        del result["b.txt"]
+        self.assertEqual(list(result), ["a.txt"])
+        with self.assertRaises(KeyError):
+            result["b.txt"]
+
+        # Hashes that aren't hex can't be stored in columns
+        self.fs.CreateFile('a/.bit_check', contents='{"a.txt": [1, "xyz"]}')
+        self.assertIsInstance(rotten_bites.read_bitcheck('a', columnar=True),
+                              dict)
+
+    def test_read_bitcheck_bad_binary(self):
+        self.fs.CreateFile('.bit_check', contents=b'RBIX\x01\x00')
+
+        result = rotten_bites.read_bitcheck('.')
+        self.assertEqual(result, {})
+
+    def test_run_columnar(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/file_2.txt', contents="file_2\n")
+        rotten_bites.run('a')
+
+        with open('a/file_2.txt', 'w') as f:
+            f.write("updated\n")
+        os.utime('a/file_2.txt', (1, 1))
+
+        updated = []
+        rotten_bites.run('a', columnar=True, updated_cb=updated.append)
+        self.assertEqual([f.name for f in updated], ['file_2.txt'])
+
+        nothing = []
+        rotten_bites.run('a', columnar=True, nothing_cb=nothing.append)
+        self.assertEqual([f.name for f in nothing],
+                         ['file_1.txt', 'file_2.txt'])
+
+    def test_run_binary(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/file_2.txt', contents="file_2\n")
+
+        rotten_bites.run('a', index_format='binary')
+        self.assertIsInstance(rotten_bites.read_bitcheck('a'),
+                              rotten_bites.BinaryIndex)
+
+        os.remove('a/file_2.txt')
+        nothing = []
+        missing = []
+        rotten_bites.run('a', nothing_cb=nothing.append,
+                         missing_cb=missing.append)
+        self.assertEqual([f.name for f in nothing], ['file_1.txt'])
+        self.assertEqual([f.name for f in missing], ['file_2.txt'])
+
+        # Without an index_format, files keep the format they're in
+        self.assertIsInstance(rotten_bites.read_bitcheck('a'),
+                              rotten_bites.BinaryIndex)
+        rotten_bites.run('a', index_format='json')
+        self.assertIsInstance(rotten_bites.read_bitcheck('a'), dict)
+
+        rotten_bites.convert_check_files('a', 'json')
+        data = rotten_bites.read_bitcheck('a')
+        self.assertIsInstance(data, dict)
+        self.assertEqual(data['file_1.txt'].hash, self.file_1_hash)
+
+    def test_binary_undecodable_names(self):
+        os.mkdir('a')
+        name = os.fsdecode(b'bad\xff')
+        data = {name: rotten_bites.File(name, 'a', 1234, hash_value='abcd'),
+                'good': rotten_bites.File('good', 'a', 1234, hash_value='ef')}
+        rotten_bites.save_bitcheck('a', data, 'binary')
+
+        index = rotten_bites.read_bitcheck('a')
+        self.assertEqual(sorted(index), sorted([name, 'good']))
+        self.assertEqual(index[name].hash, 'abcd')
+
     def test_compare_files(self):
         self.fs.CreateFile('file_1.txt', contents="file_1\n")
 
@@ -272,6 +458,66 @@ class TestRottenBites(fake_filesystem_unittest.TestCase):
         self.assertEqual(sorted(list(new_ignore_list.match_files(files))),
                          sorted(["foobar", "file3", "file22"]))
 
+    def test_ignore_matcher(self):
+        ignore_list = [
+            "file1",
+            "*.log",
+            "!keep.log",
+            "build/",
+            "a/*.txt",
+        ]
+
+        files = [
+            "file1",
+            "foobar",
+            "x.log",
+            "keep.log",
+            "b/x.log",
+            "b/build",
+            "build/file",
+            "a/x.txt",
+            "a/b/x.txt",
+            "c/file1/x",
+            ".bit_check",
+            "c/.bit_check",
+        ]
+
+        spec = rotten_bites.convert_ignore_list(ignore_list)
+        matcher = rotten_bites.IgnoreMatcher(ignore_list)
+
+        for file in files:
+            parts = file.split('/')
+            state = matcher.match_dir('', '')
+            for i, name in enumerate(parts[:-1]):
+                state = matcher.match_dir(name, '/'.join(parts[:i + 1]),
+                                          state)
+                if state is None:
+                    break
+
+            accepted = state is not None and matcher.match_file(
+                parts[-1], file, state)
+            self.assertEqual(accepted, spec.match_file(file), file)
+
+    def test_scan_dir_prune(self):
+        self.fs.CreateFile('d/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('d/node_modules/a/file_2.txt', contents="file_2\n")
+        self.fs.CreateFile('d/b/file_3.log', contents="file_3\n")
+        self.fs.CreateFile('d/b/node_modules', contents="file_4\n")
+
+        ignore = rotten_bites.IgnoreMatcher(['node_modules', '*.log'])
+        result = list(rotten_bites.walk_dir('d', ignore=ignore))
+
+        self.assertEqual(result, [('d', ['file_1.txt']), ('d/b', [])])
+
+        # Can't prune if something inside might be accepted again
+        ignore = rotten_bites.IgnoreMatcher(['node_modules', '!*.txt'])
+        result = list(rotten_bites.walk_dir('d', ignore=ignore))
+
+        self.assertEqual(result, [('d', ['file_1.txt']),
+                                  ('d/b', ['file_3.log']),
+                                  ('d/node_modules', []),
+                                  ('d/node_modules/a', ['file_2.txt'])])
+
     def test_handle_error(self):
         error = OSError("Fake error")
         path = '.'
@@ -550,11 +796,8 @@ class TestRottenBites(fake_filesystem_unittest.TestCase):
     def test_run_with_exception(self):
         self.fs.CreateFile('file_1.txt', contents="file_1\n")
 
-        def mock_stat(path):
-            raise OSError(100, "Error")
-
-        with unittest.mock.patch('rotten_bites.get_stat',
-                                 return_value=mock_stat):
+        with unittest.mock.patch('rotten_bites.stat_entry',
+                                 side_effect=OSError(100, "Error")):
             with self.assertRaises(OSError):
                 rotten_bites.run('.')
 
@@ -578,3 +821,1293 @@ class TestRottenBites(fake_filesystem_unittest.TestCase):
         rotten_bites.delete_check_files('.')
         for path, _, files in os.walk('.'):
             self.assertFalse('.bit_check' in files)
+
+        # Every other metafile goes too, but not files that look like one
+        for name in ('.resume.bit_check', '.resume.1-4.bit_check',
+                     '.rolling.bit_check', '.journal.bit_check',
+                     '.watcher.bit_check', 'a/.blocks.bit_check'):
+            self.fs.CreateFile(name, contents="stuff\n")
+        rotten_bites.delete_check_files('.')
+        self.assertEqual(sorted(os.path.join(path, name)
+                                for path, _, files in os.walk('.')
+                                for name in files),
+                         ['./a/b/c/.bit_checker', './a/b/c/bit_check',
+                          './file_1.txt'])
+
+    def test_File_stat_json(self):
+        file = rotten_bites.File("file_1.txt", ".", 1234, hash_value="abc",
+                                 size=7, inode=42)
+        self.assertEqual(file.to_json(),
+                         [1234, "abc", "sha1", {"size": 7, "inode": 42}])
+
+        data = rotten_bites.File.from_json(".", {"file_1.txt": file.to_json()})
+        self.assertEqual(data["file_1.txt"].size, 7)
+        self.assertEqual(data["file_1.txt"].inode, 42)
+
+    def test_run_quick(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/file_2.txt', contents="file_2\n")
+
+        rotten_bites.run('a')
+
+        # Bit rot can't be seen without hashing
+        st = os.stat('a/file_1.txt')
+        with open('a/file_1.txt', 'w') as f:
+            f.write("file_x\n")
+        os.utime('a/file_1.txt', (st.st_atime, st.st_mtime))
+
+        with open('a/file_2.txt', 'w') as f:
+            f.write("updated\n")
+        os.utime('a/file_2.txt', (st.st_atime, st.st_mtime + 10))
+
+        nothing = []
+        updated = []
+        hash_error = []
+
+        with unittest.mock.patch(
+                'rotten_bites.File.rehash', autospec=True,
+                side_effect=rotten_bites.File.rehash) as rehash:
+            rotten_bites.run('a', quick=True, nothing_cb=nothing.append,
+                             updated_cb=updated.append,
+                             hash_error_cb=lambda o, n: hash_error.append(n))
+
+            self.assertEqual([c[0][0].name for c in rehash.call_args_list],
+                             ['file_2.txt'])
+
+        self.assertEqual([f.name for f in nothing], ['file_1.txt'])
+        self.assertEqual([f.name for f in updated], ['file_2.txt'])
+        self.assertEqual(hash_error, [])
+
+        # A full run still finds it
+        rotten_bites.run('a', hash_error_cb=lambda o, n: hash_error.append(n))
+        self.assertEqual([f.name for f in hash_error], ['file_1.txt'])
+
+    def test_run_quick_lazy_index(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/file_2.txt', contents="file_2\n")
+
+        for index_format, columnar in (('binary', False), ('json', True)):
+            with unittest.mock.patch('time.time', return_value=1000):
+                rotten_bites.run('a', index_format=index_format)
+
+            nothing = []
+            with unittest.mock.patch('rotten_bites.CheckFileWriter.save') \
+                    as save:
+                rotten_bites.run('a', quick=True, columnar=columnar,
+                                 index_format=index_format,
+                                 nothing_cb=nothing.append)
+
+            # Trusted files weren't verified, so there's nothing to save
+            self.assertEqual(len(nothing), 2)
+            self.assertEqual(save.call_count, 0)
+            self.assertEqual([f.verified for f in rotten_bites.read_bitcheck(
+                'a').values()], [1000, 1000])
+            rotten_bites.delete_check_files('a')
+
+    def test_run_lazy_index_unchanged(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/file_2.txt', contents="file_2\n")
+
+        for index_format, columnar in (('binary', False), ('json', True)):
+            with unittest.mock.patch('time.time', return_value=1000):
+                rotten_bites.run('a', index_format=index_format)
+
+            with unittest.mock.patch('rotten_bites.LazyIndex.__setitem__',
+                                     autospec=True) as put:
+                rotten_bites.run('a', columnar=columnar,
+                                 index_format=index_format)
+
+            # New verified times alone don't turn stored files into Files
+            self.assertEqual(put.call_count, 0)
+            rotten_bites.delete_check_files('a')
+
+    def test_run_scrub(self):
+        for i in range(4):
+            self.fs.CreateFile('a/file_{}.txt'.format(i),
+                               contents="file_{}\n".format(i))
+
+        # Stagger when the files were verified
+        with unittest.mock.patch('time.time', return_value=1000):
+            rotten_bites.run('a')
+        data = rotten_bites.read_bitcheck('a')
+        for i, name in enumerate(sorted(data)):
+            data[name].verified = 1000 + i
+        rotten_bites.save_bitcheck('a', data)
+
+        def scrub_run(scrub, now):
+            with unittest.mock.patch('time.time', return_value=now):
+                with unittest.mock.patch(
+                        'rotten_bites.File.rehash', autospec=True,
+                        side_effect=rotten_bites.File.rehash) as rehash:
+                    rotten_bites.run('a', scrub=scrub)
+                    return [c[0][0].name for c in rehash.call_args_list]
+
+        scrub = rotten_bites.Scrub(period=100, max_fraction=0.5)
+        self.assertEqual(scrub_run(scrub, 1050),
+                         ['file_0.txt', 'file_1.txt'])
+        self.assertEqual(scrub_run(scrub, 1060),
+                         ['file_2.txt', 'file_3.txt'])
+        self.assertEqual(scrub_run(scrub, 1070),
+                         ['file_0.txt', 'file_1.txt'])
+
+        data = rotten_bites.read_bitcheck('a')
+        self.assertEqual([data[n].verified for n in sorted(data)],
+                         [1070, 1070, 1060, 1060])
+
+        # Overdue files are always verified
+        scrub = rotten_bites.Scrub(period=100, max_bytes=0)
+        self.assertEqual(scrub_run(scrub, 1165),
+                         ['file_2.txt', 'file_3.txt'])
+        self.assertEqual(scrub_run(scrub, 1170),
+                         ['file_0.txt', 'file_1.txt'])
+
+        scrub = rotten_bites.Scrub(period=100, max_bytes=7)
+        self.assertEqual(scrub_run(scrub, 1180), ['file_2.txt'])
+
+    def test_scrub_plan_over_budget(self):
+        for name, size in (('big', 5000), ('small_1', 400), ('small_2', 400),
+                           ('small_3', 400)):
+            self.fs.CreateFile('a/' + name, contents='x' * size)
+        rotten_bites.run('a')
+        data = rotten_bites.read_bitcheck('a')
+        for i, name in enumerate(('big', 'small_1', 'small_2', 'small_3')):
+            data[name].verified = 1000 + i
+        rotten_bites.save_bitcheck('a', data)
+
+        # The stalest file is taken even though it doesn't fit
+        scrub = rotten_bites.Scrub(period=10 ** 6, max_bytes=1000)
+        with unittest.mock.patch('time.time', return_value=2000):
+            self.assertEqual(scrub.plan('a'), {('a', 'big')})
+
+        # Files that don't fit are skipped for ones that do
+        data['big'].verified = 1010
+        rotten_bites.save_bitcheck('a', data)
+        with unittest.mock.patch('time.time', return_value=2000):
+            self.assertEqual(scrub.plan('a'),
+                             {('a', 'small_1'), ('a', 'small_2')})
+
+    def test_run_throttled(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+
+        with unittest.mock.patch('rotten_bites.Throttle.wait') as wait:
+            rotten_bites.run('a', max_bytes_per_sec=1000)
+            wait.assert_called_once_with(7, unittest.mock.ANY)
+
+    def test_run_only_saves_changes(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('b/file_2.txt', contents="file_2\n")
+        self.fs.CreateFile('b/c/file_3.txt', contents="file_3\n")
+
+        def saved(**kwargs):
+            with unittest.mock.patch(
+                    'rotten_bites.CheckFileWriter.save', autospec=True,
+                    side_effect=rotten_bites.CheckFileWriter.save) as save:
+                rotten_bites.run('.', **kwargs)
+                return [c[0][1] for c in save.call_args_list]
+
+        rotten_bites.run('.')
+        self.assertTrue(os.path.exists('b/c/.bit_check'))
+
+        self.assertEqual(saved(quick=True), [])
+
+        self.fs.CreateFile('b/file_4.txt', contents="file_4\n")
+        os.remove('b/c/file_3.txt')
+        self.assertEqual(saved(quick=True), ['./b', './b/c'])
+
+        # A full run alone doesn't rewrite anything
+        with unittest.mock.patch('time.time', return_value=2 ** 32):
+            self.assertEqual(saved(), [])
+
+        # But scrubbing needs to know when files were verified
+        with unittest.mock.patch('time.time', return_value=2 ** 32 + 1):
+            self.assertEqual(saved(scrub=rotten_bites.Scrub()),
+                             ['./a', './b'])
+
+        self.assertEqual(saved(index_format='binary'), ['./a', './b'])
+
+    def test_save_bitcheck_fsync(self):
+        file_1 = rotten_bites.File("file_1.txt", ".", 1234, hash_value="abc")
+
+        with unittest.mock.patch('rotten_bites.os.fsync') as fsync:
+            rotten_bites.save_bitcheck('.', {"file_1.txt": file_1},
+                                       fsync=True)
+            self.assertTrue(fsync.called)
+
+        self.assertEqual(os.listdir('.').count('.bit_check'), 1)
+        self.assertEqual(rotten_bites.read_bitcheck('.')['file_1.txt'].hash,
+                         'abc')
+
+    def test_check_file_writer_batches(self):
+        os.mkdir('a')
+        os.mkdir('b')
+        writer = rotten_bites.CheckFileWriter(batch_size=2)
+
+        writer.save('a', {})
+        self.assertFalse(os.path.exists('a/.bit_check'))
+
+        writer.save('b', {})
+        self.assertTrue(os.path.exists('a/.bit_check'))
+        self.assertTrue(os.path.exists('b/.bit_check'))
+        self.assertEqual(writer.saved, 2)
+
+    def test_run_with_workers(self):
+        for i in range(20):
+            self.fs.CreateFile('a/{}/file_{}.txt'.format(i % 3, i),
+                               contents="file_{}\n".format(i))
+
+        serial = []
+        rotten_bites.run('a', added_cb=lambda x: serial.append(x.name),
+                         dry_run=True)
+
+        parallel = []
+        rotten_bites.run('a', added_cb=lambda x: parallel.append(x.name),
+                         workers=4)
+
+        self.assertEqual(len(parallel), 20)
+        self.assertEqual(parallel, serial)
+
+        nothing = []
+        rotten_bites.run('a', nothing_cb=lambda x: nothing.append(x.name),
+                         workers=4)
+        self.assertEqual(nothing, serial)
+
+    def test_File_algorithm(self):
+        self.fs.CreateFile('file_1.txt', contents="file_1\n")
+
+        file = rotten_bites.File("file_1.txt", "", 1000, algorithm='sha256')
+
+        self.assertEqual(file.algorithm, 'sha256')
+        self.assertEqual(file.hash, hashlib.sha256(b"file_1\n").hexdigest())
+        self.assertEqual(file.to_json(), [1000, file.hash, 'sha256'])
+
+        data = rotten_bites.File.from_json("", {"file_1.txt": file.to_json()})
+        self.assertEqual(data["file_1.txt"].algorithm, 'sha256')
+
+        with self.assertRaises(ValueError):
+            rotten_bites.File("file_1.txt", "", 1000, algorithm='unknown')
+
+    def test_run_mixed_algorithms(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+
+        rotten_bites.run('a')
+        self.fs.CreateFile('a/file_2.txt', contents="file_2\n")
+
+        added = []
+        nothing = []
+        rotten_bites.run('a', added_cb=added.append,
+                         nothing_cb=nothing.append, algorithm='blake2b')
+
+        self.assertEqual([(f.name, f.algorithm) for f in nothing],
+                         [('file_1.txt', 'sha1')])
+        self.assertEqual([(f.name, f.algorithm) for f in added],
+                         [('file_2.txt', 'blake2b')])
+
+        data = rotten_bites.read_bitcheck('a')
+        self.assertEqual(data['file_1.txt'].hash, self.file_1_hash)
+        self.assertEqual(data['file_2.txt'].algorithm, 'blake2b')
+
+    def test_run_unavailable_algorithm(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/file_2.txt', contents="file_2\n")
+        rotten_bites.run('a')
+
+        # Written somewhere with a hash module that isn't installed here
+        data = rotten_bites.read_bitcheck('a')
+        data['file_1.txt'].algorithm = 'not_installed'
+        rotten_bites.save_bitcheck('a', data)
+
+        errors = []
+        nothing = []
+        for workers in (1, 2):
+            rotten_bites.run('a', nothing_cb=nothing.append, workers=workers,
+                             file_error_cb=lambda p, f, e: errors.append(
+                                 (f, type(e))))
+
+        self.assertEqual(errors, [('file_1.txt', ValueError)] * 2)
+        self.assertEqual([f.name for f in nothing], ['file_2.txt'] * 2)
+        self.assertEqual(rotten_bites.read_bitcheck('a')[
+            'file_1.txt'].algorithm, 'not_installed')
+
+    def test_run_sqlite(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/b/file_2.txt', contents="file_2\n")
+        store = rotten_bites.SQLiteStore(':memory:')
+
+        added = []
+        rotten_bites.run('a', added_cb=added.append, store=store)
+        self.assertEqual(len(added), 2)
+        self.assertFalse(os.path.exists('a/.bit_check'))
+
+        self.assertEqual(store.directories(),
+                         [os.path.abspath('a'), os.path.abspath('a/b')])
+        self.assertEqual(store.find_hash(self.file_1_hash),
+                         [os.path.abspath('a/file_1.txt')])
+        stats = store.stats()
+        self.assertEqual((stats['directories'], stats['files'],
+                          stats['bytes']), (2, 2, 14))
+
+        st = os.stat('a/file_1.txt')
+        with open('a/file_1.txt', 'w') as f:
+            f.write("file_x\n")
+        os.utime('a/file_1.txt', (st.st_atime, st.st_mtime))
+
+        hash_error = []
+        rotten_bites.run('a', hash_error_cb=lambda o, n: hash_error.append(n),
+                         store=store)
+        self.assertEqual([f.name for f in hash_error], ['file_1.txt'])
+
+        data = store.read('a', columnar=True)
+        self.assertIsInstance(data, rotten_bites.ColumnarIndex)
+        self.assertEqual(data['file_1.txt'].hash, self.file_1_hash)
+
+        # Deleted files are removed
+        os.remove('a/b/file_2.txt')
+        rotten_bites.run('a', store=store)
+        self.assertEqual(store.read('a/b'), {})
+
+    def test_import_export_check_files(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/b/file_2.txt', contents="file_2\n")
+        rotten_bites.run('a')
+        expected = rotten_bites.read_bitcheck('a/b')
+
+        store = rotten_bites.SQLiteStore(':memory:')
+        rotten_bites.import_check_files('a', store)
+        self.assertEqual(store.stats()['files'], 2)
+
+        rotten_bites.delete_check_files('a')
+        rotten_bites.export_check_files(store, 'binary')
+
+        data = rotten_bites.read_bitcheck('a/b')
+        self.assertIsInstance(data, rotten_bites.BinaryIndex)
+        self.assertEqual(data['file_2.txt'].to_json(),
+                         expected['file_2.txt'].to_json())
+
+    def test_scan_dir_after(self):
+        for path in ('a/file', 'a/b/file', 'a/b/c/file', 'a/b/d/file',
+                     'a/e/file', 'a/e/f/file'):
+            self.fs.CreateFile(path)
+
+        def walk(after):
+            return [path for path, _ in rotten_bites.scan_dir('a',
+                                                              after=after)]
+
+        self.assertEqual(walk(None), ['a', 'a/b', 'a/b/c', 'a/b/d', 'a/e',
+                                      'a/e/f'])
+        self.assertEqual(walk(''), ['a/b', 'a/b/c', 'a/b/d', 'a/e', 'a/e/f'])
+        self.assertEqual(walk('b/c/'), ['a/b/d', 'a/e', 'a/e/f'])
+        self.assertEqual(walk('b/d/'), ['a/e', 'a/e/f'])
+        self.assertEqual(walk('e/f/'), [])
+
+        # Directories that were deleted since are fine
+        self.assertEqual(walk('b/cc/'), ['a/b/d', 'a/e', 'a/e/f'])
+
+    def test_scan_dir_only(self):
+        for path in ('a/file', 'a/b/file', 'a/b/c/file', 'a/b/d/file',
+                     'a/e/file', 'a/e/f/file'):
+            self.fs.CreateFile(path)
+
+        with unittest.mock.patch('os.scandir', side_effect=os.scandir) as ls:
+            walk = [path for path, _ in rotten_bites.scan_dir(
+                'a', only={'b/c/', 'e/', 'gone/'})]
+
+        self.assertEqual(walk, ['a/b/c', 'a/e'])
+        # a/b/d and a/e/f aren't on the way to anything
+        self.assertEqual(sorted(call[0][0] for call in ls.call_args_list),
+                         ['a', 'a/b', 'a/b/c', 'a/e'])
+
+        walk = [path for path, _ in rotten_bites.scan_dir(
+            'a', skip={'b/', 'e/f/'})]
+        self.assertEqual(walk, ['a', 'a/b/c', 'a/b/d', 'a/e'])
+
+    def test_run_only_detect_moves(self):
+        for path in ('a/file', 'a/b/file', 'a/c/file'):
+            self.fs.CreateFile(path, contents=path)
+        rotten_bites.run('a')
+
+        with unittest.mock.patch('os.scandir', side_effect=os.scandir) as ls:
+            rotten_bites.run('a', only={'b/'}, detect_moves=True,
+                             scrub=rotten_bites.Scrub())
+
+        # Planning doesn't look at the whole tree either
+        self.assertNotIn('a/c', [call[0][0] for call in ls.call_args_list])
+
+    def test_run_resume(self):
+        for i in range(4):
+            self.fs.CreateFile('a/{}/file.txt'.format(i), contents="file\n")
+        checkpoint = rotten_bites.Checkpoint('a', interval=0)
+
+        def stop_at_2(file):
+            if file.path == 'a/2':
+                raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            rotten_bites.run('a', added_cb=stop_at_2, checkpoint=checkpoint)
+
+        self.assertTrue(os.path.exists('a/1/.bit_check'))
+        self.assertFalse(os.path.exists('a/2/.bit_check'))
+        self.assertEqual(checkpoint.load(), '1/')
+
+        added = []
+        rotten_bites.run('a', added_cb=added.append, checkpoint=checkpoint,
+                         resume=True)
+        self.assertEqual([f.path for f in added], ['a/2', 'a/3'])
+        self.assertIsNone(checkpoint.load())
+        self.assertFalse(os.path.exists('a/.resume.bit_check'))
+
+        # Without resume, everything is checked
+        nothing = []
+        rotten_bites.run('a', nothing_cb=nothing.append,
+                         checkpoint=checkpoint)
+        self.assertEqual(len(nothing), 4)
+
+    def test_run_shards(self):
+        for i in range(8):
+            self.fs.CreateFile('a/{}/file.txt'.format(i), contents="file\n")
+
+        added = []
+        for index in range(3):
+            shard = []
+            rotten_bites.run('a', added_cb=shard.append, shard=(index, 3))
+            added.append(set(f.path for f in shard))
+
+        # Every directory was checked by exactly one shard
+        self.assertEqual(sum(len(shard) for shard in added), 8)
+        self.assertEqual(set.union(*added),
+                         set('a/{}'.format(i) for i in range(8)))
+        self.assertEqual(rotten_bites.shard_of('0/', 3),
+                         rotten_bites.shard_of('0/', 3))
+
+        with self.assertRaises(ValueError):
+            rotten_bites.run('a', shard=(3, 3))
+
+    def test_merge_reports(self):
+        self.fs.CreateFile('a/b/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/c/file_2.txt', contents="file_2\n")
+        rotten_bites.run('a')
+        os.remove('a/c/file_2.txt')
+
+        for index in range(2):
+            report = rotten_bites.Report('report_{}'.format(index), 'a',
+                                         (index, 2))
+            rotten_bites.run(
+                'a', shard=(index, 2),
+                nothing_cb=lambda f: report.add('nothing', f.path, f.name),
+                missing_cb=lambda f: report.add('missing', f.path, f.name))
+            report.close()
+
+        merged = rotten_bites.merge_reports(['report_0', 'report_1'])
+        self.assertEqual(merged['counts'], {'nothing': 1, 'missing': 1})
+        self.assertEqual(merged['files']['missing'], ['c/file_2.txt'])
+        self.assertEqual(merged['shards'], [(0, 2), (1, 2)])
+        self.assertEqual(merged['missing_shards'], [])
+        self.assertEqual(merged['unfinished'], [])
+
+        # A shard that died part way through
+        with open('report_1', 'w') as f:
+            f.write('{"type": "header", "version": 1, "shard": [1, 2]}\n')
+        merged = rotten_bites.merge_reports(['report_1'])
+        self.assertEqual(merged['missing_shards'], [0])
+        self.assertEqual(merged['unfinished'], ['report_1'])
+
+        # It was resumed, adding to the same report
+        report = rotten_bites.Report('report_1', 'a', (1, 2), resumed='b/')
+        report.add('added', 'a/d', 'file_3.txt')
+        report.add('nothing', 'a/d', 'file_4.txt')
+        report.close()
+        merged = rotten_bites.merge_reports(['report_0', 'report_1'])
+        self.assertEqual(merged['counts'],
+                         {'nothing': 1, 'missing': 1, 'added': 1})
+        self.assertEqual(merged['files']['added'], ['d/file_3.txt'])
+        self.assertEqual(merged['unfinished'], [])
+
+        # Files listed by a run that died are still counted
+        report = rotten_bites.Report('report_1', 'a', (1, 2), resumed='d/')
+        report.add('error', 'a/e', 'file_5.txt')
+        report.close(finished=False)
+        report = rotten_bites.Report('report_1', 'a', (1, 2), resumed='e/')
+        report.file.close()
+        merged = rotten_bites.merge_reports(['report_1'])
+        self.assertEqual(merged['counts'],
+                         {'nothing': 1, 'added': 1, 'error': 1})
+        self.assertEqual(merged['unfinished'], ['report_1'])
+
+    def test_merge_reports_resumed(self):
+        for i in range(4):
+            self.fs.CreateFile('a/{}/file.txt'.format(i), contents="file\n")
+        checkpoint = rotten_bites.Checkpoint('a', interval=0)
+
+        def added(report, stop_at=None):
+            def callback(file):
+                report.add('added', file.path, file.name)
+                if file.path == stop_at:
+                    raise KeyboardInterrupt()
+            return callback
+
+        # a/2 is in the report, but the run died before it was saved
+        report = rotten_bites.Report('report', 'a')
+        with self.assertRaises(KeyboardInterrupt):
+            rotten_bites.run('a', added_cb=added(report, 'a/2'),
+                             checkpoint=checkpoint)
+        report.file.close()
+
+        report = rotten_bites.Report('report', 'a',
+                                     resumed=checkpoint.load())
+        rotten_bites.run('a', added_cb=added(report), checkpoint=checkpoint,
+                         resume=True)
+        report.close()
+
+        merged = rotten_bites.merge_reports(['report'])
+        self.assertEqual(merged['counts'], {'added': 4})
+        self.assertEqual(merged['files']['added'],
+                         ['{}/file.txt'.format(i) for i in range(4)])
+        self.assertEqual(merged['unfinished'], [])
+
+    def test_checkpoint_shards(self):
+        os.mkdir('a')
+        checkpoints = [rotten_bites.Checkpoint('a', interval=0, shard=(i, 2))
+                       for i in range(2)]
+        self.assertEqual(checkpoints[1].path, 'a/.resume.1-2.bit_check')
+
+        store = rotten_bites.CheckFileWriter()
+        for i, checkpoint in enumerate(checkpoints):
+            checkpoint.done('a/{}'.format(i), store)
+
+        # Finishing one shard leaves the other's checkpoint alone
+        checkpoints[0].clear()
+        self.assertIsNone(checkpoints[0].load())
+        self.assertEqual(checkpoints[1].load(), '1/')
+
+    def test_run_metrics(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/b/file_2.txt', contents="file_2\n")
+
+        for workers in (1, 2):
+            metrics = rotten_bites.Metrics()
+            rotten_bites.run('a', workers=workers, metrics=metrics)
+            summary = metrics.summary()
+
+            calls = {phase: values['calls']
+                     for phase, values in summary['phases'].items()}
+            self.assertEqual(calls, {'list': 2, 'stat': 2, 'index_read': 2,
+                                     'hash': 2, 'callbacks': 2,
+                                     'index_write': 3})
+            self.assertEqual(summary['bytes_hashed'], 14)
+            self.assertEqual(sum(summary['hash_seconds']['counts']), 2)
+            rotten_bites.delete_check_files('a')
+
+        metrics.save('metrics.prom', 'prometheus')
+        with open('metrics.prom') as f:
+            text = f.read()
+        self.assertIn('rotten_bites_phase_calls{phase="hash"} 2.0\n', text)
+        self.assertIn('rotten_bites_hash_seconds_bucket{le="+Inf"} 2.0\n',
+                      text)
+        self.assertIn('rotten_bites_hash_seconds_count 2.0\n', text)
+
+    def test_count_tree(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/b/file_2.txt', contents="file_2\n")
+        self.fs.CreateFile('a/b/file_3.txt', contents="file_3\n")
+        self.assertEqual(rotten_bites.count_tree('a'), (3, 21))
+
+        rotten_bites.run('a')
+        self.assertEqual(rotten_bites.count_tree('a', ['*_3.txt']), (2, 14))
+
+        # Stored sizes are used instead of stat-ing
+        with unittest.mock.patch('rotten_bites.stat_entry') as stat:
+            self.assertEqual(rotten_bites.count_tree('a'), (3, 21))
+            stat.assert_not_called()
+
+    def test_find_duplicates(self):
+        for path, contents in (('a/1.txt', 'same\n'), ('a/b/2.txt', 'same\n'),
+                               ('a/b/3.txt', 'other\n'), ('a/4.txt', ''),
+                               ('a/5.txt', ''), ('a/c/6.txt', 'other\n'),
+                               ('a/c/7.txt', 'same\n')):
+            self.fs.CreateFile(path, contents=contents)
+        rotten_bites.run('a')
+
+        expected = [
+            rotten_bites.Duplicate(5, 'sha1',
+                                   hashlib.sha1(b'same\n').hexdigest(),
+                                   ['a/1.txt', 'a/b/2.txt', 'a/c/7.txt'], 10),
+            rotten_bites.Duplicate(6, 'sha1',
+                                   hashlib.sha1(b'other\n').hexdigest(),
+                                   ['a/b/3.txt', 'a/c/6.txt'], 6),
+        ]
+
+        # Sorting in memory and spilling to disk find the same thing. The
+        # fake file system can't do temporary files.
+        spills = iter(range(100))
+
+        def spill(mode):
+            return open('/spill_{}'.format(next(spills)), mode)
+
+        for run_size in (100, 2):
+            with unittest.mock.patch('rotten_bites.File.rehash') as rehash, \
+                    unittest.mock.patch('tempfile.TemporaryFile', spill):
+                self.assertEqual(list(rotten_bites.find_duplicates(
+                    'a', run_size=run_size)), expected)
+                rehash.assert_not_called()
+
+        self.assertEqual(next(spills), 2)
+        self.assertEqual(len(list(rotten_bites.find_duplicates(
+            'a', min_size=0))), 3)
+
+    def test_run_detect_moves(self):
+        for i in range(4):
+            self.fs.CreateFile('a/b/file_{}.txt'.format(i),
+                               contents="file_{}\n".format(i))
+
+        with unittest.mock.patch('time.time', return_value=1000):
+            rotten_bites.run('a')
+
+        os.makedirs('a/c')
+        os.rename('a/b/file_0.txt', 'a/c/file_0.txt')
+        os.rename('a/b/file_1.txt', 'a/b/renamed.txt')
+        shutil.copy('a/b/file_2.txt', 'a/c/copy.txt')
+        os.remove('a/b/file_2.txt')
+        os.rename('a/b/file_3.txt', 'a/c/file_3.txt')
+        with open('a/c/file_3.txt', 'a') as f:
+            f.write("changed\n")
+
+        moved = []
+        added = []
+        missing = []
+        with unittest.mock.patch(
+                'rotten_bites.File.rehash', autospec=True,
+                side_effect=rotten_bites.File.rehash) as rehash:
+            rotten_bites.run('a', detect_moves=True, added_cb=added.append,
+                             missing_cb=missing.append,
+                             moved_cb=lambda o, n: moved.append((o, n)))
+
+        self.assertEqual(sorted((o.name, n.path, n.name) for o, n in moved),
+                         [('file_0.txt', 'a/c', 'file_0.txt'),
+                          ('file_1.txt', 'a/b', 'renamed.txt'),
+                          ('file_2.txt', 'a/c', 'copy.txt')])
+        self.assertEqual([f.name for f in added], ['file_3.txt'])
+        self.assertEqual([f.name for f in missing], ['file_3.txt'])
+
+        # Files moved in place weren't read, and kept when they were verified
+        self.assertEqual(sorted(c[0][0].name for c in rehash.call_args_list),
+                         ['copy.txt', 'file_3.txt'])
+        stored = rotten_bites.read_bitcheck('a/c')
+        self.assertEqual(stored['file_0.txt'].verified, 1000)
+        self.assertEqual(set(stored), {'file_0.txt', 'copy.txt',
+                                       'file_3.txt'})
+        self.assertEqual(set(rotten_bites.read_bitcheck('a/b')),
+                         {'renamed.txt'})
+
+    def test_scan(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/file_2.txt', contents="file_2\n")
+
+        events = list(rotten_bites.scan('a'))
+        self.assertEqual([(e.kind, e.path, e.name) for e in events],
+                         [('added', 'a', 'file_1.txt'),
+                          ('added', 'a', 'file_2.txt')])
+        self.assertEqual(events[0].file.hash, self.file_1_hash)
+
+        st = os.stat('a/file_1.txt')
+        with open('a/file_1.txt', 'w') as f:
+            f.write("file_x\n")
+        os.utime('a/file_1.txt', (st.st_atime, st.st_mtime))
+        os.remove('a/file_2.txt')
+
+        with unittest.mock.patch('rotten_bites.Event',
+                                 wraps=rotten_bites.Event) as event:
+            events = list(rotten_bites.scan('a', kinds=('error', 'missing')))
+
+        self.assertEqual([(e.kind, e.name) for e in events],
+                         [('error', 'file_1.txt'), ('missing', 'file_2.txt')])
+        self.assertEqual(events[0].old_file.hash, self.file_1_hash)
+        self.assertEqual(event.call_count, 2)
+
+        with self.assertRaises(ValueError):
+            list(rotten_bites.scan('a', kinds=('unknown',)))
+
+    def test_scan_stop_early(self):
+        for i in range(10):
+            self.fs.CreateFile('a/{}/file.txt'.format(i), contents="file\n")
+
+        events = rotten_bites.scan('a', buffer_size=1)
+        self.assertEqual(next(events).path, 'a/0')
+        events.close()
+
+        # The first directories were saved, but not all of them
+        self.assertTrue(os.path.exists('a/0/.bit_check'))
+        self.assertFalse(os.path.exists('a/9/.bit_check'))
+
+    def test_scan_stop_early_big_directory(self):
+        for i in range(300):
+            self.fs.CreateFile('a/file_{:03}.txt'.format(i), contents="file\n")
+
+        with unittest.mock.patch('rotten_bites.hash_file',
+                                 side_effect=rotten_bites.hash_file) as hashed:
+            events = rotten_bites.scan('a', buffer_size=1, workers=4)
+            for _ in range(5):
+                next(events)
+            events.close()
+
+        # Only a few files per worker were started ahead
+        self.assertLess(hashed.call_count, 50)
+
+    def test_scan_cancel(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+
+        # The caller's cancel stops the scan like closing it would
+        cancel = threading.Event()
+        cancel.set()
+        self.assertEqual(list(rotten_bites.scan('a', cancel=cancel)), [])
+        self.assertFalse(os.path.exists('a/.bit_check'))
+
+    def test_scan_raises(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+
+        with self.assertRaises(ValueError):
+            list(rotten_bites.scan('a', algorithm='unknown'))
+
+    def test_async_run(self):
+        self.fs.CreateFile('a/file_1.txt', contents="file_1\n")
+        self.fs.CreateFile('a/b/file_2.txt', contents="file_2\n")
+        progress = []
+
+        counts = asyncio.run(rotten_bites.async_run(
+            'a', progress_cb=lambda c: progress.append(sum(c.values()))))
+        self.assertEqual(counts, {'added': 2})
+        self.assertEqual(progress[-1], 2)
+
+        async def errors():
+            return [event async for event in rotten_bites.AsyncScan(
+                'a', kinds=('error',), algorithm='unknown')]
+
+        with self.assertRaises(ValueError):
+            asyncio.run(errors())
+
+    def test_async_scan_cancel(self):
+        for i in range(10):
+            self.fs.CreateFile('a/{}/file.txt'.format(i), contents="file\n")
+
+        async def first():
+            async with rotten_bites.AsyncScan('a', buffer_size=1) as events:
+                async for event in events:
+                    return event.path
+
+        self.assertEqual(asyncio.run(first()), 'a/0')
+        self.assertTrue(os.path.exists('a/0/.bit_check'))
+        self.assertFalse(os.path.exists('a/9/.bit_check'))
+
+        async def cancelled():
+            task = asyncio.ensure_future(rotten_bites.async_run(
+                'a', workers=2))
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancelled())
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestThrottle(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patches = [
+            unittest.mock.patch('time.monotonic', self.clock.monotonic),
+            unittest.mock.patch('time.sleep', self.clock.sleep),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def slow_chunks(self, count, size, latency):
+        for _ in range(count):
+            self.clock.sleep(latency)
+            yield b'x' * size
+
+    def test_max_bytes_per_sec(self):
+        throttle = rotten_bites.Throttle(max_bytes_per_sec=1000)
+        data = b''.join(throttle.wrap(self.slow_chunks(5, 500, 0)))
+
+        self.assertEqual(len(data), 2500)
+        # The first read is free, the rest wait their turn
+        self.assertAlmostEqual(self.clock.now, 2.0)
+
+    def test_max_iops(self):
+        throttle = rotten_bites.Throttle(max_iops=10)
+        list(throttle.wrap(self.slow_chunks(11, 1, 0)))
+
+        self.assertAlmostEqual(self.clock.now, 1.0)
+
+    def test_max_latency(self):
+        throttle = rotten_bites.Throttle(max_latency=0.05)
+
+        # Fast reads aren't slowed down
+        list(throttle.wrap(self.slow_chunks(10, 1, 0.01)))
+        self.assertAlmostEqual(self.clock.now, 0.1)
+        self.assertEqual(throttle.backoff, 0)
+
+        # Slow reads back off more and more
+        list(throttle.wrap(self.slow_chunks(10, 1, 0.2)))
+        self.assertEqual(throttle.backoff, rotten_bites.MAX_BACKOFF)
+        self.assertGreater(self.clock.now, 0.1 + 10 * 0.2 * 4)
+
+        # And recover once the reads are fast again
+        list(throttle.wrap(self.slow_chunks(50, 1, 0.001)))
+        self.assertEqual(throttle.backoff, 0)
+
+
+class TestProgress(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patch = unittest.mock.patch('time.monotonic', self.clock.monotonic)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_progress(self):
+        rendered = []
+        progress = rotten_bites.Progress(
+            10, 1000, lambda p: rendered.append((p.files, round(p.eta, 6))),
+            interval=1)
+
+        for _ in range(4):
+            self.clock.sleep(0.5)
+            progress.update(100)
+
+        # Only rendered once a second
+        self.assertEqual(rendered, [(2, 4.0), (4, 3.0)])
+        self.assertEqual(progress.bytes_per_sec, 200)
+        self.assertEqual(progress.files_per_sec, 2)
+
+        progress.finish()
+        self.assertEqual(len(rendered), 3)
+
+    def test_progress_without_bytes(self):
+        progress = rotten_bites.Progress(4, 0, lambda p: None)
+        self.assertIsNone(progress.eta)
+
+        progress.update(0)
+        self.assertEqual(progress.fraction, 0.25)
+
+
+@unittest.skipUnless(rotten_bites.load_inotify(), 'Needs inotify')
+class TestWatcher(unittest.TestCase):
+    """inotify and file locks need a real file system, so no pyfakefs."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        for name in ('a', 'b'):
+            os.mkdir(os.path.join(self.path, name))
+            with open(os.path.join(self.path, name, 'file'), 'w') as file:
+                file.write(name)
+        self.journal = rotten_bites.Journal(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def wait_for(self, check):
+        """Wait for check to return something other than None."""
+        for _ in range(200):
+            result = check()
+            if result is not None:
+                return result
+            time.sleep(0.01)
+        self.fail('Gave up waiting')
+
+    def test_journal(self):
+        # Nothing is watching, so everything has to be checked
+        self.journal.add(['a/'])
+        self.assertIsNone(self.journal.take())
+
+        lock = self.journal.hold()
+        try:
+            with self.assertRaises(RuntimeError):
+                self.journal.hold()
+
+            self.assertTrue(self.journal.watched())
+            self.assertEqual(self.journal.take(), {'a/'})
+            self.assertEqual(self.journal.take(), set())
+
+            self.journal.put_back({'a/', 'b/'})
+            self.journal.add(['a/'])
+            self.assertEqual(self.journal.take(), {'a/', 'b/'})
+
+            self.journal.put_back(None)
+            self.journal.add(['a/'])
+            self.assertIsNone(self.journal.take())
+        finally:
+            lock.close()
+        self.assertFalse(self.journal.watched())
+
+    def test_watcher(self):
+        stop = threading.Event()
+        watcher = rotten_bites.Watcher(self.path, interval=0.01)
+        thread = threading.Thread(target=watcher.run, args=(stop,))
+        thread.start()
+        try:
+            # It can't know what changed before it started
+            self.wait_for(lambda: True if self.journal.watched() and
+                          os.path.exists(self.journal.path) else None)
+            self.assertIsNone(self.journal.take())
+
+            with open(os.path.join(self.path, 'a', 'new'), 'w') as file:
+                file.write('new')
+            os.makedirs(os.path.join(self.path, 'c', 'd'))
+            with open(os.path.join(self.path, 'b', '.bit_check'), 'w'):
+                pass
+
+            changed = set()
+
+            def check():
+                changed.update(self.journal.take())
+                return changed if 'c/d/' in changed else None
+
+            self.assertEqual(self.wait_for(check), {'', 'a/', 'c/', 'c/d/'})
+
+            # Directories made later are watched too
+            with open(os.path.join(self.path, 'c', 'd', 'new'), 'w'):
+                pass
+            self.assertEqual(self.wait_for(lambda: self.journal.take() or
+                                           None), {'c/d/'})
+        finally:
+            stop.set()
+            thread.join()
+
+        self.assertFalse(self.journal.watched())
+
+    def test_watcher_ignore(self):
+        stop = threading.Event()
+        watcher = rotten_bites.Watcher(self.path, ignore=['node_modules',
+                                                          'c/skip/'],
+                                       interval=0.01)
+        thread = threading.Thread(target=watcher.run, args=(stop,))
+        thread.start()
+        try:
+            self.wait_for(lambda: True if self.journal.watched() and
+                          os.path.exists(self.journal.path) else None)
+            self.journal.take()
+
+            # Directories made later are matched from the top of the tree
+            for path in ('c/node_modules/package', 'c/skip/deep', 'c/keep'):
+                os.makedirs(os.path.join(self.path, *path.split('/')))
+
+            changed = set()
+
+            def check():
+                changed.update(self.journal.take() or ())
+                return changed if 'c/keep/' in changed else None
+
+            self.assertEqual(self.wait_for(check), {'', 'c/', 'c/keep/'})
+            self.assertEqual(sorted(watcher.watches.values()),
+                             ['', 'a/', 'b/', 'c/', 'c/keep/'])
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_run_watched(self):
+        rotten_bites.run(self.path)
+        self.assertFalse(rotten_bites.run_watched(self.path))
+
+        lock = self.journal.hold()
+        try:
+            os.remove(os.path.join(self.path, 'a', 'file'))
+            self.journal.add(['a/'])
+
+            missing = []
+            nothing = []
+            self.assertTrue(rotten_bites.run_watched(
+                self.path, missing_cb=missing.append,
+                nothing_cb=nothing.append))
+            self.assertEqual([f.path for f in missing],
+                             [os.path.join(self.path, 'a')])
+            self.assertEqual(nothing, [])
+
+            # The rest is verified for up to scrub_seconds, without checking
+            # the journal's directories again
+            with open(os.path.join(self.path, 'a', 'new'), 'w') as file:
+                file.write('new')
+            self.journal.add(['a/'])
+            added = []
+            self.assertTrue(rotten_bites.run_watched(
+                self.path, scrub_seconds=60, quick=True,
+                added_cb=added.append, nothing_cb=nothing.append))
+            self.assertEqual([f.name for f in added], ['new'])
+            self.assertEqual([f.path for f in nothing],
+                             [os.path.join(self.path, 'b')])
+
+            # A run that fails gives back what it took
+            self.journal.add(['b/'])
+            with self.assertRaises(ZeroDivisionError):
+                rotten_bites.run_watched(self.path,
+                                         nothing_cb=lambda f: 1 / 0)
+            self.assertEqual(self.journal.take(), {'b/'})
+        finally:
+            lock.close()
+
+
+class TestReadChunks(unittest.TestCase):
+    """mmap and posix_fadvise need real file descriptors, so no pyfakefs."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+        self.contents = os.urandom(100000)
+        with open(os.path.join(self.path, 'file_1'), 'wb') as file:
+            file.write(self.contents)
+        open(os.path.join(self.path, 'empty'), 'wb').close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_chunks(self):
+        for io_mode in rotten_bites.IO_MODES:
+            chunks = [bytes(c) for c in rotten_bites.read_chunks(
+                os.path.join(self.path, 'file_1'), 4096, io_mode)]
+
+            self.assertEqual(b''.join(chunks), self.contents)
+            self.assertEqual(len(chunks[0]), 4096)
+
+            chunks = list(rotten_bites.read_chunks(
+                os.path.join(self.path, 'empty'), 4096, io_mode))
+            self.assertEqual(chunks, [])
+
+    def test_read_chunks_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            list(rotten_bites.read_chunks(
+                os.path.join(self.path, 'file_1'), 4096, 'unknown'))
+
+    def test_File_io_modes(self):
+        expected = hashlib.sha1(self.contents).hexdigest()
+
+        for io_mode in rotten_bites.IO_MODES:
+            file = rotten_bites.File('file_1', self.path, 1000,
+                                     io_mode=io_mode, chunk_size=1 << 20)
+            self.assertEqual(file.hash, expected)
+
+
+class TestBatchesAndBlocks(unittest.TestCase):
+    """
+    Small files are read with os.readv and blocks with os.pread, which need
+    real file descriptors, so no pyfakefs.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+        self.contents = os.urandom(100000)
+        with open(os.path.join(self.path, 'file_1'), 'wb') as file:
+            file.write(self.contents)
+        open(os.path.join(self.path, 'empty'), 'wb').close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_run_small_files(self):
+        big = os.urandom(5000)
+        with open(os.path.join(self.path, 'big'), 'wb') as file:
+            file.write(big)
+        for i in range(5):
+            with open(os.path.join(self.path, 'small_{}'.format(i)),
+                      'wb') as file:
+                file.write(self.contents[:i * 1000])
+
+        expected = []
+        rotten_bites.run(self.path, added_cb=expected.append)
+        rotten_bites.delete_check_files(self.path)
+
+        for workers in (1, 2):
+            added = []
+            with unittest.mock.patch('rotten_bites.SMALL_FILE_BATCH', 2), \
+                    unittest.mock.patch('rotten_bites.hash_small_files',
+                                        side_effect=rotten_bites.
+                                        hash_small_files) as batches:
+                rotten_bites.run(self.path, added_cb=added.append,
+                                 workers=workers, small_file_size=4000)
+
+            self.assertEqual([(f.name, f.hash, f.size) for f in added],
+                             [(f.name, f.hash, f.size) for f in expected])
+            # 'empty' and five small files, two at a time
+            self.assertEqual(batches.call_count, 3)
+            self.assertEqual(len(batches.call_args_list[0][0][1]), 2)
+            rotten_bites.delete_check_files(self.path)
+
+    def test_hash_small_files_errors(self):
+        stat = os.stat(os.path.join(self.path, 'empty'))
+        results = rotten_bites.hash_small_files(
+            self.path, [('gone', stat, 'sha1'), ('empty', stat, 'sha256')],
+            {'small_file_size': 10})
+
+        self.assertIsInstance(results[0], FileNotFoundError)
+        self.assertEqual(results[1].hash, hashlib.sha256().hexdigest())
+
+        item = rotten_bites.BatchItem(rotten_bites.Deferred(lambda: results),
+                                      0)
+        with self.assertRaises(FileNotFoundError):
+            item.result()
+
+    def test_hash_small_files_io_mode(self):
+        stat = os.stat(os.path.join(self.path, 'file_1'))
+        expected = hashlib.sha1(self.contents).hexdigest()
+
+        for io_mode, dropped in (('buffered', False), ('readinto', True)):
+            with unittest.mock.patch('rotten_bites.advise') as advise:
+                results = rotten_bites.hash_small_files(
+                    self.path, [('file_1', stat, 'sha1')],
+                    {'small_file_size': 200000, 'io_mode': io_mode})
+
+            self.assertEqual(results[0].hash, expected)
+            self.assertEqual(advise.called, dropped)
+
+    def test_hash_small_files_short_reads(self):
+        stat = os.stat(os.path.join(self.path, 'file_1'))
+        expected = hashlib.sha1(self.contents).hexdigest()
+        options = {'small_file_size': 200000, 'chunk_size': 4096}
+
+        # Each small file takes one read, whatever chunk_size is
+        with unittest.mock.patch(
+                'rotten_bites.read_into_buffer',
+                side_effect=rotten_bites.read_into_buffer) as reads:
+            results = rotten_bites.hash_small_files(
+                self.path, [('file_1', stat, 'sha1')], options)
+        self.assertEqual(results[0].hash, expected)
+        self.assertEqual(reads.call_count, 1)
+
+        # Network file systems can hand back less than was asked for
+        read_into_buffer = rotten_bites.read_into_buffer
+
+        def short_read(descriptor, buffer):
+            return read_into_buffer(descriptor, memoryview(buffer)[:1000])
+
+        with unittest.mock.patch('rotten_bites.read_into_buffer',
+                                 side_effect=short_read):
+            results = rotten_bites.hash_small_files(
+                self.path, [('file_1', stat, 'sha1')], options)
+        self.assertEqual(results[0].hash, expected)
+
+    def test_blocks(self):
+        blocks = rotten_bites.Blocks('sha1', 30000)
+        for i in range(0, len(self.contents), 7000):
+            blocks.update(self.contents[i:i + 7000])
+        blocks.finish()
+
+        expected = [hashlib.sha1(self.contents[i:i + 30000]).digest()
+                    for i in range(0, len(self.contents), 30000)]
+        self.assertEqual(blocks.digests, expected)
+
+        left = hashlib.sha1(b'\x01' + expected[0] + expected[1]).digest()
+        right = hashlib.sha1(b'\x01' + expected[2] + expected[3]).digest()
+        self.assertEqual(blocks.root,
+                         hashlib.sha1(b'\x01' + left + right).hexdigest())
+
+        path = os.path.join(self.path, 'file_1')
+        for workers in (1, 3):
+            self.assertEqual(
+                rotten_bites.hash_blocks(path, 'sha1', 30000,
+                                         workers).digests, expected)
+            self.assertEqual(blocks.verify(path, workers), [])
+
+        with open(path, 'r+b') as file:
+            file.seek(95000)
+            file.write(b'\x00' * 10)
+        self.assertEqual(blocks.verify(path, 2), [(90000, 100000)])
+
+        copy = rotten_bites.Blocks.from_json(blocks.to_json())
+        copy.digests[0] = copy.digests[1] = b''
+        self.assertEqual(blocks.damaged(copy), [(0, 60000)])
+        with self.assertRaises(ValueError):
+            blocks.damaged(rotten_bites.Blocks('sha1', 1000))
+
+    def test_run_block_size(self):
+        path = os.path.join(self.path, 'file_1')
+        added = []
+        rotten_bites.run(self.path, added_cb=added.append, block_size=40000)
+
+        self.assertEqual([type(f).__name__ for f in added],
+                         ['File', 'BlockFile'])
+        self.assertEqual(added[1].hash,
+                         hashlib.sha1(self.contents).hexdigest())
+        self.assertEqual(list(rotten_bites.read_blocks(self.path)), ['file_1'])
+
+        stat = os.stat(path)
+        with open(path, 'r+b') as file:
+            file.seek(50000)
+            file.write(b'\x00' * 10)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        errors = []
+        rotten_bites.run(self.path, block_size=40000,
+                         hash_error_cb=lambda old, new: errors.append(new))
+        self.assertEqual([f.damaged for f in errors], [[(40000, 80000)]])
+
+        os.remove(path)
+        rotten_bites.run(self.path, block_size=40000)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.path, rotten_bites.BLOCKS_FILE)))
+
+    def test_tree_hash(self):
+        algorithm = rotten_bites.tree_algorithm('sha1', 30000)
+        self.assertEqual(rotten_bites.parse_tree_algorithm(algorithm),
+                         ('sha1', 30000))
+        self.assertIsNone(rotten_bites.parse_tree_algorithm('sha1'))
+        for bad in ('tree-x-sha1', 'tree-0-sha1', 'tree-10-unknown'):
+            with self.assertRaises(ValueError):
+                rotten_bites.get_hash(bad)
+
+        expected = rotten_bites.hash_blocks(
+            os.path.join(self.path, 'file_1'), 'sha1', 30000).root
+        for workers in (1, 4):
+            file = rotten_bites.File('file_1', self.path, 1000, None,
+                                     algorithm, workers=workers)
+            self.assertEqual(file.hash, expected)
+
+        # Up to one block, it's the same as the plain hash
+        digest = rotten_bites.get_hash(algorithm)
+        digest.update(b'abc')
+        self.assertEqual(digest.hexdigest(), hashlib.sha1(b'abc').hexdigest())
+
+    def test_run_tree_size(self):
+        added = []
+        rotten_bites.run(self.path, added_cb=added.append, workers=3,
+                         tree_size=30000, small_file_size=50000)
+
+        self.assertEqual([f.algorithm for f in added],
+                         ['sha1', rotten_bites.tree_algorithm('sha1', 30000)])
+
+        errors = []
+        rotten_bites.run(self.path, workers=3,
+                         hash_error_cb=lambda old, new: errors.append(new),
+                         tree_size=1000)
+        self.assertEqual(errors, [])
+        self.assertEqual(rotten_bites.read_bitcheck(self.path)[
+            'file_1'].algorithm, added[1].algorithm)
+
+    def test_run_tree_size_shared_pool(self):
+        for i in range(3):
+            with open(os.path.join(self.path, 'big_{}'.format(i)),
+                      'wb') as file:
+                file.write(self.contents)
+
+        with unittest.mock.patch(
+                'rotten_bites.ThreadPoolExecutor',
+                side_effect=rotten_bites.ThreadPoolExecutor) as pools:
+            added = []
+            rotten_bites.run(self.path, added_cb=added.append, workers=3,
+                             tree_size=10000)
+
+        # One pool for the files and one for all of their blocks
+        self.assertEqual(pools.call_count, 2)
+        tree = [f for f in added if f.algorithm != 'sha1']
+        self.assertEqual(len(tree), 4)
+        self.assertEqual(len(set(f.hash for f in tree)), 1)